@@ -0,0 +1,342 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+"""
+ベンチマーク用の、Kendra・S3・Bedrockのローカルの代替クライアント
+実際のAWSには接続せず、指定したレイテンシ・スロットリングの発生率・検索結果の件数で応答する
+（アプリのコードからはboto3のクライアントと同じメソッドで呼び出される）
+"""
+
+
+class FakeServiceProfile:
+    """
+    代替クライアントの応答の設定
+    """
+
+    def __init__(
+        self,
+        kendra_latency_ms=120,
+        s3_latency_ms=25,
+        bedrock_first_token_ms=600,
+        bedrock_tokens_per_second=80,
+        bedrock_output_tokens=200,
+        jitter=0.3,
+        throttle_rate=0.0,
+        result_count=10,
+        total_results=30,
+        transcription_ratio=0.7,
+        pdf_hit_ratio=0.9,
+        seed=0,
+    ):
+        """
+        :param kendra_latency_ms: Kendraのquery/retrieveAPIのレイテンシ（ミリ秒）
+        :param s3_latency_ms: S3のhead_object/list_objects_v2のレイテンシ（ミリ秒）
+        :param bedrock_first_token_ms: Bedrockの最初のトークンまでのレイテンシ（ミリ秒）
+        :param bedrock_tokens_per_second: Bedrockの出力トークンの生成速度（トークン/秒）
+        :param bedrock_output_tokens: Bedrockの回答の出力トークン数
+        :param jitter: レイテンシのばらつき（0〜1。レイテンシに1±jitterの範囲の乱数を掛ける）
+        :param throttle_rate: Kendra・Bedrockの呼び出しでスロットリングを発生させる確率（0〜1）
+        :param result_count: Kendraの1ページあたりの検索結果の件数の上限
+        :param total_results: Kendraの検索結果の総件数
+        :param transcription_ratio: 検索結果のうち、文字起こし（transcription/配下の.txt）の割合（0〜1）
+        :param pdf_hit_ratio: 文字起こしのうち、対応するPDFファイルが存在する割合（0〜1）
+        :param seed: 乱数のシード
+        """
+        self.kendra_latency_ms = kendra_latency_ms
+        self.s3_latency_ms = s3_latency_ms
+        self.bedrock_first_token_ms = bedrock_first_token_ms
+        self.bedrock_tokens_per_second = bedrock_tokens_per_second
+        self.bedrock_output_tokens = bedrock_output_tokens
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.result_count = result_count
+        self.total_results = total_results
+        self.transcription_ratio = transcription_ratio
+        self.pdf_hit_ratio = pdf_hit_ratio
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def sleep(self, latency_ms):
+        """
+        ばらつきを加えたレイテンシの分だけ待機する
+        :param latency_ms: 基準のレイテンシ（ミリ秒）
+        """
+        if latency_ms <= 0:
+            return
+        factor = 1 + self.jitter * (2 * self.random() - 1)
+        time.sleep(latency_ms * factor / 1000)
+
+    def maybeThrottle(self, operation_name):
+        """
+        throttle_rateの確率で、スロットリングのエラーを送出する
+        :param operation_name: APIの名前
+        """
+        if self.throttle_rate and self.random() < self.throttle_rate:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ThrottlingException",
+                        "Message": "Rate exceeded",
+                    },
+                    "ResponseMetadata": {"HTTPStatusCode": 400, "RetryAttempts": 0},
+                },
+                operation_name,
+            )
+
+
+def _responseMetadata():
+    return {"HTTPStatusCode": 200, "RetryAttempts": 0}
+
+
+def _documentNumber(query_text, rank):
+    """
+    検索クエリと順位から、文書の番号を決める（同じクエリには同じ文書を返す）
+    """
+    return (sum(map(ord, query_text)) * 31 + rank) % 100000
+
+
+class FakeKendraClient:
+    """
+    Kendraの代替クライアント（query, retrieve）
+    検索結果の文書のうち、transcription_ratioの割合を文字起こし（transcription/配下の.txt）とする
+    """
+
+    def __init__(self, profile, bucket_name):
+        self.profile = profile
+        self.bucket_name = bucket_name
+
+    def _isTranscription(self, document_number):
+        return (document_number % 1000) / 1000 < self.profile.transcription_ratio
+
+    def _documentUri(self, document_number):
+        if self._isTranscription(document_number):
+            key = f"transcription/doc{document_number}.txt"
+        else:
+            key = f"documents/doc{document_number}.pdf"
+        return f"https://{self.bucket_name}.s3.us-west-2.amazonaws.com/{key}"
+
+    def query(self, IndexId, QueryText, AttributeFilter, PageNumber=1, PageSize=10):
+        self.profile.sleep(self.profile.kendra_latency_ms)
+        self.profile.maybeThrottle("Query")
+        start = (PageNumber - 1) * PageSize
+        count = max(
+            0,
+            min(
+                PageSize, self.profile.result_count, self.profile.total_results - start
+            ),
+        )
+        items = []
+        for rank in range(start, start + count):
+            document_number = _documentNumber(QueryText, rank)
+            items.append(
+                {
+                    "Id": f"{document_number}",
+                    "Type": "DOCUMENT",
+                    "DocumentTitle": {"Text": f"doc{document_number}"},
+                    "DocumentExcerpt": {
+                        "Text": f"「{QueryText}」に関する文書{document_number}の抜粋です。"
+                        * 5
+                    },
+                    "DocumentURI": self._documentUri(document_number),
+                    "ScoreAttributes": {"ScoreConfidence": "HIGH"},
+                }
+            )
+        return {
+            "TotalNumberOfResults": self.profile.total_results,
+            "ResultItems": items,
+            "ResponseMetadata": _responseMetadata(),
+        }
+
+    def retrieve(self, IndexId, QueryText, AttributeFilter, PageSize=10):
+        self.profile.sleep(self.profile.kendra_latency_ms)
+        self.profile.maybeThrottle("Retrieve")
+        items = []
+        for rank in range(min(PageSize, self.profile.total_results)):
+            document_number = _documentNumber(QueryText, rank)
+            items.append(
+                {
+                    "Id": f"{document_number}-passage",
+                    "DocumentId": f"{document_number}",
+                    "DocumentTitle": f"doc{document_number}",
+                    "Content": f"「{QueryText}」に関する文書{document_number}のパッセージです。"
+                    * 10,
+                    "DocumentURI": self._documentUri(document_number),
+                    "ScoreAttributes": {"ScoreConfidence": "HIGH"},
+                }
+            )
+        return {"ResultItems": items, "ResponseMetadata": _responseMetadata()}
+
+
+class _FakePaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix):
+        self.client.profile.sleep(self.client.profile.s3_latency_ms)
+        keys = [key for key in self.client.pdf_keys if key.startswith(Prefix)]
+        for start in range(0, len(keys), 1000):
+            yield {"Contents": [{"Key": key} for key in keys[start : start + 1000]]}
+
+
+class FakeS3Client:
+    """
+    S3の代替クライアント（head_object, generate_presigned_url, list_objects_v2のpaginator）
+    文字起こしに対応するPDFファイルは、pdf_hit_ratioの割合で存在するものとする
+    """
+
+    class exceptions:
+        ClientError = ClientError
+
+    def __init__(self, profile, pdf_key_prefix):
+        self.profile = profile
+        self.pdf_key_prefix = pdf_key_prefix
+        # 存在するPDFファイルのキー（全ての文書番号のうち、pdf_hit_ratioの割合）
+        self.pdf_keys = [
+            f"{pdf_key_prefix}doc{document_number}.pdf"
+            for document_number in range(100000)
+            if (document_number * 7919 % 1000) / 1000 < profile.pdf_hit_ratio
+        ]
+        self._pdf_key_set = set(self.pdf_keys)
+
+    def addPdfKey(self, object_key):
+        """
+        PDFファイルを追加する（インデックスの構築後にアップロードされたファイルの再現に使用する）
+        :param object_key: オブジェクトキー
+        """
+        self.pdf_keys.append(object_key)
+        self._pdf_key_set.add(object_key)
+
+    def get_paginator(self, operation_name):
+        return _FakePaginator(self)
+
+    def head_object(self, Bucket, Key):
+        self.profile.sleep(self.profile.s3_latency_ms)
+        if Key.startswith(self.pdf_key_prefix) and Key not in self._pdf_key_set:
+            raise ClientError(
+                {
+                    "Error": {"Code": "404", "Message": "Not Found"},
+                    "ResponseMetadata": {"HTTPStatusCode": 404, "RetryAttempts": 0},
+                },
+                "HeadObject",
+            )
+        return {"ContentLength": 1024, "ResponseMetadata": _responseMetadata()}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        # 署名はローカルの計算のみのため、待機しない
+        return (
+            f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}"
+            f"?X-Amz-Expires={ExpiresIn}&X-Amz-Signature=fake"
+        )
+
+
+def _validateMessages(converse_kwargs, operation_name):
+    """
+    Bedrockと同じく、メッセージのロールがuserから始まりuserで終わり、userとassistantで交互になっていることを確認する
+    :param converse_kwargs: ConverseAPIの引数
+    :param operation_name: APIの名前
+    """
+    roles = [message["role"] for message in converse_kwargs["messages"]]
+    expected = ["user" if i % 2 == 0 else "assistant" for i in range(len(roles))]
+    if not roles or roles != expected or roles[-1] != "user":
+        raise ClientError(
+            {
+                "Error": {
+                    "Code": "ValidationException",
+                    "Message": f"A conversation must alternate between user and assistant roles: {roles}",
+                },
+                "ResponseMetadata": {"HTTPStatusCode": 400, "RetryAttempts": 0},
+            },
+            operation_name,
+        )
+
+
+class _Meta:
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+class FakeBedrockClient:
+    """
+    Bedrock Runtimeの代替クライアント（converse, converse_stream）
+    最初のトークンまでのレイテンシと、出力トークンの生成速度に応じて応答する
+    """
+
+    def __init__(self, profile, region_name):
+        self.profile = profile
+        self.meta = _Meta(region_name)
+
+    def _usage(self, converse_kwargs, output_tokens):
+        input_tokens = sum(
+            len(block.get("text", "")) // 3 + 1
+            for message in converse_kwargs["messages"]
+            for block in message["content"]
+        )
+        return {
+            "inputTokens": input_tokens,
+            "outputTokens": output_tokens,
+            "totalTokens": input_tokens + output_tokens,
+        }
+
+    def _outputTokens(self, converse_kwargs):
+        max_tokens = converse_kwargs.get("inferenceConfig", {}).get("maxTokens")
+        if max_tokens is None:
+            return self.profile.bedrock_output_tokens
+        return min(self.profile.bedrock_output_tokens, max_tokens)
+
+    def converse(self, **converse_kwargs):
+        _validateMessages(converse_kwargs, "Converse")
+        self.profile.maybeThrottle("Converse")
+        output_tokens = self._outputTokens(converse_kwargs)
+        self.profile.sleep(
+            self.profile.bedrock_first_token_ms
+            + output_tokens * 1000 / self.profile.bedrock_tokens_per_second
+        )
+        return {
+            "output": {
+                "message": {
+                    "role": "assistant",
+                    "content": [{"text": "回答です。" * max(1, output_tokens // 5)}],
+                }
+            },
+            "stopReason": "end_turn",
+            "usage": self._usage(converse_kwargs, output_tokens),
+            "metrics": {"latencyMs": self.profile.bedrock_first_token_ms},
+            "ResponseMetadata": _responseMetadata(),
+        }
+
+    def converse_stream(self, **converse_kwargs):
+        _validateMessages(converse_kwargs, "ConverseStream")
+        self.profile.maybeThrottle("ConverseStream")
+        output_tokens = self._outputTokens(converse_kwargs)
+        usage = self._usage(converse_kwargs, output_tokens)
+        profile = self.profile
+
+        def events():
+            yield {"messageStart": {"role": "assistant"}}
+            profile.sleep(profile.bedrock_first_token_ms)
+            # 5トークンずつ差分を返す
+            for _ in range(max(1, output_tokens // 5)):
+                yield {
+                    "contentBlockDelta": {
+                        "delta": {"text": "回答です。"},
+                        "contentBlockIndex": 0,
+                    }
+                }
+                profile.sleep(5 * 1000 / profile.bedrock_tokens_per_second)
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {
+                "metadata": {
+                    "usage": usage,
+                    "metrics": {"latencyMs": profile.bedrock_first_token_ms},
+                }
+            }
+
+        return {"stream": events(), "ResponseMetadata": _responseMetadata()}
@@ -0,0 +1,544 @@
+import argparse
+import concurrent.futures
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+# アプリのモジュールは、src/streamlit_rag_app直下のモジュールとして読み込む（streamlit run app.pyと同じ）
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_ROOT, "src", "streamlit_rag_app"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kendra_bedrock_query  # noqa: E402
+import pymupdf  # noqa: E402
+import telemetry  # noqa: E402
+from app_config import AppConfig  # noqa: E402
+from caches import KendraQueryCache  # noqa: E402
+from fake_aws import (  # noqa: E402
+    FakeBedrockClient,
+    FakeKendraClient,
+    FakeS3Client,
+    FakeServiceProfile,
+)
+from PIL import Image  # noqa: E402
+from region_pool import region_pool  # noqa: E402
+
+"""
+オフラインのベンチマーク
+Kendra・S3・Bedrockをローカルの代替クライアント（fake_aws）に差し替えた上で、
+ragSearch・kendraSearch・generateSignedUrls・invokeLLMWithFileの実際の処理を、N個の同時セッションから呼び出し、
+シナリオごとのスループット、処理全体とステージごとのレイテンシ（p50/p95/p99）、メモリの割り当て量をJSONで出力する
+--baselineに以前の結果を指定した場合は、p95のレイテンシとスループットの劣化を検出して終了コード1で終了する
+
+使用例:
+    python benchmarks/run_benchmark.py --sessions 16 --iterations 20 --output result.json
+    python benchmarks/run_benchmark.py --baseline result.json --max-regression 0.2
+"""
+
+# ベンチマークの結果のJSONの形式のバージョン（互換性のない変更を行った場合に上げる）
+SCHEMA_VERSION = 1
+
+SCENARIO_NAMES = [
+    "kendra_search",
+    "generate_signed_urls",
+    "rag_search",
+    "multi_modal_image",
+    "multi_modal_pdf",
+]
+
+BUCKET_NAME = "benchmark-bucket"
+
+
+def percentile(values, q):
+    """
+    分位数を、並べ替えた値の線形補間で求める
+    :param values: 値のリスト
+    :param q: 分位（0〜1）
+    :return: 分位数（値がない場合はNone）
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarizeLatencies(values):
+    """
+    レイテンシ（秒）のリストを、ミリ秒単位の統計値にまとめる
+    """
+    return {
+        "count": len(values),
+        "p50_ms": _toMilliseconds(percentile(values, 0.5)),
+        "p95_ms": _toMilliseconds(percentile(values, 0.95)),
+        "p99_ms": _toMilliseconds(percentile(values, 0.99)),
+        "max_ms": _toMilliseconds(max(values) if values else None),
+    }
+
+
+def _toMilliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class UploadedFile:
+    """
+    Streamlitのアップロードされたファイル（UploadedFile）の代わりに、invokeLLMWithFileに渡すファイル
+    """
+
+    def __init__(self, name, mime_type, content):
+        self.name = name
+        self.type = mime_type
+        self.size = len(content)
+        self._content = content
+
+    def getvalue(self):
+        return self._content
+
+
+def makeImageFile(index, size):
+    """
+    ベンチマーク用の画像ファイル（PNG）を生成する（indexごとに内容の異なる画像にする）
+    """
+    image = Image.new("RGB", (size, size), ((index * 37) % 256, 128, 64))
+    image.putpixel((0, 0), (index % 256, (index // 256) % 256, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return UploadedFile(f"image{index}.png", "image/png", buffer.getvalue())
+
+
+def makePdfFile(index, page_count):
+    """
+    ベンチマーク用のテキストを含むPDFファイルを生成する（indexごとに内容の異なるPDFにする）
+    """
+    document = pymupdf.open()
+    for page_number in range(page_count):
+        page = document.new_page()
+        page.insert_text(
+            (72, 72),
+            f"Benchmark document {index} page {page_number + 1}\n"
+            + "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n" * 20,
+        )
+    content = document.tobytes()
+    document.close()
+    return UploadedFile(f"document{index}.pdf", "application/pdf", content)
+
+
+def installFakeClients(profile):
+    """
+    アプリが使用するKendra・S3・Bedrockのクライアントを、代替クライアントに差し替える
+    """
+    os.environ.setdefault("kendra_index", "benchmark-index")
+    os.environ.setdefault("bucket_name", BUCKET_NAME)
+    kendra_client = FakeKendraClient(profile, BUCKET_NAME)
+    s3_client = FakeS3Client(profile, AppConfig.PDF_KEY_PREFIX)
+    bedrock_clients = {}
+    bedrock_clients_lock = threading.Lock()
+
+    def bedrockClientFactory(region_name, max_attempts):
+        with bedrock_clients_lock:
+            if region_name not in bedrock_clients:
+                bedrock_clients[region_name] = FakeBedrockClient(profile, region_name)
+            return bedrock_clients[region_name]
+
+    kendra_bedrock_query.getKendraClient = lambda: kendra_client
+    kendra_bedrock_query.getS3Client = lambda: s3_client
+    region_pool.client_factory = bedrockClientFactory
+
+
+class Scenario:
+    """
+    ベンチマークのシナリオ（セッションごとに、runを繰り返し呼び出す）
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.query_cache = (
+            KendraQueryCache(
+                max_entries=AppConfig.KENDRA_QUERY_CACHE_MAX_ENTRIES,
+                default_ttl_seconds=AppConfig.KENDRA_QUERY_CACHE_TTL_SECONDS,
+            )
+            if args.query_cache
+            else None
+        )
+        self.files = {}
+        self.kendra_response = None
+
+    def prepare(self, operation_count):
+        """
+        計測の前に、入力データを用意する
+        :param operation_count: 呼び出し回数の合計
+        """
+        # 同じファイルは保存領域や抽出結果のキャッシュから返されるため、呼び出しごとに異なるファイルを用意する
+        file_count = operation_count if self.args.unique_files else 1
+        if self.name == "multi_modal_image":
+            self.files = {
+                i: makeImageFile(i, self.args.image_size) for i in range(file_count)
+            }
+        elif self.name == "multi_modal_pdf":
+            self.files = {
+                i: makePdfFile(i, self.args.pdf_pages) for i in range(file_count)
+            }
+        elif self.name == "generate_signed_urls":
+            self.kendra_response = kendra_bedrock_query.getKendraClient().query(
+                IndexId="benchmark-index",
+                QueryText="署名付きURL",
+                AttributeFilter={},
+                PageSize=AppConfig.SEARCH_RESULTS_PAGE_SIZE,
+            )
+
+    def query(self, operation_index):
+        return f"ベンチマークの質問 {operation_index % self.args.distinct_queries}"
+
+    def run(self, operation_index):
+        """
+        シナリオの処理を1回実行する
+        :param operation_index: 全セッションを通した呼び出しの番号
+        :return: 成功した場合はTrue
+        """
+        if self.name == "kendra_search":
+            kendra_bedrock_query.kendraSearch(
+                self.query(operation_index), "all", self.query_cache
+            )
+            return True
+        if self.name == "generate_signed_urls":
+            kendra_bedrock_query.generateSignedUrls(self.kendra_response)
+            return True
+        if self.name == "rag_search":
+            # 画面と同じく、会話履歴の最後に今回の質問を追加して呼び出す
+            question = self.query(operation_index)
+            answer, _ = kendra_bedrock_query.ragSearch(
+                question,
+                [{"role": "user", "content": [{"text": question}]}],
+                AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"],
+                0.0,
+                "all",
+                stream=True,
+                query_cache=self.query_cache,
+            )
+            # 画面への表示と同じく、ストリームを最後まで読み込む
+            for _ in answer:
+                pass
+            return True
+        uploaded_file = self.files[operation_index % len(self.files)]
+        _, answered_model_id = kendra_bedrock_query.invokeLLMWithFile(
+            "この文書の内容を要約してください。", uploaded_file, []
+        )
+        # invokeLLMWithFileはエラーを回答として返すため、回答したモデルの有無で判定する
+        return answered_model_id is not None
+
+
+def runScenario(name, args):
+    """
+    シナリオを、args.sessions個の同時セッションから実行し、結果を集計する
+    :return: シナリオの結果の辞書
+    """
+    scenario = Scenario(name, args)
+    operation_count = args.sessions * args.iterations
+    scenario.prepare(operation_count + args.warmup + args.allocation_iterations)
+
+    # 共有のキャッシュはシナリオごとに空にする（シナリオの実行順による影響を避けるため）
+    kendra_bedrock_query.presigned_url_cache.invalidate()
+
+    # 初回のみの処理（インデックスの構築など）を計測から除外する
+    for i in range(args.warmup):
+        scenario.run(operation_count + i)
+
+    stage_samples = {}
+    stage_samples_lock = threading.Lock()
+
+    def collectSpan(span_name, seconds, attributes):
+        with stage_samples_lock:
+            stage_samples.setdefault(span_name, []).append(seconds)
+
+    latencies = []
+    errors = []
+    results_lock = threading.Lock()
+
+    def runSession(session_index):
+        for iteration in range(args.iterations):
+            operation_index = session_index * args.iterations + iteration
+            started_at = time.perf_counter()
+            try:
+                succeeded = scenario.run(operation_index)
+                error = None if succeeded else "failed"
+            except Exception as e:
+                error = type(e).__name__
+            elapsed = time.perf_counter() - started_at
+            with results_lock:
+                latencies.append(elapsed)
+                if error:
+                    errors.append(error)
+
+    telemetry.addSpanListener(collectSpan)
+    try:
+        started_at = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.sessions, thread_name_prefix="benchmark-session"
+        ) as executor:
+            for future in [
+                executor.submit(runSession, i) for i in range(args.sessions)
+            ]:
+                future.result()
+        wall_seconds = time.perf_counter() - started_at
+    finally:
+        telemetry.removeSpanListener(collectSpan)
+
+    error_counts = {}
+    for error in errors:
+        error_counts[error] = error_counts.get(error, 0) + 1
+    return {
+        "operations": operation_count,
+        "errors": len(errors),
+        "error_types": error_counts,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_ops_per_second": round(operation_count / wall_seconds, 3),
+        "latency": summarizeLatencies(latencies),
+        "stages": {
+            span_name: summarizeLatencies(samples)
+            for span_name, samples in sorted(stage_samples.items())
+        },
+        "allocations": measureAllocations(scenario, args, operation_count),
+    }
+
+
+def measureAllocations(scenario, args, first_operation_index):
+    """
+    シナリオを1セッションで実行し、メモリの割り当て量を計測する
+    （tracemallocは処理を遅くするため、レイテンシの計測とは別に実行する）
+    :return: {operations, peak_bytes, retained_bytes_per_operation}
+    """
+    if not args.allocation_iterations:
+        return None
+    tracemalloc.start()
+    try:
+        base_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for i in range(args.allocation_iterations):
+            try:
+                scenario.run(first_operation_index + args.warmup + i)
+            except Exception:
+                pass
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "operations": args.allocation_iterations,
+        "peak_bytes": peak_bytes - base_bytes,
+        "retained_bytes_per_operation": round(
+            (current_bytes - base_bytes) / args.allocation_iterations, 1
+        ),
+    }
+
+
+def _gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPOSITORY_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareWithBaseline(result, baseline, max_regression):
+    """
+    ベースラインの結果と比較し、劣化したシナリオを返す
+    :param result: 今回の結果
+    :param baseline: ベースラインの結果
+    :param max_regression: 許容する劣化の割合（0.2の場合、p95が1.2倍を超えるか、スループットが0.8倍を下回ると劣化とみなす）
+    :return: 劣化の内容を表す文字列のリスト
+    """
+    regressions = []
+    for name, scenario_result in result["scenarios"].items():
+        baseline_result = baseline.get("scenarios", {}).get(name)
+        if baseline_result is None:
+            continue
+        p95 = scenario_result["latency"]["p95_ms"]
+        baseline_p95 = baseline_result["latency"]["p95_ms"]
+        if p95 and baseline_p95 and p95 > baseline_p95 * (1 + max_regression):
+            regressions.append(f"{name}: p95 latency {baseline_p95}ms -> {p95}ms")
+        throughput = scenario_result["throughput_ops_per_second"]
+        baseline_throughput = baseline_result["throughput_ops_per_second"]
+        if throughput < baseline_throughput * (1 - max_regression):
+            regressions.append(
+                f"{name}: throughput {baseline_throughput} -> {throughput} ops/s"
+            )
+        if scenario_result["errors"] > baseline_result["errors"]:
+            regressions.append(
+                f"{name}: errors {baseline_result['errors']} -> {scenario_result['errors']}"
+            )
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Kendra・S3・Bedrockをローカルの代替クライアントに差し替えて、バックエンドの性能を計測する"
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=SCENARIO_NAMES,
+        default=SCENARIO_NAMES,
+        help="実行するシナリオ",
+    )
+    parser.add_argument("--sessions", type=int, default=8, help="同時セッション数")
+    parser.add_argument(
+        "--iterations", type=int, default=10, help="セッションごとの呼び出し回数"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="計測前に実行する呼び出し回数"
+    )
+    parser.add_argument(
+        "--allocation-iterations",
+        type=int,
+        default=5,
+        help="メモリの割り当て量を計測する呼び出し回数（0の場合は計測しない）",
+    )
+    parser.add_argument("--kendra-latency-ms", type=float, default=120)
+    parser.add_argument("--s3-latency-ms", type=float, default=25)
+    parser.add_argument("--bedrock-first-token-ms", type=float, default=600)
+    parser.add_argument("--bedrock-tokens-per-second", type=float, default=80)
+    parser.add_argument("--bedrock-output-tokens", type=int, default=200)
+    parser.add_argument(
+        "--jitter", type=float, default=0.3, help="レイテンシのばらつき（0〜1）"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Kendra・Bedrockでスロットリングを発生させる確率（0〜1）",
+    )
+    parser.add_argument(
+        "--result-count", type=int, default=10, help="1ページあたりの検索結果の件数"
+    )
+    parser.add_argument(
+        "--total-results", type=int, default=30, help="検索結果の総件数"
+    )
+    parser.add_argument(
+        "--transcription-ratio",
+        type=float,
+        default=0.7,
+        help="検索結果のうち、transcription/配下の文字起こしの割合（0〜1）",
+    )
+    parser.add_argument(
+        "--pdf-hit-ratio",
+        type=float,
+        default=0.9,
+        help="文字起こしのうち、対応するPDFファイルが存在する割合（0〜1）",
+    )
+    parser.add_argument(
+        "--distinct-queries",
+        type=int,
+        default=50,
+        help="検索クエリの種類の数（少ないほど検索キャッシュにヒットしやすい）",
+    )
+    parser.add_argument(
+        "--no-query-cache",
+        dest="query_cache",
+        action="store_false",
+        help="Kendraの検索結果のキャッシュを使用しない",
+    )
+    parser.add_argument(
+        "--no-unique-files",
+        dest="unique_files",
+        action="store_false",
+        help="マルチモーダルのシナリオで、全ての呼び出しに同じファイルを使う",
+    )
+    parser.add_argument("--image-size", type=int, default=2048)
+    parser.add_argument("--pdf-pages", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--span-log",
+        action="store_true",
+        help="スパンのJSONのログを出力する（出力の負荷も含めて計測する場合）",
+    )
+    parser.add_argument("--output", help="結果のJSONの出力先（省略時は標準出力）")
+    parser.add_argument("--baseline", help="比較するベースラインの結果のJSON")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="ベースラインと比較して許容する劣化の割合",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if not args.span_log:
+        telemetry.logger.setLevel(logging.WARNING)
+
+    profile = FakeServiceProfile(
+        kendra_latency_ms=args.kendra_latency_ms,
+        s3_latency_ms=args.s3_latency_ms,
+        bedrock_first_token_ms=args.bedrock_first_token_ms,
+        bedrock_tokens_per_second=args.bedrock_tokens_per_second,
+        bedrock_output_tokens=args.bedrock_output_tokens,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        result_count=args.result_count,
+        total_results=args.total_results,
+        transcription_ratio=args.transcription_ratio,
+        pdf_hit_ratio=args.pdf_hit_ratio,
+        seed=args.seed,
+    )
+    installFakeClients(profile)
+
+    result = {
+        "schema_version": SCHEMA_VERSION,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": _gitCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        print(f"running {name} ...", file=sys.stderr)
+        result["scenarios"][name] = runScenario(name, args)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        # 条件の異なる結果同士の比較は意味を持たないため、警告する
+        if baseline.get("parameters") != result["parameters"]:
+            print(
+                "WARNING baseline was measured with different parameters",
+                file=sys.stderr,
+            )
+        regressions = compareWithBaseline(result, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,493 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+
+import anyio
+from app_config import AppConfig
+from bedrock_scheduler import BedrockAdmissionError
+from caches import KendraQueryCache
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from kendra_bedrock_query import (
+    getMaxUploadBytes,
+    getMetricsText,
+    invokeLLMWithFile,
+    kendraSearch,
+    ragSearchPipeline,
+)
+from pydantic import BaseModel, Field
+from startup import startWarmUp
+from telemetry import getRequestId, requestScope
+
+if AppConfig.API_ASYNC_BACKEND_ENABLED:
+    # 非同期版のバックエンドはaiobotocoreが必要なため、使用する場合のみ読み込む
+    from async_aws_clients import closeAsyncClients
+    from kendra_bedrock_query_async import (
+        invokeLLMWithFileAsync,
+        kendraSearchAsync,
+        ragSearchPipelineAsync,
+    )
+
+"""
+ヘッドレスのHTTP API（ASGI）
+Streamlitの画面と同じバックエンドの関数（kendraSearch, ragSearchPipeline, invokeLLMWithFile）を、
+Streamlitの再実行やセッションのスレッドを介さずに呼び出すためのエントリポイント
+会話履歴はリクエストごとに呼び出し元から受け取り、サーバーには状態を持たないため、ワーカープロセスを増やして水平に拡張できる
+AppConfig.API_ASYNC_BACKEND_ENABLEDがTrueの場合は、非同期版のバックエンド（kendra_bedrock_query_async）をイベントループ上で直接呼び出す
+
+起動方法（src/streamlit_rag_appで実行）:
+    uvicorn api_server:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+
+# APIで使用するKendraの検索結果のキャッシュ（ワーカープロセス内の全リクエストで共有）
+query_cache = KendraQueryCache(
+    max_entries=AppConfig.KENDRA_QUERY_CACHE_MAX_ENTRIES,
+    default_ttl_seconds=AppConfig.KENDRA_QUERY_CACHE_TTL_SECONDS,
+)
+
+
+class ChatMessage(BaseModel):
+    """
+    会話履歴のメッセージ
+    """
+
+    role: Literal["user", "assistant"]
+    text: str
+
+
+class SearchRequest(BaseModel):
+    """
+    Kendra検索のリクエスト
+    """
+
+    query: str = Field(min_length=1)
+    category: str = "all"
+    page: int = Field(default=1, ge=1)
+
+
+class RagRequest(BaseModel):
+    """
+    RAG検索のリクエスト
+    """
+
+    question: str = Field(min_length=1)
+    history: List[ChatMessage] = Field(
+        default_factory=list, max_length=AppConfig.API_MAX_HISTORY_MESSAGES
+    )
+    model_key: str = "claude_3_5_sonnet"
+    temperature: float = Field(default=0.2, ge=0.0, le=1.0)
+    category: str = "all"
+    stream: bool = True
+
+
+def _toConverseMessages(history):
+    """
+    APIの会話履歴を、ConverseAPIの形式のメッセージに変換する
+    """
+    return [
+        {"role": message.role, "content": [{"text": message.text}]}
+        for message in history
+    ]
+
+
+def _toRagMessages(history, question):
+    """
+    RAG検索の会話履歴を、ConverseAPIの形式のメッセージに変換し、最後に今回の質問を追加する
+    （バックエンドは、画面と同じく会話履歴が今回の質問で終わっていることを前提とする）
+    """
+    if history and history[-1].role == "user":
+        raise HTTPException(
+            status_code=400,
+            detail="historyは assistant の発言で終わる必要があります（今回の質問はquestionで指定してください）",
+        )
+    return _toConverseMessages(history) + [
+        {"role": "user", "content": [{"text": question}]}
+    ]
+
+
+def _validateCategory(category):
+    if category not in AppConfig.CATEGORY_LABELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"categoryは次のいずれかを指定してください: {', '.join(AppConfig.CATEGORY_LABELS)}",
+        )
+
+
+def _formatEvent(event, data):
+    """
+    Server-Sent Eventsのイベントを組み立てる
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class UploadedFile:
+    """
+    FastAPIのUploadFileを、invokeLLMWithFileが受け付ける形式（StreamlitのUploadedFileと同じ属性）に変換したファイル
+    """
+
+    def __init__(self, name, mime_type, content):
+        self.name = name
+        self.type = mime_type
+        self.size = len(content)
+        self._content = content
+
+    def getvalue(self):
+        return self._content
+
+
+async def _runUntilDisconnected(request, coroutine):
+    """
+    非同期版のバックエンドの呼び出しを実行し、完了前にクライアントが切断した場合はキャンセルする
+    （キャンセルにより、実行中のKendra・S3・Bedrockへのリクエストも中止される）
+    :param request: リクエスト
+    :param coroutine: バックエンドの呼び出し（コルーチン）
+    :return: 呼び出しの結果
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {task}, timeout=AppConfig.API_DISCONNECT_POLL_SECONDS
+            )
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise HTTPException(status_code=499, detail="Client Closed Request")
+    finally:
+        task.cancel()
+
+
+class RequestLimitMiddleware:
+    """
+    同時に処理するリクエスト数とリクエストボディのサイズを制限し、リクエストごとにリクエストIDを発行するASGIミドルウェア
+    （レスポンスのストリーミングが完了するまでを1リクエストとして数える）
+    ボディのサイズは、Content-Lengthで上限を超える場合はボディを受信せずに、
+    Content-Lengthがない（chunked）場合は受信したサイズが上限を超えた時点で413を返す
+    （Starletteがアップロードされたファイルを一時ファイルに書き出す前に拒否するため）
+    リクエストIDはX-Request-IDヘッダーで返却し、バックエンドのスパンのログと対応付けられるようにする
+    """
+
+    def __init__(self, app, max_concurrent_requests, max_body_bytes):
+        self.app = app
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_body_bytes = max_body_bytes
+        self.active_requests = 0
+
+    def _bodyTooLargeDetail(self):
+        return f"リクエストのサイズは最大{self.max_body_bytes / (1024 * 1024):g}MBまでです。"
+
+    def _limitBody(self, receive):
+        """
+        受信したボディのサイズが上限を超えた場合に、HTTPException（413）を送出するreceiveを返す
+        （FastAPIがボディの解析中の例外として扱い、413のレスポンスを返す）
+        """
+        received_bytes = 0
+
+        async def limitedReceive():
+            nonlocal received_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                received_bytes += len(message.get("body", b""))
+                if received_bytes > self.max_body_bytes:
+                    raise HTTPException(
+                        status_code=413, detail=self._bodyTooLargeDetail()
+                    )
+            return message
+
+        return limitedReceive
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.active_requests >= self.max_concurrent_requests:
+            response = JSONResponse(
+                {
+                    "detail": "リクエストが混み合っています。しばらくしてから再度お試しください。"
+                },
+                status_code=503,
+            )
+            await response(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit():
+            if int(content_length) > self.max_body_bytes:
+                response = JSONResponse(
+                    {"detail": self._bodyTooLargeDetail()}, status_code=413
+                )
+                await response(scope, receive, send)
+                return
+        else:
+            receive = self._limitBody(receive)
+
+        self.active_requests += 1
+        try:
+            with requestScope(
+                "api_request", method=scope["method"], path=scope["path"]
+            ) as attributes:
+                request_id = getRequestId()
+
+                async def sendWithRequestId(message):
+                    if message["type"] == "http.response.start":
+                        attributes["status"] = message["status"]
+                        message["headers"] = list(message.get("headers", [])) + [
+                            (b"x-request-id", request_id.encode("ascii"))
+                        ]
+                    await send(message)
+
+                await self.app(scope, receive, sendWithRequestId)
+        finally:
+            self.active_requests -= 1
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # バックエンドの処理はブロッキングのため、スレッドプールで実行する（スレッド数の上限を設定する）
+    anyio.to_thread.current_default_thread_limiter().total_tokens = (
+        AppConfig.API_WORKER_THREADS
+    )
+    # AWSクライアントの生成と接続の確立を、最初のリクエストを待たずにバックグラウンドで行う
+    if AppConfig.STARTUP_WARMUP_ENABLED:
+        startWarmUp()
+    yield
+    if AppConfig.API_ASYNC_BACKEND_ENABLED:
+        await closeAsyncClients()
+
+
+app = FastAPI(title=f"{AppConfig.APP_NAME} API", lifespan=lifespan)
+app.add_middleware(
+    RequestLimitMiddleware,
+    max_concurrent_requests=AppConfig.API_MAX_CONCURRENT_REQUESTS,
+    max_body_bytes=AppConfig.API_MAX_REQUEST_BODY_BYTES,
+)
+
+
+@app.exception_handler(BedrockAdmissionError)
+async def handleAdmissionError(request, error):
+    # Bedrockの流量制御で送信できなかった場合は、再試行を促す
+    return JSONResponse({"detail": str(error)}, status_code=503)
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    ヘルスチェック（ロードバランサーからの死活監視用）
+    """
+    return {"status": "ok"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    ワーカープロセスの計測結果（Prometheusのテキスト形式）
+    """
+    return await run_in_threadpool(getMetricsText, query_cache)
+
+
+@app.post("/v1/search")
+async def search(request: SearchRequest, http_request: Request):
+    """
+    Kendra検索（指定したページの検索結果の署名付きURLを返す）
+    """
+    _validateCategory(request.category)
+    if AppConfig.API_ASYNC_BACKEND_ENABLED:
+        signed_urls, has_more = await _runUntilDisconnected(
+            http_request,
+            kendraSearchAsync(
+                request.query, request.category, query_cache, request.page
+            ),
+        )
+    else:
+        signed_urls, has_more = await run_in_threadpool(
+            kendraSearch, request.query, request.category, query_cache, request.page
+        )
+    return {"results": signed_urls, "has_more": has_more, "page": request.page}
+
+
+@app.post("/v1/rag")
+async def rag(request: RagRequest, http_request: Request):
+    """
+    RAG検索
+    stream=trueの場合は、回答の差分（delta）を生成され次第Server-Sent Eventsで返し、
+    最後に署名付きURL・回答したモデル・トークン使用量・処理時間（done）を返す
+    """
+    _validateCategory(request.category)
+    model_id = AppConfig.MODEL_ID_DICT.get(request.model_key)
+    if model_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"model_keyは次のいずれかを指定してください: {', '.join(AppConfig.MODEL_ID_DICT)}",
+        )
+
+    if AppConfig.API_ASYNC_BACKEND_ENABLED:
+        return await _ragAsync(request, http_request, model_id)
+
+    try:
+        result = await run_in_threadpool(
+            ragSearchPipeline,
+            request.question,
+            _toRagMessages(request.history, request.question),
+            model_id,
+            request.temperature,
+            request.category,
+            stream=request.stream,
+            query_cache=query_cache,
+        )
+    except ValueError as e:
+        # 会話履歴のロールが交互になっていない場合など
+        raise HTTPException(status_code=400, detail=str(e))
+    if not request.stream:
+        return {
+            "answer": result.answer,
+            "model_id": result.model_id,
+            "results": await run_in_threadpool(lambda: result.signed_urls),
+            "has_more": result.has_more,
+            "timings": result.timings,
+        }
+
+    def events():
+        # 同期のジェネレータはStarletteがスレッドプールで読み込むため、ストリームの待機でイベントループを止めない
+        try:
+            for delta_text in result.stream:
+                yield _formatEvent("delta", {"text": delta_text})
+            yield _formatEvent(
+                "done",
+                {
+                    "model_id": result.model_id,
+                    "results": result.signed_urls,
+                    "has_more": result.has_more,
+                    "usage": result.stream.usage,
+                    "timings": result.timings,
+                },
+            )
+        except Exception as e:
+            yield _formatEvent("error", {"detail": str(e)})
+
+    return _eventStreamResponse(events())
+
+
+async def _ragAsync(request, http_request, model_id):
+    """
+    非同期版のバックエンドでRAG検索を行う
+    ストリーミングの場合、クライアントが切断するとStarletteがジェネレータをキャンセルし、
+    Bedrockのストリームと署名付きURLの生成も中止される
+    """
+    try:
+        result = await _runUntilDisconnected(
+            http_request,
+            ragSearchPipelineAsync(
+                request.question,
+                _toRagMessages(request.history, request.question),
+                model_id,
+                request.temperature,
+                request.category,
+                stream=request.stream,
+                query_cache=query_cache,
+            ),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not request.stream:
+        return {
+            "answer": result.answer,
+            "model_id": result.model_id,
+            "results": await _runUntilDisconnected(
+                http_request, result.getSignedUrls()
+            ),
+            "has_more": result.has_more,
+            "timings": result.timings,
+        }
+
+    async def events():
+        try:
+            async for delta_text in result.stream:
+                yield _formatEvent("delta", {"text": delta_text})
+            yield _formatEvent(
+                "done",
+                {
+                    "model_id": result.model_id,
+                    "results": await result.getSignedUrls(),
+                    "has_more": result.has_more,
+                    "usage": result.stream.usage,
+                    "timings": result.timings,
+                },
+            )
+        except Exception as e:
+            yield _formatEvent("error", {"detail": str(e)})
+        finally:
+            result.cancel()
+
+    return _eventStreamResponse(events())
+
+
+def _eventStreamResponse(events):
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/v1/multimodal")
+async def multimodal(
+    http_request: Request,
+    question: str = Form(""),
+    history: str = Form("[]"),
+    file: Optional[UploadFile] = File(None),
+):
+    """
+    マルチモーダル（アップロードされた画像・PDFと質問から回答を生成する）
+    historyは会話履歴（[{"role", "text"}]）のJSON文字列で指定する
+    """
+    try:
+        messages = _toConverseMessages(
+            [ChatMessage(**message) for message in json.loads(history)]
+        )
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"historyの形式が不正です: {e}")
+    if len(messages) > AppConfig.API_MAX_HISTORY_MESSAGES:
+        raise HTTPException(status_code=400, detail="historyの件数が上限を超えています")
+
+    uploaded_file = None
+    if file is not None:
+        file_format = AppConfig.SUPPORTED_FORMATS.get(file.content_type)
+        if not file_format:
+            raise HTTPException(
+                status_code=415,
+                detail=f"サポートされていないファイル形式です。以下の形式に対応しています: {', '.join(AppConfig.SUPPORTED_FORMATS.values())}",
+            )
+        max_upload_bytes = getMaxUploadBytes(file_format)
+        # ファイルは、受信時にStarletteが一時ファイルに書き出している
+        # （リクエスト全体のサイズはRequestLimitMiddlewareで制限し、ここではファイル形式ごとの上限を確認する）
+        # 上限を1バイト超えるまで読み込み、上限を超えるファイルはメモリ上に全体を読み込まずに拒否する
+        content = await file.read(int(max_upload_bytes) + 1)
+        if len(content) > max_upload_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"アップロードできるファイルサイズは最大{max_upload_bytes / (1024 * 1024):g}MBまでです。",
+            )
+        uploaded_file = UploadedFile(file.filename, file.content_type, content)
+
+    try:
+        if AppConfig.API_ASYNC_BACKEND_ENABLED:
+            answer, model_id = await _runUntilDisconnected(
+                http_request, invokeLLMWithFileAsync(question, uploaded_file, messages)
+            )
+        else:
+            answer, model_id = await run_in_threadpool(
+                invokeLLMWithFile, question, uploaded_file, messages
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # invokeLLMWithFileはBedrockの呼び出しのエラーを回答として返すため、回答したモデルの有無で判定する
+    if model_id is None:
+        raise HTTPException(status_code=502, detail=answer)
+    return {"answer": answer, "model_id": model_id}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("api_server:app", host="0.0.0.0", port=8000)
@@ -1,17 +1,13 @@
+import importlib
 import re
 
 import streamlit as st
 from app_config import AppConfig
-from dotenv import load_dotenv
-from kendra_bedrock_query import (
-    invokeLLMWithFile,
-    invokeLLMWithoutFile,
-    kendraSearch,
-    ragSearch,
-)
-
-# 環境変数をロード
-load_dotenv()
+from attachment_store import ATTACHMENT_REF_KEY
+from caches import KendraQueryCache
+from history_manager import HistoryManager
+from startup import getBackend, startup_report, startWarmUp
+from telemetry import stage_metrics, startMetricsServer
 
 
 # メッセージリストの順序を保証する関数
@@ -39,6 +35,67 @@ def initialize_session():
             "kendra_search": [],
             "multi_modal": [],
         }
+    # 各タブの会話履歴の管理（送信する会話履歴の絞り込みと、古い会話の要約）
+    if "history_managers" not in st.session_state:
+        st.session_state.history_managers = {
+            "rag_search": HistoryManager(),
+            "multi_modal": HistoryManager(),
+        }
+    # 各タブの直近の検索結果
+    if "search_results" not in st.session_state:
+        st.session_state.search_results = {}
+    # 各タブの直近の回答のトークン使用量
+    if "last_usage" not in st.session_state:
+        st.session_state.last_usage = {}
+    # 各タブの直近の処理のステージごとの処理時間
+    if "last_timings" not in st.session_state:
+        st.session_state.last_timings = {}
+    # 各タブの会話履歴で、表示する最も古いメッセージの位置（「さらに前の会話を表示」でさかのぼる）
+    if "history_first_index" not in st.session_state:
+        st.session_state.history_first_index = {}
+    # 各タブの会話履歴の、メッセージごとの表示用のMarkdown {tab_key: {位置: (メッセージ, Markdown)}}
+    if "rendered_messages" not in st.session_state:
+        st.session_state.rendered_messages = {}
+    # 直近の一括検索の結果 {rows, csv, parquet, error_count}
+    if "bulk_search_results" not in st.session_state:
+        st.session_state.bulk_search_results = None
+
+
+# メッセージを表示用のMarkdownに変換
+def render_message_markdown(tab_key, index, message):
+    """
+    メッセージのテキストとファイル名を、表示用のMarkdownに変換する
+    会話履歴は追加のみで変更されないため、変換結果はメッセージごとにsession stateに保持し、再実行時に使い回す
+    :param tab_key: session_stateのキー
+    :param index: 会話履歴でのメッセージの位置
+    :param message: メッセージ
+    :return: Markdownの文字列
+    """
+    rendered = st.session_state.rendered_messages.setdefault(tab_key, {})
+    cached = rendered.get(index)
+    if cached is not None and cached[0] is message:
+        return cached[1]
+
+    parts = []
+    for block in message["content"]:
+        if "text" in block:
+            parts.append(block["text"])
+        elif ATTACHMENT_REF_KEY in block:
+            parts.append(f"📎 {block[ATTACHMENT_REF_KEY]['name']}")
+    markdown = "\n\n".join(parts)
+    rendered[index] = (message, markdown)
+    return markdown
+
+
+def load_older_messages(tab_key, first_index):
+    """
+    「さらに前の会話を表示」が押された際に、表示する会話を1ページ分さかのぼる
+    :param tab_key: session_stateのキー
+    :param first_index: 現在表示している最も古いメッセージの位置
+    """
+    st.session_state.history_first_index[tab_key] = max(
+        0, first_index - AppConfig.CHAT_HISTORY_PAGE_TURNS * 2
+    )
 
 
 # チャットメッセージを表示
@@ -47,20 +104,50 @@ def display_tab_messages(
 ):
     """
     過去のメッセージや履歴を折りたたみで表示する汎用関数。
+    再実行のたびに全ての履歴を描画しないよう、直近の会話（AppConfig.CHAT_HISTORY_WINDOW_TURNS）のみを表示し、
+    それより前の会話は「さらに前の会話を表示」が押された時点で、ページごとに1つの要素にまとめて表示する
     :param tab_key: session_stateのキー
     :param label: 折りたたみタイトル
     :param empty_message: メッセージが空の場合の表示内容
     """
+    messages = st.session_state.tab_messages[tab_key]
     # チャット履歴が存在するか確認し、なければ履歴がない旨のメッセージを表示
-    if not st.session_state.tab_messages[tab_key]:
+    if not messages:
         st.info(empty_message)
         return
 
+    # 直近の会話の開始位置と、さかのぼって表示する最も古いメッセージの位置
+    window_start = max(0, len(messages) - AppConfig.CHAT_HISTORY_WINDOW_TURNS * 2)
+    first_index = min(
+        st.session_state.history_first_index.get(tab_key, window_start), window_start
+    )
+    page_size = AppConfig.CHAT_HISTORY_PAGE_TURNS * 2
+
     # 過去の会話/検索履歴を expander 内にまとめて表示
     with st.expander(label):
-        for message in st.session_state.tab_messages[tab_key]:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"][0]["text"])
+        if first_index > 0:
+            st.button(
+                f"さらに前の会話を表示（残り{first_index}件）",
+                key=f"{tab_key}_load_older",
+                on_click=load_older_messages,
+                args=(tab_key, first_index),
+            )
+
+        # さかのぼって表示する会話は、ページごとに1つのMarkdownにまとめて表示
+        for page_start in range(first_index, window_start, page_size):
+            page_end = min(page_start + page_size, window_start)
+            st.markdown(
+                "\n\n---\n\n".join(
+                    f"**{'ユーザー' if messages[index]['role'] == 'user' else 'アシスタント'}**\n\n"
+                    + render_message_markdown(tab_key, index, messages[index])
+                    for index in range(page_start, page_end)
+                )
+            )
+
+        # 直近の会話
+        for index in range(window_start, len(messages)):
+            with st.chat_message(messages[index]["role"]):
+                st.markdown(render_message_markdown(tab_key, index, messages[index]))
 
 
 # モデル名の表示を整形
@@ -69,33 +156,283 @@ def format_model_key_for_display(key):
     return formatted_model_name
 
 
-def display_search_results(signed_urls):
+# 実際に回答したモデルを表示（ルーティングにより、選択したモデルと異なる場合がある）
+def display_answered_model(model_id):
+    model_key = next(
+        (key for key, value in AppConfig.MODEL_ID_DICT.items() if value == model_id),
+        None,
+    )
+    if model_key:
+        st.caption(f"回答モデル: {format_model_key_for_display(model_key)}")
+
+
+def set_search_results(tab_key, signed_urls, has_more, pages):
+    """
+    検索結果をsession stateに格納する（「さらに表示」でページを追加取得できるよう、ジェネレータも保持する）
+    :param tab_key: session_stateのキー
+    :param signed_urls: 取得済みの検索結果（辞書のリスト形式）
+    :param has_more: 次のページが存在するかどうか
+    :param pages: 次のページ以降を取得するジェネレータ（iterSearchResultPages）
+    """
+    st.session_state.search_results[tab_key] = {
+        "signed_urls": list(signed_urls),
+        "has_more": has_more,
+        "pages": pages,
+    }
+
+
+def load_more_search_results(tab_key):
+    """
+    「さらに表示」が押された際に、次のページの検索結果を取得して追加する
+    :param tab_key: session_stateのキー
+    """
+    search_results = st.session_state.search_results[tab_key]
+    try:
+        signed_urls, has_more = next(search_results["pages"])
+    except StopIteration:
+        signed_urls, has_more = [], False
+    except Exception as e:
+        st.error(f"エラーが発生しました: {e}")
+        return
+    search_results["signed_urls"].extend(signed_urls)
+    search_results["has_more"] = has_more
+
+
+def format_search_results(signed_urls, start):
     """
-    検索結果を上位10件はそのまま表示し、残りは折りたたみで表示する。
+    検索結果を、番号付きリストのMarkdownに変換する
     :param signed_urls: 検索結果（辞書のリスト形式）
+    :param start: 最初の検索結果の番号
+    :return: Markdownの文字列
     """
-    if not signed_urls:
+    return "\n".join(
+        f"{i}. [{result['document_name']}]({result['signed_url']})"
+        for i, result in enumerate(signed_urls, start)
+    )
+
+
+def display_search_results(tab_key):
+    """
+    検索結果を上位10件はそのまま表示し、以降のページは「さらに表示」が押された時点で取得して折りたたみで表示する。
+    :param tab_key: session_stateのキー
+    """
+    search_results = st.session_state.search_results.get(tab_key)
+    if search_results is None:
+        return
+
+    signed_urls = search_results["signed_urls"]
+    if not signed_urls and not search_results["has_more"]:
         st.info("関連ドキュメントが見つかりませんでした。")
         return
 
-    # 検索結果が10件以下の場合
-    if len(signed_urls) <= 10:
-        st.write("#### 関連するドキュメント")
-        for i, result in enumerate(signed_urls, 1):
-            st.markdown(f"{i}. [{result['document_name']}]({result['signed_url']})")
-    else:
-        # 上位10件を表示
-        st.write("#### 関連するドキュメント（上位10件）")
-        for i, result in enumerate(signed_urls[:10], 1):
-            st.markdown(f"{i}. [{result['document_name']}]({result['signed_url']})")
+    # 1ページ目の検索結果を表示（検索結果のリストは、1つのMarkdownにまとめて表示する）
+    page_size = AppConfig.SEARCH_RESULTS_PAGE_SIZE
+    st.write(f"#### 関連するドキュメント（上位{page_size}件）")
+    st.markdown(format_search_results(signed_urls[:page_size], 1))
 
-    # 残りの結果を折りたたみ表示
-    if len(signed_urls) > 10:
+    # 追加で取得した検索結果を折りたたみ表示
+    if len(signed_urls) > page_size:
         with st.expander(
-            f"残りの関連ドキュメントを表示（※最大20件）（{len(signed_urls) - 10}件）"
+            f"残りの関連ドキュメントを表示（{len(signed_urls) - page_size}件）",
+            expanded=True,
         ):
-            for i, result in enumerate(signed_urls[10:], 11):
-                st.markdown(f"{i}. [{result['document_name']}]({result['signed_url']})")
+            st.markdown(format_search_results(signed_urls[page_size:], page_size + 1))
+
+    # 次のページが存在する場合のみ、追加取得のボタンを表示
+    if search_results["has_more"]:
+        st.button(
+            f"さらに表示（※最大{AppConfig.SEARCH_RESULTS_MAX_COUNT}件）",
+            key=f"{tab_key}_load_more",
+            on_click=load_more_search_results,
+            args=(tab_key,),
+        )
+
+
+# Kendraの検索結果のキャッシュ（全てのセッションで共有）
+@st.cache_resource
+def get_kendra_query_cache():
+    return KendraQueryCache(
+        max_entries=AppConfig.KENDRA_QUERY_CACHE_MAX_ENTRIES,
+        default_ttl_seconds=AppConfig.KENDRA_QUERY_CACHE_TTL_SECONDS,
+    )
+
+
+# サイドバーにKendraの検索結果のキャッシュの利用状況を表示
+def display_kendra_query_cache_status():
+    """
+    キャッシュのヒット率を表示し、Kendraのインデックス同期後などにキャッシュを破棄できるようにする
+    """
+    query_cache = get_kendra_query_cache()
+    stats = query_cache.stats()
+    st.sidebar.caption(
+        f"検索キャッシュ: {stats['entries']}件 / ヒット率 {stats['hit_rate']:.0%}"
+        f"（ヒット {stats['hits']}回, ミス {stats['misses']}回）"
+    )
+    if st.sidebar.button("検索キャッシュをクリア"):
+        query_cache.invalidate()
+        st.sidebar.success("検索キャッシュをクリアしました")
+
+
+# バックエンド（kendra_bedrock_query）は、画面の初期表示を待たせないよう初回利用時に読み込む（全セッションで共有）
+# （環境変数の読み込みとAWSクライアントの生成も、最初のクライアントの生成時まで遅延される）
+@st.cache_resource(show_spinner="初期化しています...")
+def get_backend():
+    return getBackend()
+
+
+# 一括検索（bulk_search）は、一括検索の画面を初めて開いた時点で読み込む（全セッションで共有）
+@st.cache_resource(show_spinner="初期化しています...")
+def get_bulk_search():
+    get_backend()
+    return importlib.import_module("bulk_search")
+
+
+# 一括検索の結果をsession stateに格納
+def set_bulk_search_results(outcomes):
+    """
+    一括検索の結果を出力用の行に変換し、ダウンロード用のCSV/Parquetファイルとあわせてsession stateに格納する
+    :param outcomes: iterBulkSearchの結果のリスト
+    """
+    bulk_search = get_bulk_search()
+    rows = bulk_search.buildBulkSearchRows(outcomes)
+    try:
+        parquet = bulk_search.buildBulkSearchParquet(rows)
+    except ImportError:
+        # pyarrowがインストールされていない場合は、CSVのみダウンロードできる
+        parquet = None
+    st.session_state.bulk_search_results = {
+        "rows": rows,
+        "csv": bulk_search.buildBulkSearchCsv(rows),
+        "parquet": parquet,
+        "error_count": sum(1 for outcome in outcomes if outcome["error"]),
+    }
+
+
+# 一括検索の結果を表示
+def display_bulk_search_results():
+    """
+    直近の一括検索の結果を表で表示し、CSV/Parquet形式でダウンロードできるようにする
+    """
+    results = st.session_state.bulk_search_results
+    if results is None:
+        return
+
+    st.write("#### 検索結果")
+    if results["error_count"]:
+        st.warning(
+            f"{results['error_count']}件の検索でエラーが発生しました（error列を確認してください）"
+        )
+    st.dataframe(
+        results["rows"],
+        column_config={
+            "query": "検索キーワード",
+            "category": "カテゴリ",
+            "rank": "順位",
+            "document_name": "ドキュメント",
+            "signed_url": st.column_config.LinkColumn("URL", display_text="開く"),
+            "error": "エラー",
+        },
+        hide_index=True,
+    )
+    columns = st.columns(2)
+    columns[0].download_button(
+        "CSVでダウンロード",
+        data=results["csv"],
+        file_name="bulk_search_results.csv",
+        mime="text/csv",
+    )
+    if results["parquet"] is not None:
+        columns[1].download_button(
+            "Parquetでダウンロード",
+            data=results["parquet"],
+            file_name="bulk_search_results.parquet",
+            mime="application/octet-stream",
+        )
+
+
+# 起動直後に、バックグラウンドでバックエンドの読み込みとAWSへの接続の確立を行う（プロセスで1度だけ）
+@st.cache_resource
+def start_backend_warm_up():
+    if not AppConfig.STARTUP_WARMUP_ENABLED:
+        return None
+    return startWarmUp()
+
+
+# Prometheus形式のメトリクスを公開するHTTPサーバー（プロセスで1つだけ起動する）
+@st.cache_resource
+def start_metrics_server():
+    if AppConfig.TELEMETRY_METRICS_PORT is None:
+        return None
+    return startMetricsServer(
+        AppConfig.TELEMETRY_METRICS_PORT,
+        lambda: getBackend().getMetricsText(get_kendra_query_cache()),
+    )
+
+
+# 計測結果（ステージごとの処理時間の分位数など）を表示
+def display_backend_metrics():
+    """
+    ステージごとの処理時間・エラー数・リトライ回数と、流量制御・ルーティング・キャッシュの状況を表示する
+    """
+    stats = get_backend().getBackendStats(get_kendra_query_cache())
+
+    st.subheader("ステージごとの処理時間")
+    if stats["stages"]:
+        st.dataframe(
+            [
+                {
+                    "ステージ": stage,
+                    "件数": stage_stats["count"],
+                    "エラー": stage_stats["errors"],
+                    "リトライ": stage_stats["retries"],
+                    "結果件数": stage_stats["results"],
+                    "p50 (ms)": stage_stats["p50_seconds"] * 1000,
+                    "p95 (ms)": stage_stats["p95_seconds"] * 1000,
+                    "p99 (ms)": stage_stats["p99_seconds"] * 1000,
+                }
+                for stage, stage_stats in stats["stages"].items()
+            ],
+            use_container_width=True,
+        )
+    else:
+        st.info("まだ計測結果がありません")
+
+    st.subheader("トークン使用量")
+    st.json(stats["usage"], expanded=False)
+    st.subheader("流量制御")
+    st.json(stats["scheduler"], expanded=False)
+    st.subheader("モデルのルーティング")
+    st.json(stats["router"], expanded=False)
+    st.subheader("リージョン")
+    st.json(stats["regions"], expanded=False)
+    st.subheader("キャッシュ")
+    st.json(stats["caches"], expanded=False)
+    st.subheader("起動時間")
+    startup_stats = startup_report.stats()
+    st.caption(
+        "、".join(
+            f"{phase}: {seconds * 1000:.0f}ms"
+            for phase, seconds in startup_stats["totals"].items()
+        )
+    )
+    st.dataframe(
+        [
+            {
+                "処理": entry["phase"],
+                "対象": entry["name"],
+                "処理時間 (ms)": entry["seconds"] * 1000,
+                "エラー": entry["error"],
+            }
+            for entry in startup_stats["entries"]
+        ],
+        use_container_width=True,
+    )
+
+    with st.expander("Prometheus形式"):
+        st.code(get_backend().getMetricsText(get_kendra_query_cache()), language="text")
+    if st.button("計測結果をリセット"):
+        stage_metrics.reset()
+        st.success("計測結果をリセットしました")
 
 
 # ファイル名のバリデーション
@@ -104,18 +441,31 @@ def is_valid_filename(filename):
     return bool(re.match(r"^[a-zA-Z0-9\s\-\.\(\)\[\]]+$", filename))
 
 
-# ファイルのサイズチェック（Claudeが受け付ける4.5MBを超えているかどうか）
+# ファイルのサイズの上限（ファイル形式ごとの上限は、getMaxUploadBytesを参照）
+def get_max_file_size(uploaded_file):
+    return get_backend().getMaxUploadBytes(
+        AppConfig.SUPPORTED_FORMATS.get(uploaded_file.type)
+    )
+
+
+# ファイルのサイズチェック
 def is_file_size_valid(uploaded_file):
-    return uploaded_file.size <= 4.5 * 1024 * 1024  # 4.5MB
+    return uploaded_file.size <= get_max_file_size(uploaded_file)
 
 
 # アプリの初期表示
 st.title("Kendra-Bedrock-RAG検証")
+start_backend_warm_up()
 initialize_session()
+start_metrics_server()
 
 
 # 表示内容切り替えのためのプルダウン設定
-tab_titles = AppConfig.WORDS_USED_IN_EACH_TAB_DICT
+tab_titles = {
+    tab_key: title
+    for tab_key, title in AppConfig.WORDS_USED_IN_EACH_TAB_DICT.items()
+    if tab_key != "metrics" or AppConfig.TELEMETRY_ADMIN_TAB_ENABLED
+}
 selected_tab = st.selectbox(
     "プルダウンで機能を選択",
     options=list(tab_titles.keys()),
@@ -167,6 +517,7 @@ if selected_tab == "rag_search":
     # サイドバーにKendra検索タブの使い方を追加
     st.sidebar.markdown("### RAG検索の使い方")
     st.sidebar.markdown(AppConfig.HOW_TO_USE_RAG_SEARCH)
+    display_kendra_query_cache_status()
 
     # 会話履歴の表示
     display_tab_messages(
@@ -189,30 +540,50 @@ if selected_tab == "rag_search":
             st.markdown(user_input)
 
         try:
-            # RAG検索を実行
+            # RAG検索を実行（回答はストリーミングで受け取り、署名付きURLは回答の生成と並行して生成される）
             with st.spinner("RAG検索実行中..."):
-                kendra_response, signed_urls = ragSearch(
+                rag_result = get_backend().ragSearchPipeline(
                     user_input,
                     history,
                     selected_model_id,
                     selected_temperature,
                     selected_category_key,
+                    stream=True,
+                    query_cache=get_kendra_query_cache(),
+                    history_manager=st.session_state.history_managers["rag_search"],
                 )
 
-            # LLMからのレスポンスをsession stateに格納
-            response_msg = {"role": "assistant", "content": [{"text": kendra_response}]}
-            st.session_state.tab_messages["rag_search"].append(response_msg)
-
-            # LLM からのレスポンスを表示
+            # LLM からのレスポンスを生成され次第、逐次表示
             with st.chat_message("assistant"):
-                st.markdown(kendra_response)
+                kendra_response = st.write_stream(rag_result.stream)
+                display_answered_model(rag_result.model_id)
 
-            # 関連ドキュメントを表示
-            display_search_results(signed_urls)
+            # LLMからのレスポンスとトークン使用量をsession stateに格納
+            response_msg = {"role": "assistant", "content": [{"text": kendra_response}]}
+            st.session_state.tab_messages["rag_search"].append(response_msg)
+            st.session_state.last_usage["rag_search"] = rag_result.stream.usage
+
+            # 関連ドキュメントをsession stateに格納（2ページ目以降は「さらに表示」で取得）
+            set_search_results(
+                "rag_search",
+                rag_result.signed_urls,
+                has_more=rag_result.has_more,
+                pages=get_backend().iterSearchResultPages(
+                    user_input,
+                    selected_category_key,
+                    query_cache=get_kendra_query_cache(),
+                    start_page=2,
+                ),
+            )
+            st.session_state.last_timings["rag_search"] = rag_result.timings
 
         except Exception as e:
+            st.session_state.search_results.pop("rag_search", None)
             st.error(f"エラーが発生しました: {e}")
 
+    # 関連ドキュメントを表示
+    display_search_results("rag_search")
+
 
 # Kendra検索タブ
 elif selected_tab == "kendra_search":
@@ -243,6 +614,7 @@ elif selected_tab == "kendra_search":
     # サイドバーにKendra検索タブの使い方を追加
     st.sidebar.markdown("### Kendra検索の使い方")
     st.sidebar.markdown(AppConfig.HOW_TO_USE_KENDRA_SEARCH)
+    display_kendra_query_cache_status()
 
     # ユーザーの入力
     user_input = st.chat_input("質問を入力してください")
@@ -254,12 +626,15 @@ elif selected_tab == "kendra_search":
             st.markdown(user_input)
 
         try:
-            # Kendra検索実行
+            # Kendra検索実行（1ページ目のみ取得し、以降のページは「さらに表示」で取得）
+            pages = get_backend().iterSearchResultPages(
+                user_input,
+                selected_category_key,
+                query_cache=get_kendra_query_cache(),
+            )
             with st.spinner("検索中..."):
-                signed_urls = kendraSearch(user_input, selected_category_key)
-
-            # 検索結果を表示
-            display_search_results(signed_urls)
+                signed_urls, has_more = next(pages)
+            set_search_results("kendra_search", signed_urls, has_more, pages)
 
             # 検索結果をsession stateに格納
             response_content = "以下の関連ドキュメントが見つかりました"
@@ -269,8 +644,12 @@ elif selected_tab == "kendra_search":
             }
             st.session_state.tab_messages["kendra_search"].append(response_msg)
         except Exception as e:
+            st.session_state.search_results.pop("kendra_search", None)
             st.error(f"エラーが発生しました: {e}")
 
+    # 検索結果を表示
+    display_search_results("kendra_search")
+
 
 # マルチモーダルタブ
 elif selected_tab == "multi_modal":
@@ -309,7 +688,10 @@ elif selected_tab == "multi_modal":
                 "ファイル名にはアルファベット、数字、空白（1文字のみ）、ハイフン、括弧のみを使用してください。"
             )
         elif not is_file_size_valid(uploaded_file):
-            st.error("アップロードできるファイルサイズは最大4.5MBまでです。")
+            max_file_size_mb = get_max_file_size(uploaded_file) / (1024 * 1024)
+            st.error(
+                f"アップロードできるファイルサイズは最大{max_file_size_mb:g}MBまでです。"
+            )
         else:
             file_type = uploaded_file.type
             file_format = supported_formats_dict.get(file_type)
@@ -335,13 +717,30 @@ elif selected_tab == "multi_modal":
                     st.markdown(question)
 
                 try:
+                    # 大きなPDFを分割して要約する場合の進捗表示
+                    progress_placeholder = st.empty()
+
+                    def show_progress(completed, total):
+                        progress_placeholder.progress(
+                            completed / total,
+                            text=f"文書を分割して要約中...（{completed}/{total}）",
+                        )
+
                     # Bedrockモデルの呼び出し
                     with st.spinner("回答生成中..."):
-                        response_content = invokeLLMWithFile(
+                        (
+                            response_content,
+                            answered_model_id,
+                        ) = get_backend().invokeLLMWithFile(
                             question,
                             uploaded_file,
                             st.session_state.tab_messages["multi_modal"],
+                            history_manager=st.session_state.history_managers[
+                                "multi_modal"
+                            ],
+                            on_progress=show_progress,
                         )
+                    progress_placeholder.empty()
                     response_msg = {
                         "role": "assistant",
                         "content": [{"text": response_content}],
@@ -353,6 +752,7 @@ elif selected_tab == "multi_modal":
                     # LLMからのレスポンスを表示
                     with st.chat_message("assistant"):
                         st.markdown(response_content)
+                        display_answered_model(answered_model_id)
                 except Exception as e:
                     st.error(f"ファイル処理中にエラーが発生しました: {e}")
     elif uploaded_file and not question:
@@ -368,24 +768,96 @@ elif selected_tab == "multi_modal":
             st.markdown(question)
 
         try:
-            # Bedrockモデルの呼び出し
+            # Bedrockモデルの呼び出し（回答はストリーミングで受け取る）
             with st.spinner("回答生成中..."):
-                response_content = invokeLLMWithoutFile(
-                    st.session_state.tab_messages["multi_modal"]
+                answer_stream = get_backend().invokeLLMWithoutFile(
+                    st.session_state.tab_messages["multi_modal"],
+                    stream=True,
+                    history_manager=st.session_state.history_managers["multi_modal"],
                 )
+
+            # LLMからのレスポンスを生成され次第、逐次表示
+            with st.chat_message("assistant"):
+                response_content = st.write_stream(answer_stream)
+                display_answered_model(answer_stream.model_id)
+
             response_msg = {
                 "role": "assistant",
                 "content": [{"text": response_content}],
             }
 
-            # LLMからのレスポンスをセッションに保存
+            # LLMからのレスポンスとトークン使用量をセッションに保存
             st.session_state.tab_messages["multi_modal"].append(response_msg)
-
-            # LLMからのレスポンスを表示
-            with st.chat_message("assistant"):
-                st.markdown(response_content)
+            st.session_state.last_usage["multi_modal"] = answer_stream.usage
         except Exception as e:
             st.error(f"エラーが発生しました: {e}")
     else:
         # 両方が未入力の場合
         st.info("ファイルをアップロードし、質問を入力してください。")
+
+# 一括検索タブ
+elif selected_tab == "bulk_search":
+    st.header(tab_titles["bulk_search"])
+    bulk_search = get_bulk_search()
+
+    # 検索対象のドキュメントを選択させる（複数選択した場合は、カテゴリごとに検索する）
+    category_dict = AppConfig.CATEGORY_LABELS
+    selected_category_values = st.multiselect(
+        "検索したい資料のカテゴリを選択してください（複数選択可）:",
+        options=list(category_dict.values()),
+        default=[category_dict["all"]],
+    )
+    selected_category_keys = [
+        category_key
+        for category_key, category_value in category_dict.items()
+        if category_value in selected_category_values
+    ]
+
+    # サイドバーに一括検索タブの使い方を追加
+    st.sidebar.markdown("### 一括検索の使い方")
+    st.sidebar.markdown(AppConfig.HOW_TO_USE_BULK_SEARCH)
+    display_kendra_query_cache_status()
+
+    # 検索キーワードの入力（CSVファイル、または1行に1件の貼り付け）
+    uploaded_csv = st.file_uploader(
+        '検索キーワードのCSVファイル（"query"列、または1列目）', type=["csv"]
+    )
+    pasted_queries = st.text_area("検索キーワード（1行に1件）")
+    queries = bulk_search.dedupeQueries(
+        (bulk_search.parseQueryCsv(uploaded_csv.getvalue()) if uploaded_csv else [])
+        + bulk_search.parseQueryText(pasted_queries)
+    )
+    if len(queries) > AppConfig.BULK_SEARCH_MAX_QUERIES:
+        st.warning(
+            f"検索キーワードが多すぎます。先頭の{AppConfig.BULK_SEARCH_MAX_QUERIES}件のみ検索します（{len(queries)}件）"
+        )
+        queries = queries[: AppConfig.BULK_SEARCH_MAX_QUERIES]
+    total = len(queries) * len(selected_category_keys)
+    st.caption(
+        f"検索キーワード {len(queries)}件（重複を除く）× カテゴリ {len(selected_category_keys)}件 = {total}回の検索"
+    )
+
+    if st.button("一括検索を実行", disabled=total == 0):
+        progress_placeholder = st.empty()
+        outcomes = []
+        try:
+            for outcome in bulk_search.iterBulkSearch(
+                queries, selected_category_keys, query_cache=get_kendra_query_cache()
+            ):
+                outcomes.append(outcome)
+                progress_placeholder.progress(
+                    len(outcomes) / total,
+                    text=f"検索中...（{len(outcomes)}/{total}）",
+                )
+            set_bulk_search_results(outcomes)
+        except Exception as e:
+            st.error(f"エラーが発生しました: {e}")
+        progress_placeholder.empty()
+
+    # 検索結果を表示
+    display_bulk_search_results()
+
+# 計測結果タブ
+elif selected_tab == "metrics":
+    st.header(tab_titles["metrics"])
+    display_backend_metrics()
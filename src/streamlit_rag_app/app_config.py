@@ -1,3 +1,7 @@
+import os
+import tempfile
+
+
 class AppConfig:
     # リージョン名
     REGION_NAME_DICT = {
@@ -5,11 +9,12 @@ class AppConfig:
         "verginia": "us-east-1",
         "tokyo": "ap-northeast-1",
     }
-    # Amazon BedrockのモデルID（Claude3.5 Sonnet, Claude3 Sonnet, Claude3 Haiku）
+    # Amazon BedrockのモデルID（Claude3.5 Sonnet, Claude3 Sonnet, Claude3 Haiku, Claude3.5 Haiku）
     MODEL_ID_DICT = {
         "claude_3_5_sonnet": "anthropic.claude-3-5-sonnet-20240620-v1:0",
         "claude_3_sonnet": "anthropic.claude-3-sonnet-20240229-v1:0",
         "claude_3_haiku": "anthropic.claude-3-haiku-20240307-v1:0",
+        "claude_3_5_haiku": "anthropic.claude-3-5-haiku-20241022-v1:0",
     }
 
     # Claudeモデルの、推論時の各種パラメータ（追加したいパラメータを下記に追記していく）
@@ -26,6 +31,8 @@ class AppConfig:
         "rag_search": "RAG検索",
         "kendra_search": "Kendra検索",
         "multi_modal": "マルチモーダル",
+        "bulk_search": "一括検索",
+        "metrics": "計測結果",
     }
     # リトライ設定
     # botocoreのリトライ設定の作成(Throttlingエラー回避策)
@@ -33,6 +40,279 @@ class AppConfig:
         "max_attempts": 10,  # 最大10回のリトライ
         "mode": "adaptive",  # リトライモード
     }
+    # AWSクライアントごとのHTTPコネクションプールの上限数
+    # （全セッションで同じクライアントを共有するため、同時利用ユーザー数に合わせて設定する）
+    MAX_POOL_CONNECTIONS = 50
+
+    # 署名付きURL生成（S3への存在確認・署名）を並列に行うスレッド数の上限
+    PRESIGN_MAX_WORKERS = 32
+    # 署名付きURL生成ステージ全体のタイムアウト（秒）。超過した検索結果は表示対象から除外する
+    PRESIGN_STAGE_TIMEOUT_SECONDS = 5
+    # RAG検索で、LLMの回答生成と並行して署名付きURLの生成を行うスレッド数の上限
+    PIPELINE_MAX_WORKERS = 16
+    # 署名付きURLの有効期間（秒）
+    PRESIGNED_URL_EXPIRES_IN_SECONDS = 3600
+    # キャッシュした署名付きURLを使い回す際に必要な、有効期限までの残り時間（秒）
+    # （これを下回ったURLは署名し直す）
+    PRESIGNED_URL_MIN_REMAINING_SECONDS = 900
+    # 署名付きURLのキャッシュに保持するURL数の上限
+    PRESIGNED_URL_CACHE_MAX_ENTRIES = 5000
+
+    # 文字起こし（transcription/配下の.txt）に対応するPDFファイルのプレフィックス
+    PDF_KEY_PREFIX = "hogehoge/"
+    # PDFファイルの存在確認を、head_objectの代わりにlist_objects_v2で構築したインデックスで行うかどうか
+    PDF_KEY_INDEX_ENABLED = True
+    # PDFファイルのインデックスを定期的に再構築する間隔（秒）
+    PDF_KEY_INDEX_REFRESH_INTERVAL_SECONDS = 600
+    # 存在しないPDFファイルを参照した際の再構築を含め、再構築を行う最短の間隔（秒）
+    PDF_KEY_INDEX_MIN_REFRESH_INTERVAL_SECONDS = 60
+
+    # Kendraの検索結果のキャッシュの有効期間（秒）
+    KENDRA_QUERY_CACHE_TTL_SECONDS = 600
+    # Kendraの検索結果のキャッシュに保持する件数の上限
+    KENDRA_QUERY_CACHE_MAX_ENTRIES = 1000
+
+    # 検索結果を1度に取得・表示する件数（以降のページは「さらに表示」を押した時点で取得する）
+    SEARCH_RESULTS_PAGE_SIZE = 10
+    # 取得する検索結果の件数の上限
+    SEARCH_RESULTS_MAX_COUNT = 30
+
+    # 会話履歴の表示で、常に表示する直近の会話の数（1往復を1件とする。それより前の会話は「さらに前の会話を表示」で表示する）
+    CHAT_HISTORY_WINDOW_TURNS = 10
+    # 「さらに前の会話を表示」で、1度にさかのぼる会話の数（1往復を1件とする）
+    CHAT_HISTORY_PAGE_TURNS = 20
+
+    # RAG検索でLLMに渡すコンテキストの取得元
+    # "query": query APIの検索結果の抜粋を使用（追加のAPI呼び出しなし）
+    # "retrieve": retrieve APIで取得した、より長いパッセージを使用
+    RAG_CONTEXT_SOURCE = "query"
+    # retrieve APIで取得するパッセージの件数
+    RAG_RETRIEVE_PAGE_SIZE = 20
+    # RAG検索のコンテキストに使用できるトークン数の上限（モデルごと）
+    RAG_CONTEXT_TOKEN_BUDGET_DICT = {
+        "claude_3_5_sonnet": 8000,
+        "claude_3_sonnet": 6000,
+        "claude_3_haiku": 4000,
+        "claude_3_5_haiku": 6000,
+    }
+    # MODEL_ID_DICTにないモデルの場合のトークン数の上限
+    RAG_CONTEXT_DEFAULT_TOKEN_BUDGET = 4000
+    # パッセージを重複とみなす重複度（0〜1。短い方のパッセージの文字3-gramのうち、長い方に含まれる割合）
+    RAG_CONTEXT_DEDUPE_THRESHOLD = 0.8
+
+    # ConverseAPIに渡す会話履歴のトークン数の上限（モデルごと）。超えた分は古い会話から送信対象外とする
+    HISTORY_TOKEN_BUDGET_DICT = {
+        "claude_3_5_sonnet": 16000,
+        "claude_3_sonnet": 12000,
+        "claude_3_haiku": 8000,
+        "claude_3_5_haiku": 12000,
+    }
+    # MODEL_ID_DICTにないモデルの場合の会話履歴のトークン数の上限
+    HISTORY_DEFAULT_TOKEN_BUDGET = 8000
+    # 送信対象外となった古い会話を、バックグラウンドで要約してシステムプロンプトに含めるかどうか
+    HISTORY_SUMMARIZE_ENABLED = True
+    # 古い会話の要約に使用するモデル（MODEL_ID_DICTのキー）
+    HISTORY_SUMMARY_MODEL_KEY = "claude_3_haiku"
+    # 古い会話の要約の最大トークン数
+    HISTORY_SUMMARY_MAX_TOKENS = 1000
+
+    # プロンプトキャッシュに対応しているモデルのID
+    # NOTE MODEL_ID_DICTのモデルのうち、ここに含まれるモデル（現在はClaude3.5 Haikuのみ）のみキャッシュのチェックポイントを置く
+    #      （Claude3.5 Sonnet(v1), Claude3 Sonnet, Claude3 Haikuはプロンプトキャッシュに対応していないため、チェックポイントを置かずに送信する）
+    #      通常のチャット（Claude3.5 Sonnet、"auto"の場合はClaude3 Haiku）とマルチモーダル（Claude3 Haiku）は対応していないモデルを使用するため、
+    #      既定の設定でキャッシュが使われるのは、RAG検索でClaude3.5 Haikuを選択した場合のみ
+    #      （Claude3.5 HaikuはBedrockで画像の入力に対応していないため、マルチモーダルには使用できない）
+    PROMPT_CACHE_SUPPORTED_MODEL_IDS = [
+        "anthropic.claude-3-5-haiku-20241022-v1:0",
+        "anthropic.claude-3-7-sonnet-20250219-v1:0",
+    ]
+    # キャッシュできる最小のトークン数（これに満たない場合はチェックポイントを置かない）
+    PROMPT_CACHE_MIN_TOKENS = 1024
+
+    # マルチモーダルでアップロードされたファイルの保存先（大きなファイルはディスク上に保存する。プロセスごとのサブディレクトリに保存し、終了時に削除する）
+    ATTACHMENT_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), "streamlit_rag_app_attachments"
+    )
+    # このサイズ以下のファイルはメモリ上に保存する（バイト）
+    ATTACHMENT_MEMORY_THRESHOLD_BYTES = 256 * 1024
+    # メモリ上に保存するファイルの合計サイズの上限（バイト）
+    ATTACHMENT_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+    # ディスク上に保存するファイルの合計サイズの上限（バイト。プロセスごと）
+    ATTACHMENT_MAX_DISK_BYTES = 2 * 1024 * 1024 * 1024
+    # 以前の質問でアップロードされたファイルも、ConverseAPIに再送信するかどうか
+    # （Falseの場合、以前のファイルはファイル名のみを送信する）
+    ATTACHMENT_RESEND_PREVIOUS = False
+
+    # アップロードされた画像を、送信前に縮小・再エンコードするかどうか
+    IMAGE_PREPROCESS_ENABLED = True
+    # 画像の長辺の最大ピクセル数（Claudeはこれを超える画像を内部で縮小するため、送信前に縮小する）
+    IMAGE_MAX_LONG_EDGE_PIXELS = 1568
+    # 画像の総画素数の上限
+    IMAGE_MAX_PIXELS = 1_150_000
+    # 透過情報を持たない画像の再エンコード後の形式（"jpeg"または"png"）
+    IMAGE_OUTPUT_FORMAT = "jpeg"
+    # JPEGで再エンコードする際の画質
+    IMAGE_JPEG_QUALITY = 85
+    # 前処理済みの画像のキャッシュに保持する件数の上限
+    IMAGE_PREPROCESS_CACHE_MAX_ENTRIES = 100
+    # アップロードできる画像のサイズの上限（バイト。縮小・再エンコードを行う場合に適用）
+    IMAGE_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+    # アップロードされたPDFをローカルで解析し、テキストとして送信するかどうか
+    PDF_EXTRACT_ENABLED = True
+    # テキストの文字数がこれ未満で、画像を含むページをスキャンされたページとみなす
+    PDF_SCANNED_PAGE_MIN_CHARS = 20
+    # スキャンされたページを画像として書き出す際の解像度（dpi）
+    PDF_SCANNED_PAGE_DPI = 150
+    # スキャンされたページを画像として添付する上限（ConverseAPIは1リクエストあたり20枚まで）
+    PDF_SCANNED_PAGE_MAX_IMAGES = 20
+    # PDFから抽出したテキストのトークン数の上限（超えた以降のページは省略する）
+    PDF_EXTRACT_MAX_TOKENS = 150000
+    # このページ数以上のPDFは、プロセスプールで並列にテキストを抽出する
+    PDF_EXTRACT_PARALLEL_MIN_PAGES = 50
+    # プロセスプールの1タスクあたりのページ数
+    PDF_EXTRACT_PAGES_PER_TASK = 25
+    # プロセスプールのプロセス数
+    PDF_EXTRACT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+    # 抽出済みのPDFのキャッシュに保持する件数の上限
+    PDF_EXTRACT_CACHE_MAX_ENTRIES = 20
+    # ConverseAPIにPDFをそのまま（documentとして）送信できるサイズの上限（バイト）
+    PDF_DOCUMENT_MAX_BYTES = 4.5 * 1024 * 1024
+    # アップロードできるPDFのサイズの上限（バイト。テキストを抽出する場合に適用）
+    PDF_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+    # 入力の上限を超える大きな文書を、分割して要約（map-reduce）するかどうか
+    MAP_REDUCE_ENABLED = True
+    # 文書から抽出したテキストのトークン数がこれを超える場合に、分割して要約する
+    MAP_REDUCE_THRESHOLD_TOKENS = 60000
+    # 分割したチャンクあたりのトークン数の上限
+    MAP_REDUCE_CHUNK_TOKENS = 20000
+    # チャンクの要約を同時に行う数の上限（全セッションで共有）
+    MAP_REDUCE_MAX_CONCURRENCY = 8
+    # チャンクの要約の最大トークン数
+    MAP_REDUCE_SUMMARY_MAX_TOKENS = 1000
+    # 分割要約に使用するモデル（MODEL_ID_DICTのキー）
+    MAP_REDUCE_MODEL_KEY = "claude_3_haiku"
+    # 分割要約の回答のキャッシュの有効期間（秒）と保持する件数の上限
+    MAP_REDUCE_CACHE_TTL_SECONDS = 3600
+    MAP_REDUCE_CACHE_MAX_ENTRIES = 100
+
+    # Bedrockへのリクエストの流量制御（プロセス全体で共有）
+    # モデル（MODEL_ID_DICTのキー）ごとの、リージョンあたりの1分間のリクエスト数・トークン数の上限（アカウントのクォータに合わせて設定する）
+    BEDROCK_RATE_LIMITS_DICT = {
+        "claude_3_5_sonnet": {"requests_per_minute": 50, "tokens_per_minute": 400000},
+        "claude_3_sonnet": {"requests_per_minute": 500, "tokens_per_minute": 1000000},
+        "claude_3_haiku": {"requests_per_minute": 1000, "tokens_per_minute": 2000000},
+        "claude_3_5_haiku": {"requests_per_minute": 250, "tokens_per_minute": 2000000},
+    }
+    # BEDROCK_RATE_LIMITS_DICTにないモデルの上限
+    BEDROCK_DEFAULT_RATE_LIMITS = {"requests_per_minute": 50, "tokens_per_minute": 200000}
+    # (モデル, リージョン)ごとの待ち行列の長さの上限
+    BEDROCK_QUEUE_MAX_SIZE = 100
+    # 優先度ごとの待ち時間の上限（秒。超える見込みの場合は待たずにエラーとする）
+    BEDROCK_QUEUE_TIMEOUT_SECONDS_DICT = {"interactive": 30, "bulk": 120}
+
+    # モデルのルーティング
+    # 呼び出し元ごとのポリシー（"fixed": 常に指定したモデル、"fallback": 飽和時に代替モデルへ切り替え、
+    # "auto": fallbackに加え、短い質問をMODEL_ROUTING_SHORT_PROMPT_MODEL_KEYのモデルに振り分ける）
+    MODEL_ROUTING_POLICY_DICT = {
+        "rag_search": "fallback",
+        "multi_modal": "fallback",
+        "chat": "auto",
+    }
+    # モデル（MODEL_ID_DICTのキー）ごとの代替モデル（試す順）
+    MODEL_FALLBACK_DICT = {
+        "claude_3_5_sonnet": ["claude_3_sonnet", "claude_3_haiku"],
+        "claude_3_sonnet": ["claude_3_haiku"],
+        "claude_3_haiku": [],
+        "claude_3_5_haiku": ["claude_3_haiku"],
+    }
+    # 短い質問を振り分けるモデル（MODEL_ID_DICTのキー）
+    MODEL_ROUTING_SHORT_PROMPT_MODEL_KEY = "claude_3_haiku"
+    # 短い質問とみなす、最後の質問のトークン数の上限
+    MODEL_ROUTING_SHORT_PROMPT_TOKENS = 100
+    # 短い質問とみなす、会話履歴全体のトークン数の上限
+    MODEL_ROUTING_SIMPLE_MAX_INPUT_TOKENS = 2000
+    # レイテンシとスロットリングの発生率を集計する期間（秒）
+    MODEL_ROUTING_WINDOW_SECONDS = 300
+    # 飽和の判定に必要な、期間内の最小の呼び出し回数
+    MODEL_ROUTING_MIN_SAMPLES = 5
+    # 飽和とみなすスロットリングの発生率（0〜1）
+    MODEL_ROUTING_THROTTLE_RATE_THRESHOLD = 0.3
+    # 飽和とみなす平均レイテンシ（秒。最初の応答までの時間）
+    MODEL_ROUTING_LATENCY_THRESHOLD_SECONDS_DICT = {
+        "claude_3_5_sonnet": 20,
+        "claude_3_sonnet": 20,
+        "claude_3_haiku": 10,
+        "claude_3_5_haiku": 10,
+    }
+    # 飽和とみなす、流量制御の待ち行列の長さ
+    MODEL_ROUTING_QUEUE_DEPTH_THRESHOLD = 10
+    # 代替モデルがある場合の、Bedrockクライアントの最大試行回数（早めに代替モデルへ切り替えるため）
+    MODEL_ROUTING_MAX_ATTEMPTS = 2
+    # 次の候補（リージョン・モデル）がある場合の、流量制御の待ち時間の上限（秒。超える見込みの場合は飽和しているとみなし、次の候補を試す）
+    MODEL_ROUTING_ADMISSION_WAIT_SECONDS = 0.3
+
+    # Bedrockのリクエストを送信するリージョン（REGION_NAME_DICTのキー。未計測の場合・レイテンシが同じ場合は先頭を優先する）
+    # NOTE リージョンを追加する場合は、MODEL_ID_DICTのモデルへのアクセスを追加するリージョンで有効にするか、
+    #      BEDROCK_MODEL_REGION_KEYS_DICTでモデルごとに利用できるリージョンを指定してください
+    BEDROCK_REGION_KEYS = ["oregon"]
+    # モデル（MODEL_ID_DICTのキー）ごとの、利用できるリージョン（REGION_NAME_DICTのキー。未指定の場合はBEDROCK_REGION_KEYSの全てのリージョン）
+    BEDROCK_MODEL_REGION_KEYS_DICT = {}
+    # リージョンのレイテンシの指数移動平均の係数（0〜1。大きいほど直近の値を重視する）
+    BEDROCK_REGION_LATENCY_ALPHA = 0.3
+    # スロットリング・接続エラーが発生したリージョンの優先度を下げる時間（秒。連続して発生するほど倍に延ばす）
+    BEDROCK_REGION_COOLDOWN_SECONDS = 10
+    BEDROCK_REGION_MAX_COOLDOWN_SECONDS = 300
+    # レイテンシの推定値を更新するため、最速以外のリージョンを先に試す確率（0〜1）
+    BEDROCK_REGION_EXPLORE_RATE = 0.05
+
+    # 計測（ステージごとのレイテンシ・検索結果の件数・リトライ回数・トークン使用量）
+    # 計測結果（スパン）を、リクエストID付きのJSON形式のログとして標準エラー出力に出力するかどうか
+    # （検索1回あたり、署名付きURLの生成など10行以上のログが出力されるため、調査時のみ有効にする。
+    # 無効の場合も、ステージごとの集計（計測結果タブ、/metrics）は行う）
+    TELEMETRY_SPAN_LOG_ENABLED = False
+    # ステージごとの処理時間のヒストグラムの区切り（秒）
+    TELEMETRY_HISTOGRAM_BUCKETS_SECONDS = [
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    ]
+    # Prometheus形式のメトリクス（/metrics）を公開するHTTPサーバーのポート（Noneの場合は起動しない）
+    TELEMETRY_METRICS_PORT = None
+    # 計測結果を表示する管理画面（プルダウンの「計測結果」）を表示するかどうか
+    TELEMETRY_ADMIN_TAB_ENABLED = True
+
+    # ヘッドレスのHTTP API（api_server.py。Streamlitとは別のプロセスで起動する）
+    # バックエンドの処理（Kendra・S3・Bedrockの呼び出し）を実行するスレッド数の上限（ワーカープロセスごと）
+    API_WORKER_THREADS = 64
+    # 同時に処理するリクエスト数の上限（ワーカープロセスごと。超えた場合は503を返す）
+    API_MAX_CONCURRENT_REQUESTS = 256
+    # 送信できる会話履歴の件数の上限
+    API_MAX_HISTORY_MESSAGES = 100
+    # リクエストボディのサイズの上限（バイト。超えた場合は413を返す。アップロードできるファイルの上限に、会話履歴などのフォームの項目の分を加える）
+    API_MAX_REQUEST_BODY_BYTES = (
+        max(IMAGE_MAX_UPLOAD_BYTES, PDF_MAX_UPLOAD_BYTES) + 1024 * 1024
+    )
+    # バックエンドの処理を非同期版（kendra_bedrock_query_async。aiobotocoreが必要）で実行するかどうか
+    # （Trueの場合は、リクエストごとにスレッドを占有せず、クライアントの切断時にAWSへのリクエストも中止する）
+    API_ASYNC_BACKEND_ENABLED = False
+    # 非同期版で、クライアントの切断を確認する間隔（秒）
+    API_DISCONNECT_POLL_SECONDS = 0.5
+
+    # 起動時間の短縮（startup.py）
+    # 起動直後に、バックグラウンドでバックエンドの読み込み・AWSクライアントの生成・接続の確立（ウォームアップ）を行うかどうか
+    STARTUP_WARMUP_ENABLED = True
+    # ウォームアップで接続を確立するサービス（"kendra", "s3", "bedrock-runtime"。Bedrockは利用する全てのリージョン）
+    STARTUP_WARMUP_SERVICES = ["kendra", "s3", "bedrock-runtime"]
+
+    # Kendraの一括検索（bulk_search.py）
+    # 一括検索でのKendraへの1秒あたりのリクエスト数の上限（全セッションの合計。Kendraのクエリ容量に合わせて設定する）
+    BULK_SEARCH_KENDRA_QPS = 2
+    # 一括検索を並列に実行するスレッド数の上限（全セッションで共有）
+    BULK_SEARCH_MAX_WORKERS = 8
+    # 検索キーワード・カテゴリごとに取得する検索結果の件数（Kendraの上限は100件）
+    BULK_SEARCH_RESULTS_PER_QUERY = 10
+    # 1回の一括検索で検索できる検索キーワードの件数の上限（重複を除いた件数）
+    BULK_SEARCH_MAX_QUERIES = 500
 
     # システムプロンプト
     SYSTEM_PROMPT = [
@@ -107,6 +387,22 @@ class AppConfig:
 
 
    ※検索結果がない場合は、検索キーワードや検索対象のカテゴリの設定を見直して再度検索をお試しください。
+   """
+
+    # 一括検索
+    HOW_TO_USE_BULK_SEARCH = """
+   ここでは、Amazon Kendraを使用して、複数の検索キーワードの検索をまとめて行うことができます。
+
+
+   1. :red[**検索したい資料のカテゴリを選択**]  
+   検索対象のドキュメントの種類を選択してください。複数のカテゴリを選択した場合は、カテゴリごとに検索します。 
+   2. :red[**検索キーワードの入力**]  
+   CSVファイル（"query"列、または1列目）をアップロードするか、検索キーワードを1行に1件ずつ貼り付けてください。重複した検索キーワードは1件にまとめられます。 
+   3. :red[**一括検索の実行**]  
+   「一括検索を実行」を押すと、検索の進捗が表示されます。完了後、検索結果をCSVまたはParquet形式でダウンロードできます。 
+
+
+   ※ダウンロードした検索結果のURLには有効期限（最短で15分程度）があります。期限が切れた場合は、再度検索してください。
    """
 
     # マルチモーダル
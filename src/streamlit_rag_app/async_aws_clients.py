@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import os
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import AioSession
+from app_config import AppConfig
+from aws_clients import _freeze, loadEnvironment
+
+"""
+非同期のAWSクライアント（aiobotocore）の共有プール
+aiobotocoreのクライアントは生成したイベントループのHTTPセッションに紐づくため、
+イベントループごとに(サービス名, リージョン, 設定)ごとに1つだけ生成し、ループ内の全てのリクエストで使い回す
+（ASGIサーバーのワーカープロセスでは、通常イベントループは1つのため、プロセス全体で共有される）
+"""
+
+# プロセス全体で共有するaiobotocoreセッション（初回利用時に生成）
+_session = None
+# イベントループごとのクライアントのプール {イベントループ: {"stack", "clients", "lock"}}
+_pools = {}
+
+
+def _getPool():
+    """
+    実行中のイベントループのクライアントのプールを取得する（存在しない場合は生成する）
+    :return: {"stack": クライアントを閉じるためのAsyncExitStack, "clients": 生成済みのクライアント, "lock": 生成時の排他制御用ロック}
+    """
+    global _session
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        if _session is None:
+            loadEnvironment()
+            _session = AioSession(profile=os.getenv("profile_name"))
+        pool = {
+            "stack": contextlib.AsyncExitStack(),
+            "clients": {},
+            "lock": asyncio.Lock(),
+        }
+        _pools[loop] = pool
+    return pool
+
+
+async def getAsyncClient(service_name, region_name=None, verify=None, **config_kwargs):
+    """
+    共有プールから非同期のAWSクライアントを取得する（存在しない場合のみ生成する）
+    :param service_name: サービス名（"kendra", "s3", "bedrock-runtime"など）
+    :param region_name: リージョン名（省略時はオレゴン）
+    :param verify: SSL証明書の検証設定
+    :param config_kwargs: aiobotocoreのAioConfigに渡す設定（retries, signature_versionなど）
+    :return: 非同期のAWSクライアント
+    """
+    region_name = region_name or AppConfig.REGION_NAME_DICT["oregon"]
+    # 同時接続数の上限（同期のクライアントと同じく、同時に処理するリクエストでコネクションを使い回す）
+    config_kwargs.setdefault("max_pool_connections", AppConfig.MAX_POOL_CONNECTIONS)
+    key = (service_name, region_name, verify, _freeze(config_kwargs))
+
+    pool = _getPool()
+    client = pool["clients"].get(key)
+    if client is not None:
+        return client
+
+    async with pool["lock"]:
+        # ロック待ちの間に他のタスクが生成している場合がある
+        client = pool["clients"].get(key)
+        if client is None:
+            client = await pool["stack"].enter_async_context(
+                _session.create_client(
+                    service_name,
+                    region_name=region_name,
+                    config=AioConfig(**config_kwargs),
+                    verify=verify,
+                )
+            )
+            pool["clients"][key] = client
+    return client
+
+
+async def getAsyncBedrockClient(region_name=None, max_attempts=None):
+    """
+    非同期のBedrock Runtimeクライアントを取得する（Throttlingエラー回避のためのリトライ設定付き）
+    :param region_name: リージョン名
+    :param max_attempts: 最大試行回数（省略時はAppConfig.RETRY_CONFIGSの設定。代替モデルに早めに切り替える場合に指定する）
+    :return: 非同期のBedrock Runtimeクライアント
+    """
+    retries = AppConfig.RETRY_CONFIGS
+    if max_attempts is not None:
+        retries = dict(retries, max_attempts=max_attempts)
+    return await getAsyncClient(
+        "bedrock-runtime", region_name=region_name, retries=retries
+    )
+
+
+async def getAsyncKendraClient(region_name=None):
+    """
+    非同期のKendraクライアントを取得する
+    :param region_name: リージョン名
+    :return: 非同期のKendraクライアント
+    """
+    return await getAsyncClient("kendra", region_name=region_name)
+
+
+async def getAsyncS3Client(region_name=None):
+    """
+    存在確認（head_object）用の非同期のS3クライアントを取得する
+    :param region_name: リージョン名
+    :return: 非同期のS3クライアント
+    """
+    return await getAsyncClient(
+        "s3", region_name=region_name, verify=False, signature_version="s3v4"
+    )
+
+
+async def closeAsyncClients():
+    """
+    実行中のイベントループのクライアントを閉じ、プールから取り除く（ASGIサーバーの終了時に呼び出す）
+    """
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool["stack"].aclose()
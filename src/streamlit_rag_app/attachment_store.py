@@ -0,0 +1,284 @@
+import atexit
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from app_config import AppConfig
+
+"""
+マルチモーダルでアップロードされたファイルの保存領域
+ファイルの内容のハッシュ値をキーとして保存し（同じファイルの再アップロードは1つにまとめる）、
+会話履歴にはファイルそのものではなく参照（attachmentRef）のみを保持する
+小さなファイルはメモリ上に、大きなファイルはディスク上に保存し、ConverseAPIに渡す際に読み込む
+ディスク上の保存先は、プロセスごとのディレクトリ（ATTACHMENT_CACHE_DIR/pid-<プロセスID>）とし、
+プロセスの終了時に削除する（Streamlit/uvicornの複数のプロセスが、互いのファイルを破棄しないようにするため）
+"""
+
+# 会話履歴に保持するファイルの参照のキー
+ATTACHMENT_REF_KEY = "attachmentRef"
+# プロセスごとの保存先のディレクトリ名の接頭辞
+PROCESS_DIR_PREFIX = "pid-"
+
+
+def _isProcessRunning(pid):
+    """
+    プロセスが実行中かどうか（POSIX以外では判定できないため、常に実行中とみなす）
+    """
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def removeStaleAttachmentDirs(cache_dir):
+    """
+    終了したプロセスの保存先のディレクトリと、以前のバージョンで直下に保存されたファイルを削除する
+    （強制終了などで、終了時に削除されなかったもの）
+    :param cache_dir: ディスク上の保存先のディレクトリ
+    """
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            pid = name[len(PROCESS_DIR_PREFIX) :]
+            if (
+                name.startswith(PROCESS_DIR_PREFIX)
+                and pid.isdigit()
+                and int(pid) != os.getpid()
+                and not _isProcessRunning(int(pid))
+            ):
+                shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class AttachmentStore:
+    """
+    ファイルの内容のハッシュ値をキーとした保存領域（全てのセッションで共有する）
+    メモリ上・ディスク上のそれぞれで容量の上限を超えた場合は、最も長く参照されていないファイルから破棄する
+    ※ディスク上の保存先（cache_dir）はこのインスタンス専用とし、他のプロセスと共有しないこと
+    """
+
+    def __init__(
+        self, cache_dir, memory_threshold_bytes, max_memory_bytes, max_disk_bytes
+    ):
+        """
+        :param cache_dir: ディスク上の保存先のディレクトリ（このインスタンス専用。存在するファイルは削除する）
+        :param memory_threshold_bytes: このサイズ以下のファイルはメモリ上に保存する
+        :param max_memory_bytes: メモリ上に保存するファイルの合計サイズの上限
+        :param max_disk_bytes: ディスク上に保存するファイルの合計サイズの上限（プロセスごと）
+        """
+        self.cache_dir = cache_dir
+        self.memory_threshold_bytes = memory_threshold_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        # {ハッシュ値: ファイルの内容}
+        self._memory_entries = OrderedDict()
+        self._memory_bytes = 0
+        # {ハッシュ値: ファイルサイズ}
+        self._disk_entries = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        # 管理していないファイルが容量の上限に数えられないよう、空の状態から始める
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def put(self, data):
+        """
+        ファイルを保存する（同じ内容のファイルが保存済みの場合は保存しない）
+        :param data: ファイルの内容
+        :return: ファイルの内容のハッシュ値
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if content_hash in self._memory_entries:
+                self._memory_entries.move_to_end(content_hash)
+                return content_hash
+            if content_hash in self._disk_entries:
+                self._disk_entries.move_to_end(content_hash)
+                return content_hash
+
+            if len(data) <= self.memory_threshold_bytes:
+                self._memory_entries[content_hash] = bytes(data)
+                self._memory_bytes += len(data)
+                while self._memory_bytes > self.max_memory_bytes:
+                    _, evicted = self._memory_entries.popitem(last=False)
+                    self._memory_bytes -= len(evicted)
+            else:
+                # 書き込み途中のファイルを読み込まないよう、一時ファイルに書き込んでから置き換える
+                path = self._path(content_hash)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._disk_entries[content_hash] = len(data)
+                self._disk_bytes += len(data)
+                while self._disk_bytes > self.max_disk_bytes:
+                    evicted_hash, evicted_size = self._disk_entries.popitem(last=False)
+                    self._disk_bytes -= evicted_size
+                    try:
+                        os.remove(self._path(evicted_hash))
+                    except OSError:
+                        pass
+        return content_hash
+
+    def get(self, content_hash):
+        """
+        保存したファイルを取得する
+        :param content_hash: ファイルの内容のハッシュ値
+        :return: ファイルの内容。破棄済みの場合はNone
+        """
+        with self._lock:
+            data = self._memory_entries.get(content_hash)
+            if data is not None:
+                self._memory_entries.move_to_end(content_hash)
+                return data
+            if content_hash not in self._disk_entries:
+                return None
+            self._disk_entries.move_to_end(content_hash)
+            try:
+                with open(self._path(content_hash), "rb") as f:
+                    return f.read()
+            except OSError:
+                return None
+
+    def stats(self):
+        """
+        保存領域の利用状況を返す
+        :return: メモリ上/ディスク上のファイル数と合計サイズの辞書
+        """
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory_entries),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk_entries),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def close(self):
+        """
+        ディスク上の保存先を削除する（プロセスの終了時に呼び出す）
+        """
+        with self._lock:
+            self._disk_entries.clear()
+            self._disk_bytes = 0
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash)
+
+
+# プロセス全体で共有する保存領域（初回利用時に生成）
+_attachment_store = None
+_attachment_store_lock = threading.Lock()
+
+
+def getAttachmentStore():
+    """
+    プロセス全体で共有するファイルの保存領域を取得する
+    （初回の生成時に、終了したプロセスの保存先を削除する）
+    :return: AttachmentStore
+    """
+    global _attachment_store
+    if _attachment_store is None:
+        with _attachment_store_lock:
+            if _attachment_store is None:
+                removeStaleAttachmentDirs(AppConfig.ATTACHMENT_CACHE_DIR)
+                _attachment_store = AttachmentStore(
+                    cache_dir=os.path.join(
+                        AppConfig.ATTACHMENT_CACHE_DIR,
+                        f"{PROCESS_DIR_PREFIX}{os.getpid()}",
+                    ),
+                    memory_threshold_bytes=AppConfig.ATTACHMENT_MEMORY_THRESHOLD_BYTES,
+                    max_memory_bytes=AppConfig.ATTACHMENT_MAX_MEMORY_BYTES,
+                    max_disk_bytes=AppConfig.ATTACHMENT_MAX_DISK_BYTES,
+                )
+                atexit.register(_attachment_store.close)
+    return _attachment_store
+
+
+def makeAttachmentRef(content_hash, attachment_type, file_format, name, tokens=None):
+    """
+    会話履歴に保持するファイルの参照（コンテンツブロック）を生成する
+    :param content_hash: ファイルの内容のハッシュ値
+    :param attachment_type: "image"、"document"または"text"（PDFから抽出したテキスト）
+    :param file_format: ファイル形式（"png", "pdf"など）
+    :param name: ファイル名
+    :param tokens: 概算のトークン数（会話履歴のトークン数の計算に使用。省略時は種類ごとの概算値）
+    :return: ファイルの参照のコンテンツブロック
+    """
+    ref = {
+        "hash": content_hash,
+        "type": attachment_type,
+        "format": file_format,
+        "name": name,
+    }
+    if tokens is not None:
+        ref["tokens"] = tokens
+    return {ATTACHMENT_REF_KEY: ref}
+
+
+def resolveAttachments(messages, store, resend_previous=None):
+    """
+    会話履歴のファイルの参照を、ConverseAPIに渡せるコンテンツブロックに置き換える
+    最新のメッセージのファイルは常に送信し、それより前のファイルはresend_previousに応じて
+    ファイルそのもの、またはファイル名のみのテキストに置き換える
+    （元の会話履歴は変更せず、置き換えたコピーを返す）
+    :param messages: 会話履歴
+    :param store: AttachmentStore
+    :param resend_previous: 以前のメッセージのファイルも再送信するかどうか（省略時はAppConfig.ATTACHMENT_RESEND_PREVIOUS）
+    :return: ConverseAPIに渡せる会話履歴
+    """
+    if resend_previous is None:
+        resend_previous = AppConfig.ATTACHMENT_RESEND_PREVIOUS
+
+    resolved_messages = []
+    for i, message in enumerate(messages):
+        if not any(ATTACHMENT_REF_KEY in block for block in message["content"]):
+            resolved_messages.append(message)
+            continue
+
+        is_latest = i == len(messages) - 1
+        content = []
+        for block in message["content"]:
+            ref = block.get(ATTACHMENT_REF_KEY)
+            if ref is None:
+                content.append(block)
+                continue
+            data = store.get(ref["hash"]) if is_latest or resend_previous else None
+            if data is None:
+                content.append(
+                    {"text": f"（以前アップロードされたファイル: {ref['name']}）"}
+                )
+            elif ref["type"] == "text":
+                content.append({"text": bytes(data).decode("utf-8")})
+            elif ref["type"] == "image":
+                content.append(
+                    {"image": {"format": ref["format"], "source": {"bytes": data}}}
+                )
+            else:
+                # TODO nameの部分に関して、ファイル名の名前を使用するとなぜかconverseAPIのエラーになってしまうため決めうちで指定
+                content.append(
+                    {
+                        "document": {
+                            "format": ref["format"],
+                            "name": ref["format"],
+                            "source": {"bytes": data},
+                        }
+                    }
+                )
+        resolved_messages.append({"role": message["role"], "content": content})
+    return resolved_messages
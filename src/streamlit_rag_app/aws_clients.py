@@ -0,0 +1,138 @@
+import os
+import threading
+
+from app_config import AppConfig
+from dotenv import load_dotenv
+
+"""
+AWSクライアントの共有プール
+boto3のクライアントはスレッドセーフなため、(サービス名, リージョン, 設定)ごとに1つだけ生成し、
+全てのStreamlitセッションで使い回す（エンドポイント/サービスモデルの再読み込みと、
+HTTPSコネクションの再確立を避けるため）
+boto3の読み込みと環境変数（.env）の読み込みは、起動時間を短縮するため最初のクライアントの生成時まで遅延させる
+"""
+
+# クライアント生成時の排他制御用ロック（boto3のセッションはスレッドセーフではないため）
+_lock = threading.Lock()
+# プロセス全体で共有するboto3セッション（初回利用時に生成）
+_session = None
+# 生成済みのクライアント {(サービス名, リージョン, verify, 設定): client}
+_clients = {}
+# 環境変数（.env）を読み込み済みかどうか
+_environment_loaded = False
+
+
+def loadEnvironment():
+    """
+    環境変数（.env）を読み込む（プロセス内で1度だけ）
+    """
+    global _environment_loaded
+    if not _environment_loaded:
+        load_dotenv()
+        _environment_loaded = True
+
+
+def _freeze(value):
+    """
+    クライアントの設定値を辞書のキーとして使えるよう、再帰的にタプルに変換する
+    :param value: 設定値
+    :return: ハッシュ可能な値
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _getSession():
+    """
+    プロファイルを元にboto3セッションを確立する（プロセス内で1度だけ）
+    ※呼び出し元で_lockを取得していること
+    :return: boto3セッション
+    """
+    global _session
+    if _session is None:
+        import boto3
+
+        loadEnvironment()
+        _session = boto3.session.Session(profile_name=os.getenv("profile_name"))
+    return _session
+
+
+def getClient(service_name, region_name=None, verify=None, **config_kwargs):
+    """
+    共有プールからAWSクライアントを取得する（存在しない場合のみ生成する）
+    :param service_name: サービス名（"kendra", "s3", "bedrock-runtime"など）
+    :param region_name: リージョン名（省略時はオレゴン）
+    :param verify: SSL証明書の検証設定
+    :param config_kwargs: botocoreのConfigに渡す設定（retries, signature_versionなど）
+    :return: AWSクライアント
+    """
+    region_name = region_name or AppConfig.REGION_NAME_DICT["oregon"]
+    # 同時接続数の上限（複数セッションから同時に利用されてもコネクションを使い回せるようにする）
+    config_kwargs.setdefault("max_pool_connections", AppConfig.MAX_POOL_CONNECTIONS)
+    key = (service_name, region_name, verify, _freeze(config_kwargs))
+
+    # 生成済みの場合はロックを取らずに返却
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        # ロック待ちの間に他のスレッドが生成している場合がある
+        client = _clients.get(key)
+        if client is None:
+            from botocore.client import Config
+
+            client = _getSession().client(
+                service_name,
+                region_name=region_name,
+                config=Config(**config_kwargs),
+                verify=verify,
+            )
+            _clients[key] = client
+    return client
+
+
+def getBedrockClient(region_name=None, max_attempts=None):
+    """
+    Bedrock Runtimeクライアントを取得する（Throttlingエラー回避のためのリトライ設定付き）
+    :param region_name: リージョン名
+    :param max_attempts: 最大試行回数（省略時はAppConfig.RETRY_CONFIGSの設定。代替モデルに早めに切り替える場合に指定する）
+    :return: Bedrock Runtimeクライアント
+    """
+    retries = AppConfig.RETRY_CONFIGS
+    if max_attempts is not None:
+        retries = dict(retries, max_attempts=max_attempts)
+    return getClient("bedrock-runtime", region_name=region_name, retries=retries)
+
+
+def getKendraClient(region_name=None):
+    """
+    Kendraクライアントを取得する
+    :param region_name: リージョン名
+    :return: Kendraクライアント
+    """
+    return getClient("kendra", region_name=region_name)
+
+
+def getS3Client(region_name=None):
+    """
+    署名付きURL生成用のS3クライアントを取得する
+    :param region_name: リージョン名
+    :return: S3クライアント
+    """
+    return getClient(
+        "s3", region_name=region_name, verify=False, signature_version="s3v4"
+    )
+
+
+def clearClients():
+    """
+    共有プールのクライアントとセッションを破棄する（プロファイルや設定を切り替えた場合に使用）
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
@@ -0,0 +1,400 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from app_config import AppConfig
+from context_builder import estimateMessageTokens, estimateTokens, getModelKey
+from telemetry import recordSpan
+
+"""
+Amazon Bedrockへのリクエストの流量制御（プロセス全体で共有）
+全てのConverse/ConverseStreamAPIの呼び出しをこのスケジューラ経由で行い、
+(モデル, リージョン)ごとのトークンバケット（リクエスト数/分・トークン数/分）の範囲内で送信する
+（Bedrockのクォータはリージョンごとに設定されるため、リージョンごとに上限を管理する）
+上限に達している場合は優先度付きの待ち行列で待機し、待ち時間の上限を超える見込みの場合は即座にエラーとする
+（クライアントごとのリトライに任せると、バースト時に全セッションがBedrockへの再送を繰り返し、互いに遅延させるため）
+"""
+
+# リクエストの優先度（値が小さいほど優先される）
+PRIORITY_DICT = {
+    "interactive": 0,  # 画面で回答を待っているチャット
+    "bulk": 1,  # 分割要約・会話履歴の要約などのバックグラウンド処理
+}
+
+
+class BedrockAdmissionError(Exception):
+    """
+    Bedrockへのリクエストが混み合っており、待ち時間の上限内に送信できない場合のエラー
+    """
+
+
+class TokenBucket:
+    """
+    トークンバケット（1分あたりの上限を、秒単位で少しずつ補充する）
+    ※排他制御は呼び出し元で行うこと
+    """
+
+    def __init__(self, per_minute):
+        """
+        :param per_minute: 1分あたりの上限（バケットの容量）
+        """
+        self.capacity = per_minute
+        self.refill_per_second = per_minute / 60
+        self.available = per_minute
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity,
+            self.available + (now - self._updated_at) * self.refill_per_second,
+        )
+        self._updated_at = now
+
+    def waitSeconds(self, amount):
+        """
+        指定した量を取り出せるようになるまでの待ち時間を返す
+        :param amount: 取り出す量（容量を超える場合は容量として扱う）
+        :return: 待ち時間（秒。すぐに取り出せる場合は0）
+        """
+        self._refill()
+        shortage = min(amount, self.capacity) - self.available
+        return max(0.0, shortage / self.refill_per_second)
+
+    def consume(self, amount):
+        """
+        指定した量を取り出す（不足する場合は、残量がマイナスになる）
+        :param amount: 取り出す量（マイナスの場合は戻す）
+        """
+        self._refill()
+        self.available = min(self.capacity, self.available - amount)
+
+
+class AdmissionController:
+    """
+    (モデル, リージョン)ごとのトークンバケットと、優先度付きの待ち行列によるBedrockへの流量制御クラス
+    """
+
+    def __init__(self, rate_limits_dict, default_rate_limits, max_queue_size):
+        """
+        :param rate_limits_dict: モデル（MODEL_ID_DICTのキー）ごとの上限 {requests_per_minute, tokens_per_minute}
+        :param default_rate_limits: rate_limits_dictにないモデルの上限
+        :param max_queue_size: (モデル, リージョン)ごとの待ち行列の長さの上限
+        """
+        self.rate_limits_dict = rate_limits_dict
+        self.default_rate_limits = default_rate_limits
+        self.max_queue_size = max_queue_size
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+        # (モデルID, リージョン名)ごとの状態 {(モデルID, リージョン名): {"requests", "tokens", "queue", "stats"}}
+        self._models = {}
+
+    def _getModel(self, model_id, region_name=None):
+        model = self._models.get((model_id, region_name))
+        if model is None:
+            rate_limits = self.rate_limits_dict.get(
+                getModelKey(model_id), self.default_rate_limits
+            )
+            model = {
+                "requests": TokenBucket(rate_limits["requests_per_minute"]),
+                "tokens": TokenBucket(rate_limits["tokens_per_minute"]),
+                "queue": [],
+                "stats": {
+                    "admitted": 0,
+                    "rejected": 0,
+                    "wait_seconds_total": 0.0,
+                    "wait_seconds_max": 0.0,
+                    "queue_depth_max": 0,
+                },
+            }
+            self._models[(model_id, region_name)] = model
+        return model
+
+    def acquire(
+        self,
+        model_id,
+        tokens,
+        priority="interactive",
+        timeout_seconds=None,
+        region_name=None,
+    ):
+        """
+        Bedrockへのリクエストの送信許可を得る（上限に達している場合は、送信できるまで待機する）
+        :param model_id: BedrockのモデルID
+        :param tokens: リクエストの概算のトークン数（入力と出力の上限の合計）
+        :param priority: 優先度（PRIORITY_DICTのキー）
+        :param timeout_seconds: 待ち時間の上限（秒。省略時は優先度ごとのAppConfig.BEDROCK_QUEUE_TIMEOUT_SECONDS_DICT。
+                                0の場合は、すぐに送信できない場合にエラーとする）
+        :param region_name: 送信先のリージョン名
+        :return: 待ち時間（秒）
+        """
+        if timeout_seconds is None:
+            timeout_seconds = AppConfig.BEDROCK_QUEUE_TIMEOUT_SECONDS_DICT[priority]
+        started_at = time.monotonic()
+        deadline = started_at + timeout_seconds
+
+        with self._cond:
+            model = self._getModel(model_id, region_name)
+            queue = model["queue"]
+            if len(queue) >= self.max_queue_size:
+                self._reject(model, "待ち行列が上限に達しています")
+            entry = (PRIORITY_DICT[priority], next(self._sequence))
+            heapq.heappush(queue, entry)
+            model["stats"]["queue_depth_max"] = max(
+                model["stats"]["queue_depth_max"], len(queue)
+            )
+            try:
+                while True:
+                    now = time.monotonic()
+                    if queue[0] == entry:
+                        # 先頭の場合は、バケットから取り出せるまでの待ち時間を求める
+                        wait_seconds = max(
+                            model["requests"].waitSeconds(1),
+                            model["tokens"].waitSeconds(tokens),
+                        )
+                        if wait_seconds == 0:
+                            model["requests"].consume(1)
+                            model["tokens"].consume(tokens)
+                            break
+                        # 待ち時間の上限を超える見込みの場合は、待たずにエラーとする
+                        if now + wait_seconds > deadline:
+                            self._reject(model, "待ち時間の上限を超える見込みです")
+                        self._cond.wait(wait_seconds)
+                    else:
+                        # 先に並んでいるリクエストの送信を待つと上限を超える見込みの場合は、待たずにエラーとする
+                        ahead = sum(1 for other in queue if other < entry)
+                        if now + model["requests"].waitSeconds(ahead + 1) > deadline:
+                            self._reject(model, "待ち時間の上限を超える見込みです")
+                        self._cond.wait(deadline - now)
+            finally:
+                if entry in queue:
+                    queue.remove(entry)
+                    heapq.heapify(queue)
+                # 次の先頭のリクエストを起こす
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started_at
+            stats = model["stats"]
+            stats["admitted"] += 1
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+        return waited
+
+    def reconcile(self, model_id, estimated_tokens, actual_tokens, region_name=None):
+        """
+        送信許可時に取り出した概算のトークン数を、実際のトークン使用量に合わせて補正する
+        :param model_id: BedrockのモデルID
+        :param estimated_tokens: acquireで指定したトークン数
+        :param actual_tokens: レスポンスのトークン使用量（totalTokens）
+        :param region_name: 送信先のリージョン名
+        """
+        with self._cond:
+            self._getModel(model_id, region_name)["tokens"].consume(
+                actual_tokens - estimated_tokens
+            )
+            self._cond.notify_all()
+
+    def queueDepth(self, model_id):
+        """
+        モデルの待ち行列の長さ（全リージョンの合計）を返す
+        :param model_id: BedrockのモデルID
+        :return: 待ち行列の長さ
+        """
+        with self._cond:
+            return sum(
+                len(model["queue"])
+                for (key_model_id, _), model in self._models.items()
+                if key_model_id == model_id
+            )
+
+    def _reject(self, model, reason):
+        model["stats"]["rejected"] += 1
+        raise BedrockAdmissionError(
+            f"Bedrockへのリクエストが混み合っています（{reason}）。しばらくしてから再度お試しください。"
+        )
+
+    def stats(self):
+        """
+        (モデル, リージョン)ごとの流量制御の状況を返す
+        :return: {"モデルID@リージョン名": {queue_depth, admitted, rejected, wait_seconds_avg, wait_seconds_max, ...}}
+        """
+        with self._cond:
+            result = {}
+            for (model_id, region_name), model in self._models.items():
+                stats = dict(model["stats"])
+                stats["queue_depth"] = len(model["queue"])
+                stats["wait_seconds_avg"] = (
+                    stats["wait_seconds_total"] / stats["admitted"]
+                    if stats["admitted"]
+                    else 0.0
+                )
+                stats["available_requests"] = model["requests"].available
+                stats["available_tokens"] = model["tokens"].available
+                result[f"{model_id}@{region_name}"] = stats
+            return result
+
+
+# プロセス全体で共有する流量制御
+admission_controller = AdmissionController(
+    rate_limits_dict=AppConfig.BEDROCK_RATE_LIMITS_DICT,
+    default_rate_limits=AppConfig.BEDROCK_DEFAULT_RATE_LIMITS,
+    max_queue_size=AppConfig.BEDROCK_QUEUE_MAX_SIZE,
+)
+
+
+def estimateRequestTokens(converse_kwargs):
+    """
+    ConverseAPIのリクエストのトークン数（入力の概算と出力の上限の合計）を求める
+    :param converse_kwargs: ConverseAPIの引数
+    :return: 概算のトークン数
+    """
+    input_tokens = sum(
+        estimateMessageTokens(message) for message in converse_kwargs["messages"]
+    ) + sum(
+        estimateTokens(block.get("text", ""))
+        for block in converse_kwargs.get("system", [])
+    )
+    max_tokens = converse_kwargs.get("inferenceConfig", {}).get(
+        "maxTokens", AppConfig.INFERENCE_CONFIG_DICT["maxTokens"]
+    )
+    return input_tokens + max_tokens
+
+
+def _acquireForClient(client, priority, timeout_seconds, converse_kwargs):
+    """
+    クライアントのリージョンの流量制御の送信許可を得て、トークン数の補正を行う関数を返す
+    """
+    model_id = converse_kwargs["modelId"]
+    region_name = getattr(getattr(client, "meta", None), "region_name", None)
+    tokens = estimateRequestTokens(converse_kwargs)
+    waited = admission_controller.acquire(
+        model_id, tokens, priority, timeout_seconds, region_name=region_name
+    )
+    recordSpan(
+        "bedrock.admission_wait",
+        waited,
+        model_id=model_id,
+        region=region_name,
+        priority=priority,
+        estimated_tokens=tokens,
+    )
+
+    def reconcile_usage(actual_tokens):
+        admission_controller.reconcile(model_id, tokens, actual_tokens, region_name)
+
+    return reconcile_usage
+
+
+def scheduledConverse(
+    client, priority="interactive", timeout_seconds=None, **converse_kwargs
+):
+    """
+    流量制御の送信許可を得てから、ConverseAPIを呼び出す
+    :param client: Bedrock Runtimeクライアント
+    :param priority: 優先度（PRIORITY_DICTのキー）
+    :param timeout_seconds: 待ち時間の上限（秒。AdmissionController.acquireを参照）
+    :param converse_kwargs: ConverseAPIの引数
+    :return: ConverseAPIのレスポンス
+    """
+    reconcile_usage = _acquireForClient(
+        client, priority, timeout_seconds, converse_kwargs
+    )
+    response = client.converse(**converse_kwargs)
+    total_tokens = response.get("usage", {}).get("totalTokens")
+    if total_tokens is not None:
+        reconcile_usage(total_tokens)
+    return response
+
+
+def scheduledConverseStream(
+    client,
+    priority="interactive",
+    timeout_seconds=None,
+    timings=None,
+    **converse_kwargs,
+):
+    """
+    流量制御の送信許可を得てから、ConverseStreamAPIを呼び出す
+    （トークン使用量はストリームの最後に返却されるため、補正は呼び出し元で返却した関数を呼び出して行う）
+    :param client: Bedrock Runtimeクライアント
+    :param priority: 優先度（PRIORITY_DICTのキー）
+    :param timeout_seconds: 待ち時間の上限（秒。AdmissionController.acquireを参照）
+    :param timings: 指定した場合、送信許可を得てからレスポンスのヘッダーを受け取るまでの時間（first_byte_seconds）を格納する辞書
+    :param converse_kwargs: ConverseStreamAPIの引数
+    :return: (ConverseStreamAPIのレスポンス, トークン数の補正を行う関数 reconcile_usage(実際のトークン数))
+    """
+    reconcile_usage = _acquireForClient(
+        client, priority, timeout_seconds, converse_kwargs
+    )
+    sent_at = time.perf_counter()
+    response = client.converse_stream(**converse_kwargs)
+    if timings is not None:
+        timings["first_byte_seconds"] = time.perf_counter() - sent_at
+    return response, reconcile_usage
+
+
+async def scheduledConverseAsync(
+    client, priority="interactive", timeout_seconds=None, **converse_kwargs
+):
+    """
+    scheduledConverseの非同期版（非同期のBedrockクライアントで呼び出す）
+    送信許可の待機はスレッドで行い、イベントループを止めない
+    :param client: Bedrock Runtimeの非同期クライアント
+    :param priority: 優先度（PRIORITY_DICTのキー）
+    :param timeout_seconds: 待ち時間の上限（秒。AdmissionController.acquireを参照）
+    :param converse_kwargs: ConverseAPIの引数
+    :return: ConverseAPIのレスポンス
+    """
+    reconcile_usage = await _acquireForClientAsync(
+        client, priority, timeout_seconds, converse_kwargs
+    )
+    response = await client.converse(**converse_kwargs)
+    total_tokens = response.get("usage", {}).get("totalTokens")
+    if total_tokens is not None:
+        reconcile_usage(total_tokens)
+    return response
+
+
+async def scheduledConverseStreamAsync(
+    client,
+    priority="interactive",
+    timeout_seconds=None,
+    timings=None,
+    **converse_kwargs,
+):
+    """
+    scheduledConverseStreamの非同期版（非同期のBedrockクライアントで呼び出す）
+    :param client: Bedrock Runtimeの非同期クライアント
+    :param priority: 優先度（PRIORITY_DICTのキー）
+    :param timeout_seconds: 待ち時間の上限（秒。AdmissionController.acquireを参照）
+    :param timings: 指定した場合、送信許可を得てからレスポンスのヘッダーを受け取るまでの時間（first_byte_seconds）を格納する辞書
+    :param converse_kwargs: ConverseStreamAPIの引数
+    :return: (ConverseStreamAPIのレスポンス, トークン数の補正を行う関数 reconcile_usage(実際のトークン数))
+    """
+    reconcile_usage = await _acquireForClientAsync(
+        client, priority, timeout_seconds, converse_kwargs
+    )
+    sent_at = time.perf_counter()
+    response = await client.converse_stream(**converse_kwargs)
+    if timings is not None:
+        timings["first_byte_seconds"] = time.perf_counter() - sent_at
+    return response, reconcile_usage
+
+
+async def _acquireForClientAsync(client, priority, timeout_seconds, converse_kwargs):
+    if timeout_seconds == 0:
+        # 待たずに判定する場合は、スレッドに切り替えずに呼び出す
+        return _acquireForClient(client, priority, timeout_seconds, converse_kwargs)
+    return await asyncio.to_thread(
+        _acquireForClient, client, priority, timeout_seconds, converse_kwargs
+    )
+
+
+def getSchedulerStats():
+    """
+    (モデル, リージョン)ごとの流量制御の状況を返す
+    :return: AdmissionController.statsの結果
+    """
+    return admission_controller.stats()
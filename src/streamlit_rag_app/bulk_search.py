@@ -0,0 +1,252 @@
+import concurrent.futures
+import csv
+import io
+import logging
+import threading
+import time
+
+from app_config import AppConfig
+from caches import KendraQueryCache
+from kendra_bedrock_query import generateSignedUrls, queryKendra
+from telemetry import span, submitWithContext
+
+"""
+Kendraの一括検索
+CSVファイルまたは貼り付けたリストの検索キーワードを、重複を除いた上で、
+選択したカテゴリ（AppConfig.CATEGORY_LABELS）ごとに並列に検索し、
+検索結果（検索キーワード, カテゴリ, 順位, ドキュメント名, 署名付きURL）をCSV/Parquet形式で出力する
+検索結果のキャッシュ・署名付きURLのキャッシュは、通常の検索と同じものを使用し、
+キャッシュにない検索のみ、全セッションで共有する1秒あたりのリクエスト数の上限（AppConfig.BULK_SEARCH_KENDRA_QPS）の範囲内でKendraへ送信する
+"""
+
+logger = logging.getLogger(__name__)
+
+# 出力する検索結果の列
+BULK_SEARCH_COLUMNS = [
+    "query",
+    "category",
+    "rank",
+    "document_name",
+    "signed_url",
+    "error",
+]
+
+
+class RequestRateLimiter:
+    """
+    1秒あたりのリクエスト数の上限の範囲内になるよう、リクエストの送信間隔を空けるクラス（プロセス全体で共有）
+    """
+
+    def __init__(self, requests_per_second):
+        """
+        :param requests_per_second: 1秒あたりのリクエスト数の上限
+        """
+        self.interval_seconds = 1 / requests_per_second
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        次のリクエストを送信できる時刻まで待機する
+        :return: 待機した時間（秒）
+        """
+        with self._lock:
+            now = time.monotonic()
+            scheduled_at = max(now, self._next_at)
+            self._next_at = scheduled_at + self.interval_seconds
+        wait_seconds = scheduled_at - now
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+
+# 一括検索でのKendraへのリクエスト数の上限（全セッションで共有）
+kendra_rate_limiter = RequestRateLimiter(AppConfig.BULK_SEARCH_KENDRA_QPS)
+
+# 一括検索を並列に実行するスレッドプール（全セッションで共有）
+_bulk_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AppConfig.BULK_SEARCH_MAX_WORKERS, thread_name_prefix="bulk-search"
+)
+
+
+def dedupeQueries(queries):
+    """
+    検索キーワードから空のものと重複したもの（正規化した結果が同じもの）を除く
+    :param queries: 検索キーワードのリスト
+    :return: 検索キーワードのリスト（最初に出現した順）
+    """
+    seen = set()
+    deduped = []
+    for query in queries:
+        query = query.strip()
+        normalized = KendraQueryCache.normalizeQuery(query)
+        if not normalized or normalized in seen:
+            continue
+        seen.add(normalized)
+        deduped.append(query)
+    return deduped
+
+
+def parseQueryText(text):
+    """
+    貼り付けられたテキスト（1行に1件）から検索キーワードを取り出す
+    :param text: 貼り付けられたテキスト
+    :return: 検索キーワードのリスト（重複を除く）
+    """
+    return dedupeQueries(text.splitlines())
+
+
+def parseQueryCsv(data):
+    """
+    CSVファイルから検索キーワードを取り出す
+    1行目に"query"列がある場合はその列を、ない場合は1列目を検索キーワードとして扱う
+    :param data: CSVファイルの内容（UTF-8またはShift_JIS）
+    :return: 検索キーワードのリスト（重複を除く）
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Excelで保存されたCSVファイル
+        text = data.decode("cp932")
+
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    if "query" in header:
+        column = header.index("query")
+        rows = rows[1:]
+    else:
+        column = 0
+    return dedupeQueries(row[column] for row in rows if len(row) > column)
+
+
+def _searchQuery(query, category_key, query_cache):
+    """
+    検索キーワード1件・カテゴリ1件の検索を行う（iterBulkSearchからスレッドプール上で呼び出される）
+    :param query: 検索キーワード
+    :param category_key: 検索対象のカテゴリのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :return: 署名付きURLのリスト（Kendraのランキング順）
+    """
+    with span("bulk_search.query") as attributes:
+        # キャッシュにある検索結果は、リクエスト数の上限による待機をせずに返却する
+        kendra_response = queryKendra(
+            query,
+            category_key,
+            query_cache,
+            page_number=1,
+            page_size=AppConfig.BULK_SEARCH_RESULTS_PER_QUERY,
+            rate_limiter=kendra_rate_limiter,
+        )
+        signed_urls = generateSignedUrls(kendra_response)
+        attributes["result_count"] = len(signed_urls)
+    return signed_urls
+
+
+def iterBulkSearch(queries, category_keys, query_cache=None):
+    """
+    検索キーワードとカテゴリの全ての組み合わせを並列に検索し、完了した順に結果を返すジェネレータ
+    途中でジェネレータを閉じた場合は、開始前の検索を取り消す
+    :param queries: 検索キーワードのリスト（dedupeQueriesで重複を除いたもの）
+    :param category_keys: 検索対象のカテゴリのkeyのリスト
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :return: {order（検索キーワード・カテゴリの順）, query, category_key, signed_urls, error}を完了した順に返すジェネレータ
+    """
+    tasks = [
+        (query, category_key) for query in queries for category_key in category_keys
+    ]
+    futures = {
+        submitWithContext(
+            _bulk_executor, _searchQuery, query, category_key, query_cache
+        ): order
+        for order, (query, category_key) in enumerate(tasks)
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            order = futures[future]
+            query, category_key = tasks[order]
+            try:
+                signed_urls, error = future.result(), None
+            except Exception as e:
+                logger.warning(
+                    "Bulk search failed for %r (%s): %s", query, category_key, e
+                )
+                signed_urls, error = [], str(e)
+            yield {
+                "order": order,
+                "query": query,
+                "category_key": category_key,
+                "signed_urls": signed_urls,
+                "error": error,
+            }
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def buildBulkSearchRows(outcomes):
+    """
+    iterBulkSearchの結果を、出力用の行（BULK_SEARCH_COLUMNSの辞書）に変換する
+    検索キーワード・カテゴリの順に並べ、検索結果がない組み合わせも順位を空欄とした1行として残す
+    :param outcomes: iterBulkSearchの結果のリスト
+    :return: 行のリスト
+    """
+    rows = []
+    for outcome in sorted(outcomes, key=lambda outcome: outcome["order"]):
+        base = {
+            "query": outcome["query"],
+            "category": AppConfig.CATEGORY_LABELS.get(
+                outcome["category_key"], outcome["category_key"]
+            ),
+        }
+        if not outcome["signed_urls"]:
+            rows.append(
+                dict(
+                    base,
+                    rank=None,
+                    document_name="",
+                    signed_url="",
+                    error=outcome["error"] or "",
+                )
+            )
+            continue
+        for rank, result in enumerate(outcome["signed_urls"], 1):
+            rows.append(
+                dict(
+                    base,
+                    rank=rank,
+                    document_name=result["document_name"],
+                    signed_url=result["signed_url"],
+                    error="",
+                )
+            )
+    return rows
+
+
+def buildBulkSearchCsv(rows):
+    """
+    検索結果をCSV形式に変換する（Excelで開けるよう、BOM付きのUTF-8とする）
+    :param rows: buildBulkSearchRowsの結果
+    :return: CSVファイルの内容
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=BULK_SEARCH_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def buildBulkSearchParquet(rows):
+    """
+    検索結果をParquet形式に変換する（pandasとpyarrowが必要。Streamlitの依存関係に含まれる）
+    :param rows: buildBulkSearchRowsの結果
+    :return: Parquetファイルの内容
+    """
+    import pandas
+
+    data_frame = pandas.DataFrame(rows, columns=BULK_SEARCH_COLUMNS)
+    data_frame["rank"] = data_frame["rank"].astype("Int64")
+    buffer = io.BytesIO()
+    data_frame.to_parquet(buffer, index=False)
+    return buffer.getvalue()
@@ -0,0 +1,200 @@
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+"""
+プロセス内で共有するキャッシュ
+全てのStreamlitセッションから同時に参照されるため、操作は全てロックで保護する
+"""
+
+
+class TTLLRUCache:
+    """
+    有効期限（TTL）付きのLRUキャッシュ
+    エントリ数が上限を超えた場合は、最も長く参照されていないエントリから破棄する
+    """
+
+    def __init__(self, max_entries, default_ttl_seconds=None):
+        """
+        :param max_entries: 保持するエントリ数の上限
+        :param default_ttl_seconds: エントリの既定の有効期間（秒）。Noneの場合は期限なし
+        """
+        self.max_entries = max_entries
+        self.default_ttl_seconds = default_ttl_seconds
+        # {key: (有効期限（time.monotonic基準。期限なしの場合はNone）, 値)}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        キャッシュから値を取得する（期限切れの場合はエントリを破棄してNoneを返す）
+        :param key: キャッシュのキー
+        :return: キャッシュされた値。存在しない場合はNone
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """
+        キャッシュから値を参照する（ヒット/ミスの回数とLRUの順序は更新しない）
+        :param key: キャッシュのキー
+        :return: キャッシュされた値。存在しない、または期限切れの場合はNone
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is None or time.monotonic() < expires_at:
+                return value
+            return None
+
+    def put(self, key, value, ttl_seconds=None):
+        """
+        キャッシュに値を格納する
+        :param key: キャッシュのキー
+        :param value: 格納する値
+        :param ttl_seconds: 有効期間（秒）。省略時はdefault_ttl_secondsを使用
+        """
+        ttl_seconds = (
+            ttl_seconds if ttl_seconds is not None else self.default_ttl_seconds
+        )
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            # 上限を超えた分は、最も長く参照されていないエントリから破棄
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        キャッシュを破棄する
+        :param key: 破棄するキー。省略時は全てのエントリを破棄
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """
+        キャッシュの利用状況を返す
+        :return: エントリ数、ヒット数、ミス数、ヒット率、破棄数の辞書
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class PresignedUrlCache(TTLLRUCache):
+    """
+    (バケット名, オブジェクトキー)ごとの署名付きURLのキャッシュ
+    有効期限までの残り時間が一定以上ある間は同じURLを返し、期限が近づいたら署名し直す
+    """
+
+    def __init__(self, max_entries, expires_in_seconds, min_remaining_seconds):
+        """
+        :param max_entries: 保持するURL数の上限
+        :param expires_in_seconds: 署名付きURLの有効期間（秒）
+        :param min_remaining_seconds: キャッシュしたURLを返す際に必要な、有効期限までの残り時間（秒）
+        """
+        super().__init__(max_entries)
+        self.expires_in_seconds = expires_in_seconds
+        self.min_remaining_seconds = min_remaining_seconds
+
+    def putSignedUrl(self, bucket_name, object_key, signed_url):
+        """
+        署名したURLを格納する（残り時間がmin_remaining_secondsを切った時点で期限切れとして扱う）
+        :param bucket_name: バケット名
+        :param object_key: オブジェクトキー
+        :param signed_url: 署名付きURL
+        """
+        self.put(
+            (bucket_name, object_key),
+            signed_url,
+            ttl_seconds=max(self.expires_in_seconds - self.min_remaining_seconds, 0),
+        )
+
+    def getOrSign(self, s3_client, bucket_name, object_key):
+        """
+        キャッシュ済みの署名付きURLを返す。存在しない/期限が近い場合は署名してキャッシュする
+        :param s3_client: S3クライアント
+        :param bucket_name: バケット名
+        :param object_key: オブジェクトキー
+        :return: 署名付きURL
+        """
+        signed_url = self.get((bucket_name, object_key))
+        if signed_url is None:
+            signed_url = s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": bucket_name, "Key": object_key},
+                ExpiresIn=self.expires_in_seconds,
+            )
+            self.putSignedUrl(bucket_name, object_key, signed_url)
+        return signed_url
+
+
+class KendraQueryCache(TTLLRUCache):
+    """
+    Kendraの検索結果のキャッシュ（全てのセッションで共有する）
+    正規化した検索クエリ、AttributeFilter、ページをキーとして検索結果を保持する
+    ※キャッシュした検索結果は複数のセッションから参照されるため、呼び出し元で変更しないこと
+    """
+
+    def makeKey(
+        self, query_text, attribute_filter, page_number, page_size, api="query"
+    ):
+        """
+        キャッシュのキーを生成する
+        :param query_text: 検索クエリ
+        :param attribute_filter: KendraのAttributeFilter
+        :param page_number: ページ番号
+        :param page_size: 1ページあたりの件数
+        :param api: 呼び出したKendraのAPI（"query"または"retrieve"）
+        :return: キャッシュのキー
+        """
+        return (
+            api,
+            self.normalizeQuery(query_text),
+            json.dumps(attribute_filter, sort_keys=True, ensure_ascii=False),
+            page_number,
+            page_size,
+        )
+
+    @staticmethod
+    def normalizeQuery(query_text):
+        """
+        検索クエリを正規化する（全角/半角の統一、大文字/小文字の統一、空白の除去）
+        :param query_text: 検索クエリ
+        :return: 正規化した検索クエリ
+        """
+        normalized = unicodedata.normalize("NFKC", query_text).lower()
+        return re.sub(r"\s+", " ", normalized).strip()
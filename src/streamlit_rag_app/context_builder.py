@@ -0,0 +1,216 @@
+import re
+import unicodedata
+
+from app_config import AppConfig
+from attachment_store import ATTACHMENT_REF_KEY
+
+"""
+RAG検索でLLMに渡すコンテキストの構築
+Kendraの検索結果（query API/retrieve API）から本文の抜粋（パッセージ）を取り出し、
+重複の除去・並べ替えを行った上で、モデルごとのトークン数の上限に収まるように詰め込む
+"""
+
+# RAG検索のコンテキスト（assistantのメッセージとして会話に挿入される）の先頭の文言
+RAG_CONTEXT_PREFIX = "Kendra検索結果:"
+
+# ファイル（画像/PDF）を含む会話をトークン数に換算する際の概算値
+ATTACHMENT_TOKEN_ESTIMATE = {"image": 1600, "document": 3000}
+# Kendraの検索結果の信頼度ごとの重み（並べ替えに使用）
+SCORE_CONFIDENCE_WEIGHTS = {
+    "VERY_HIGH": 4,
+    "HIGH": 3,
+    "MEDIUM": 2,
+    "LOW": 1,
+    "NOT_AVAILABLE": 0,
+}
+
+
+def estimateTokens(text):
+    """
+    テキストのトークン数を概算する（Claudeのトークナイザは公開されていないため近似値）
+    ASCII文字は4文字で1トークン、日本語などの非ASCII文字は1文字で1トークンとして数える
+    :param text: テキスト
+    :return: 概算のトークン数
+    """
+    ascii_count = sum(1 for c in text if c.isascii())
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+def estimateMessageTokens(message):
+    """
+    メッセージ1件のトークン数を概算する
+    :param message: ConverseAPIのメッセージ
+    :return: 概算のトークン数
+    """
+    tokens = 0
+    for block in message["content"]:
+        if "text" in block:
+            tokens += estimateTokens(block["text"])
+        for attachment_type, attachment_tokens in ATTACHMENT_TOKEN_ESTIMATE.items():
+            if attachment_type in block:
+                tokens += attachment_tokens
+        # 保存領域に保存したファイルの参照は、参照に記録したトークン数（なければファイルの種類）で数える
+        if ATTACHMENT_REF_KEY in block:
+            ref = block[ATTACHMENT_REF_KEY]
+            tokens += ref.get("tokens") or ATTACHMENT_TOKEN_ESTIMATE.get(ref["type"], 0)
+    return tokens
+
+
+def getModelKey(model_id):
+    """
+    モデルIDに対応する、AppConfig.MODEL_ID_DICTのキーを返す
+    :param model_id: BedrockのモデルID
+    :return: MODEL_ID_DICTのキー。存在しない場合はNone
+    """
+    for model_key, dict_model_id in AppConfig.MODEL_ID_DICT.items():
+        if dict_model_id == model_id:
+            return model_key
+    return None
+
+
+def getContextTokenBudget(model_id):
+    """
+    モデルIDに対応する、コンテキストに使用できるトークン数の上限を返す
+    :param model_id: BedrockのモデルID
+    :return: トークン数の上限
+    """
+    return AppConfig.RAG_CONTEXT_TOKEN_BUDGET_DICT.get(
+        getModelKey(model_id), AppConfig.RAG_CONTEXT_DEFAULT_TOKEN_BUDGET
+    )
+
+
+def extractPassagesFromQuery(kendra_response):
+    """
+    Kendraの query APIの検索結果からパッセージを取り出す
+    :param kendra_response: query APIのレスポンス
+    :return: パッセージ（document_title, text, confidence, rank）のリスト
+    """
+    passages = []
+    for rank, result in enumerate(kendra_response.get("ResultItems", [])):
+        text = result.get("DocumentExcerpt", {}).get("Text", "")
+        # 質問回答（ANSWER/QUESTION_ANSWER）の場合は、回答の本文を優先して使用する
+        for attribute in result.get("AdditionalAttributes", []):
+            if attribute.get("Key") == "AnswerText":
+                text = (
+                    attribute.get("Value", {})
+                    .get("TextWithHighlightsValue", {})
+                    .get("Text", text)
+                )
+        passages.append(
+            {
+                "document_title": result.get("DocumentTitle", {}).get("Text", ""),
+                "text": text,
+                "confidence": result.get("ScoreAttributes", {}).get(
+                    "ScoreConfidence", "NOT_AVAILABLE"
+                ),
+                "rank": rank,
+            }
+        )
+    return passages
+
+
+def extractPassagesFromRetrieve(retrieve_response):
+    """
+    Kendraの retrieve APIの検索結果からパッセージを取り出す
+    :param retrieve_response: retrieve APIのレスポンス
+    :return: パッセージ（document_title, text, confidence, rank）のリスト
+    """
+    return [
+        {
+            "document_title": result.get("DocumentTitle", ""),
+            "text": result.get("Content", ""),
+            "confidence": result.get("ScoreAttributes", {}).get(
+                "ScoreConfidence", "NOT_AVAILABLE"
+            ),
+            "rank": rank,
+        }
+        for rank, result in enumerate(retrieve_response.get("ResultItems", []))
+    ]
+
+
+def _normalizeText(text):
+    """
+    重複判定用にテキストを正規化する（全角/半角の統一、空白と省略記号の除去）
+    """
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"[\s…]+|\.\.\.", "", normalized)
+
+
+def _ngrams(text, n=3):
+    return {text[i : i + n] for i in range(max(len(text) - n + 1, 1))}
+
+
+def rankPassages(passages):
+    """
+    パッセージを信頼度の高い順、同じ信頼度の場合はKendraの検索順に並べ替える
+    :param passages: パッセージのリスト
+    :return: 並べ替えたパッセージのリスト
+    """
+    return sorted(
+        passages,
+        key=lambda p: (-SCORE_CONFIDENCE_WEIGHTS.get(p["confidence"], 0), p["rank"]),
+    )
+
+
+def dedupePassages(passages, threshold=None):
+    """
+    内容が重複するパッセージを除去する（先に並んでいるパッセージを優先して残す）
+    文字3-gramの集合で、短い方のパッセージがどれだけ長い方に含まれているかを重複度として判定する
+    :param passages: パッセージのリスト（優先度の高い順）
+    :param threshold: 重複とみなす重複度（0〜1）。省略時はAppConfig.RAG_CONTEXT_DEDUPE_THRESHOLD
+    :return: 重複を除去したパッセージのリスト
+    """
+    threshold = (
+        threshold if threshold is not None else AppConfig.RAG_CONTEXT_DEDUPE_THRESHOLD
+    )
+    kept = []
+    kept_ngrams = []
+    for passage in passages:
+        normalized = _normalizeText(passage["text"])
+        if not normalized:
+            continue
+        ngrams = _ngrams(normalized)
+        is_duplicate = any(
+            len(ngrams & other) / min(len(ngrams), len(other)) >= threshold
+            for other in kept_ngrams
+        )
+        if not is_duplicate:
+            kept.append(passage)
+            kept_ngrams.append(ngrams)
+    return kept
+
+
+def packPassages(passages, token_budget):
+    """
+    パッセージを優先度の高い順に、トークン数の上限に収まるだけ詰め込む
+    :param passages: パッセージのリスト（優先度の高い順）
+    :param token_budget: トークン数の上限
+    :return: 上限に収まったパッセージを整形したテキストのリスト
+    """
+    packed = []
+    used_tokens = 0
+    for passage in passages:
+        title = passage["document_title"]
+        formatted = f"[{len(packed) + 1}] {title}\n{passage['text'].strip()}"
+        tokens = estimateTokens(formatted)
+        # 上限を超えるパッセージは飛ばし、より短いパッセージが入るか試す
+        if used_tokens + tokens > token_budget:
+            continue
+        packed.append(formatted)
+        used_tokens += tokens
+    return packed
+
+
+def buildRagContext(passages, model_id):
+    """
+    パッセージからLLMに渡すコンテキストを構築する（署名付きURLはプロンプトに含めない）
+    :param passages: パッセージのリスト
+    :param model_id: BedrockのモデルID（トークン数の上限の決定に使用）
+    :return: コンテキストのテキスト
+    """
+    packed = packPassages(
+        dedupePassages(rankPassages(passages)), getContextTokenBudget(model_id)
+    )
+    if not packed:
+        return f"{RAG_CONTEXT_PREFIX}\n\n該当する検索結果はありませんでした。"
+    return f"{RAG_CONTEXT_PREFIX}\n\n" + "\n\n".join(packed)
@@ -0,0 +1,232 @@
+import concurrent.futures
+import hashlib
+
+from app_config import AppConfig
+from caches import TTLLRUCache
+from context_builder import ATTACHMENT_TOKEN_ESTIMATE, estimateTokens
+from image_preprocess import preprocessImage
+from model_router import routedConverse
+from prompt_cache import recordUsage
+from telemetry import submitWithContext
+
+"""
+大きな文書の分割要約（map-reduce）
+モデルの入力の上限を超える文書をページ範囲ごとのチャンクに分割し、
+チャンクごとの要約（map）を並列に行った上で、要約をまとめて質問への回答（reduce）を生成する
+回答は（文書のハッシュ値, 質問）ごとにキャッシュする
+"""
+
+# チャンクの要約を行うスレッドプール（全セッションで共有し、Bedrockへの同時呼び出し数を制限する）
+_map_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AppConfig.MAP_REDUCE_MAX_CONCURRENCY, thread_name_prefix="map-reduce"
+)
+
+# 生成済みの回答のキャッシュ {(文書のハッシュ値, 質問のハッシュ値, モデルID): 回答}
+_answer_cache = TTLLRUCache(
+    max_entries=AppConfig.MAP_REDUCE_CACHE_MAX_ENTRIES,
+    default_ttl_seconds=AppConfig.MAP_REDUCE_CACHE_TTL_SECONDS,
+)
+
+
+def needsMapReduce(pages):
+    """
+    分割要約が必要な文書かどうか（抽出したテキストのトークン数が上限を超えるかどうか）
+    :param pages: pdf_extract.extractPdfで抽出したページのリスト
+    :return: 分割要約が必要な場合はTrue
+    """
+    return AppConfig.MAP_REDUCE_ENABLED and (
+        sum(_pageTokens(page) for page in pages) > AppConfig.MAP_REDUCE_THRESHOLD_TOKENS
+    )
+
+
+def _pageTokens(page):
+    if page["image"] is not None:
+        return ATTACHMENT_TOKEN_ESTIMATE["image"]
+    return estimateTokens(page["text"])
+
+
+def splitIntoChunks(pages, chunk_tokens=None):
+    """
+    ページを、トークン数の上限に収まる連続したページ範囲（チャンク）に分割する
+    :param pages: pdf_extract.extractPdfで抽出したページのリスト
+    :param chunk_tokens: チャンクあたりのトークン数の上限（省略時はAppConfig.MAP_REDUCE_CHUNK_TOKENS）
+    :return: チャンク（ページのリスト）のリスト
+    """
+    chunk_tokens = chunk_tokens or AppConfig.MAP_REDUCE_CHUNK_TOKENS
+    chunks = []
+    current = []
+    current_tokens = 0
+    current_images = 0
+    for page in pages:
+        if page["image"] is None and not page["text"]:
+            continue
+        tokens = _pageTokens(page)
+        is_image = page["image"] is not None
+        # ConverseAPIは1リクエストあたりの画像の枚数にも上限があるため、画像の枚数でも区切る
+        if current and (
+            current_tokens + tokens > chunk_tokens
+            or current_images + is_image > AppConfig.PDF_SCANNED_PAGE_MAX_IMAGES
+        ):
+            chunks.append(current)
+            current, current_tokens, current_images = [], 0, 0
+        current.append(page)
+        current_tokens += tokens
+        current_images += is_image
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _converse(model_id, content, max_tokens):
+    response, _, _ = routedConverse(
+        {
+            "modelId": model_id,
+            "messages": [{"role": "user", "content": content}],
+            "inferenceConfig": {"maxTokens": max_tokens, "temperature": 0.2},
+        },
+        policy="fixed",
+        priority="bulk",
+    )
+    recordUsage(model_id, response.get("usage", {}))
+    return response["output"]["message"]["content"][0]["text"]
+
+
+def _summarizeChunk(model_id, chunk, question):
+    """
+    チャンク（ページ範囲）を、質問に関係する内容を中心に要約する
+    """
+    start_page = chunk[0]["page_number"]
+    end_page = chunk[-1]["page_number"]
+    content = [
+        {
+            "text": (
+                f"以下は文書の{start_page}〜{end_page}ページです。"
+                f"後で「{question}」という質問に回答するため、"
+                "この範囲の重要な事実・数値・固有名詞を残して簡潔に日本語で要約してください。"
+            )
+        }
+    ]
+    for page in chunk:
+        if page["image"] is not None:
+            image_bytes, image_format = preprocessImage(page["image"])
+            content.append({"text": f"--- {page['page_number']}ページ（スキャン） ---"})
+            content.append(
+                {"image": {"format": image_format, "source": {"bytes": image_bytes}}}
+            )
+        else:
+            content.append(
+                {"text": f"--- {page['page_number']}ページ ---\n{page['text']}"}
+            )
+    summary = _converse(model_id, content, AppConfig.MAP_REDUCE_SUMMARY_MAX_TOKENS)
+    return f"【{start_page}〜{end_page}ページ】\n{summary}"
+
+
+def _combineSummaries(model_id, summaries, question):
+    """
+    複数のチャンクの要約を、1つの要約にまとめる（要約が多すぎる場合の中間段階）
+    """
+    content = [
+        {
+            "text": (
+                f"以下は文書の各部分の要約です。後で「{question}」という質問に回答するため、"
+                "ページ範囲の表記を残して1つの要約にまとめてください。\n\n"
+                + "\n\n".join(summaries)
+            )
+        }
+    ]
+    return _converse(model_id, content, AppConfig.MAP_REDUCE_SUMMARY_MAX_TOKENS)
+
+
+def _groupSummaries(summaries, max_tokens):
+    groups = []
+    current = []
+    current_tokens = 0
+    for summary in summaries:
+        tokens = estimateTokens(summary)
+        if current and current_tokens + tokens > max_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(summary)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def mapReduceSummarize(pages, question, document_hash, model_id=None, on_progress=None):
+    """
+    大きな文書をチャンクに分割して並列に要約し、要約をまとめて質問への回答を生成する
+    :param pages: pdf_extract.extractPdfで抽出したページのリスト
+    :param question: ユーザーの質問
+    :param document_hash: 文書の内容のハッシュ値（回答のキャッシュのキーに使用）
+    :param model_id: BedrockのモデルID（省略時はAppConfig.MAP_REDUCE_MODEL_KEYのモデル）
+    :param on_progress: 進捗の通知先 on_progress(完了した処理数, 全体の処理数)。呼び出し元のスレッドで呼ばれる
+    :return: 回答
+    """
+    model_id = model_id or AppConfig.MODEL_ID_DICT[AppConfig.MAP_REDUCE_MODEL_KEY]
+    question_hash = hashlib.sha256(question.strip().encode("utf-8")).hexdigest()
+    cache_key = (document_hash, question_hash, model_id)
+    cached = _answer_cache.get(cache_key)
+    if cached is not None:
+        if on_progress:
+            on_progress(1, 1)
+        return cached
+
+    chunks = splitIntoChunks(pages)
+    # 全体の処理数は、チャンクの要約と最後の回答生成（中間のまとめは都度加算する）
+    total = len(chunks) + 1
+    completed = 0
+
+    # map: チャンクごとの要約を並列に行う（結果はページ順に並べる）
+    futures = {
+        submitWithContext(_map_executor, _summarizeChunk, model_id, chunk, question): i
+        for i, chunk in enumerate(chunks)
+    }
+    summaries = [None] * len(chunks)
+    for future in concurrent.futures.as_completed(futures):
+        summaries[futures[future]] = future.result()
+        completed += 1
+        if on_progress:
+            on_progress(completed, total)
+
+    # 要約の合計が1回の入力に収まらない場合は、段階的にまとめる
+    while (
+        len(summaries) > 1
+        and estimateTokens("\n\n".join(summaries)) > AppConfig.MAP_REDUCE_CHUNK_TOKENS
+    ):
+        groups = _groupSummaries(summaries, AppConfig.MAP_REDUCE_CHUNK_TOKENS)
+        # 要約1件ずつのグループしか作れない場合は、それ以上まとめられない
+        if len(groups) == len(summaries):
+            break
+        total += len(groups)
+        summaries = [
+            future.result()
+            for future in [
+                submitWithContext(
+                    _map_executor, _combineSummaries, model_id, group, question
+                )
+                for group in groups
+            ]
+        ]
+        completed += len(groups)
+        if on_progress:
+            on_progress(completed, total)
+
+    # reduce: 要約から質問への回答を生成する
+    content = [
+        {
+            "text": (
+                "以下は、アップロードされた文書をページ範囲ごとに要約したものです。"
+                "この要約に基づいて質問に回答してください。"
+                "根拠となるページ範囲がわかる場合は併記してください。\n\n"
+                + "\n\n".join(summaries)
+                + f"\n\n【質問】\n{question}"
+            )
+        }
+    ]
+    answer = _converse(model_id, content, AppConfig.INFERENCE_CONFIG_DICT["maxTokens"])
+    if on_progress:
+        on_progress(total, total)
+
+    _answer_cache.put(cache_key, answer)
+    return answer
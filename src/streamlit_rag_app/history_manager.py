@@ -0,0 +1,172 @@
+import concurrent.futures
+import logging
+import threading
+
+from app_config import AppConfig
+from context_builder import RAG_CONTEXT_PREFIX, estimateMessageTokens, getModelKey
+from model_router import routedConverse
+
+"""
+会話履歴の管理
+ConverseAPIに渡す会話履歴を、モデルごとのトークン数の上限に収まる直近の範囲（スライディングウィンドウ）に絞り込む
+古い検索結果のコンテキストや「準備中...」のダミーの応答は取り除き、
+ウィンドウから外れた古い会話は、必要に応じてバックグラウンドで要約してシステムプロンプトに含める
+"""
+
+logger = logging.getLogger(__name__)
+
+# 会話のロールを交互にするために挿入される、ダミーの応答の文言
+PLACEHOLDER_TEXT = "準備中..."
+
+# 古い会話の要約を行うスレッドプール（全セッションで共有）
+_summary_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="history-summary"
+)
+
+
+def _messageText(message):
+    """
+    メッセージに含まれるテキストを連結して返す
+    """
+    return "\n".join(block["text"] for block in message["content"] if "text" in block)
+
+
+def removeStaleTurns(history):
+    """
+    会話履歴から、過去の検索結果のコンテキストと「準備中...」のダミーの応答を取り除く
+    userとassistantが交互になるよう、取り除くメッセージと対になるuserのメッセージも合わせて取り除く
+    :param history: 会話履歴
+    :return: 取り除いた後の会話履歴（新しいリスト）
+    """
+    cleaned = []
+    skip_next = False
+    for i, message in enumerate(history):
+        if skip_next:
+            skip_next = False
+            continue
+        text = _messageText(message) if message["role"] == "assistant" else ""
+        # 検索結果のコンテキストと、その直後の（重複した）質問を取り除く
+        if text.startswith(RAG_CONTEXT_PREFIX) and i + 1 < len(history):
+            skip_next = True
+            continue
+        # ダミーの応答と、その直前の（重複した）質問を取り除く
+        if text == PLACEHOLDER_TEXT and cleaned and cleaned[-1]["role"] == "user":
+            cleaned.pop()
+            continue
+        cleaned.append(message)
+    return cleaned
+
+
+class HistoryManager:
+    """
+    セッション（タブ）ごとの会話履歴の管理クラス
+    st.session_stateに保持し、ConverseAPIを呼び出すたびにbuildMessagesで送信する会話履歴を組み立てる
+    """
+
+    def __init__(self, summarize=None):
+        """
+        :param summarize: ウィンドウから外れた会話を要約するかどうか（省略時はAppConfig.HISTORY_SUMMARIZE_ENABLED）
+        """
+        self.summarize = (
+            summarize if summarize is not None else AppConfig.HISTORY_SUMMARIZE_ENABLED
+        )
+        # ウィンドウから外れた会話の要約と、要約済みのメッセージ数
+        self.summary = ""
+        self._summarized_count = 0
+        self._summary_future = None
+        self._lock = threading.Lock()
+
+    def buildMessages(self, history, model_id, reserved_tokens=0):
+        """
+        ConverseAPIに渡す会話履歴を組み立てる（元の会話履歴は変更しない）
+        :param history: 会話履歴（userから始まり、userとassistantが交互であること）
+        :param model_id: BedrockのモデルID（トークン数の上限の決定に使用）
+        :param reserved_tokens: 会話履歴以外（検索結果のコンテキストなど）に使用するトークン数
+        :return: トークン数の上限に収まる直近の会話履歴
+        """
+        cleaned = removeStaleTurns(history)
+        token_budget = (
+            AppConfig.HISTORY_TOKEN_BUDGET_DICT.get(
+                getModelKey(model_id), AppConfig.HISTORY_DEFAULT_TOKEN_BUDGET
+            )
+            - reserved_tokens
+        )
+
+        # 新しいメッセージから順に、上限に収まる範囲を求める（最新のメッセージは必ず含める）
+        start = len(cleaned)
+        used_tokens = 0
+        while start > 0:
+            tokens = estimateMessageTokens(cleaned[start - 1])
+            if start < len(cleaned) and used_tokens + tokens > token_budget:
+                break
+            used_tokens += tokens
+            start -= 1
+        # ウィンドウはuserのメッセージから始める
+        while start < len(cleaned) - 1 and cleaned[start]["role"] != "user":
+            start += 1
+
+        if self.summarize and start > 0:
+            self._summarizeAsync(cleaned[:start])
+        return cleaned[start:]
+
+    def getSummarySystemPrompt(self):
+        """
+        ウィンドウから外れた会話の要約を、システムプロンプトに追加する形式で返す
+        :return: システムプロンプトのリスト（要約がない場合は空のリスト）
+        """
+        with self._lock:
+            summary = self.summary
+        if not summary:
+            return []
+        return [{"text": f"【これまでの会話の要約】\n{summary}"}]
+
+    def _summarizeAsync(self, dropped_messages):
+        """
+        ウィンドウから外れた会話のうち、未要約の部分をバックグラウンドで要約する
+        （要約中の場合は、次回の呼び出し時に改めて要約する）
+        :param dropped_messages: ウィンドウから外れた会話
+        """
+        with self._lock:
+            if len(dropped_messages) <= self._summarized_count:
+                return
+            if self._summary_future is not None and not self._summary_future.done():
+                return
+            new_messages = dropped_messages[self._summarized_count :]
+            self._summary_future = _summary_executor.submit(
+                self._summarize, self.summary, new_messages, len(dropped_messages)
+            )
+
+    def _summarize(self, previous_summary, new_messages, summarized_count):
+        """
+        これまでの要約と新たにウィンドウから外れた会話から、新しい要約を生成する
+        """
+        conversation = "\n".join(
+            f"{message['role']}: {_messageText(message)}" for message in new_messages
+        )
+        prompt = (
+            "以下の「これまでの要約」と「会話」を、後続の会話で参照できるよう、"
+            "重要な事実・質問・回答を残して簡潔に日本語で要約してください。\n\n"
+            f"【これまでの要約】\n{previous_summary or 'なし'}\n\n【会話】\n{conversation}"
+        )
+        try:
+            response, _, _ = routedConverse(
+                {
+                    "modelId": AppConfig.MODEL_ID_DICT[
+                        AppConfig.HISTORY_SUMMARY_MODEL_KEY
+                    ],
+                    "messages": [{"role": "user", "content": [{"text": prompt}]}],
+                    "inferenceConfig": {
+                        "maxTokens": AppConfig.HISTORY_SUMMARY_MAX_TOKENS,
+                        "temperature": 0.2,
+                    },
+                },
+                policy="fixed",
+                priority="bulk",
+            )
+            summary = response["output"]["message"]["content"][0]["text"]
+        except Exception as e:
+            logger.warning("Error summarizing history: %s", e)
+            return
+        with self._lock:
+            self.summary = summary
+            self._summarized_count = summarized_count
@@ -0,0 +1,71 @@
+import hashlib
+import io
+
+from app_config import AppConfig
+from caches import TTLLRUCache
+from PIL import Image, ImageOps
+
+"""
+Amazon Bedrockに送信する前の画像の前処理
+モデルが実際に使用する解像度まで縮小し、メタデータ（EXIFなど）を取り除いた上で、
+サイズ効率のよい形式で再エンコードする（同じ画像の前処理結果はハッシュ値をキーとしてキャッシュする）
+"""
+
+# 前処理済みの画像のキャッシュ {画像のハッシュ値: (画像の内容, 形式)}
+_preprocessed_cache = TTLLRUCache(
+    max_entries=AppConfig.IMAGE_PREPROCESS_CACHE_MAX_ENTRIES
+)
+
+
+def preprocessImage(image_bytes):
+    """
+    画像を縮小・再エンコードする
+    透過情報を持つ画像はPNG、それ以外はAppConfig.IMAGE_OUTPUT_FORMATの形式で再エンコードする
+    :param image_bytes: アップロードされた画像の内容
+    :return: (前処理後の画像の内容, 形式（"jpeg"または"png"）)
+    """
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    cached = _preprocessed_cache.get(content_hash)
+    if cached is not None:
+        return cached
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # EXIFの回転情報を画像に反映してから、メタデータを取り除く
+        image = ImageOps.exif_transpose(image)
+
+        # 長辺と総画素数が、モデルが使用する解像度に収まるように縮小する（アスペクト比は維持）
+        max_edge = AppConfig.IMAGE_MAX_LONG_EDGE_PIXELS
+        scale = min(
+            1.0,
+            max_edge / max(image.size),
+            (AppConfig.IMAGE_MAX_PIXELS / (image.width * image.height)) ** 0.5,
+        )
+        if scale < 1.0:
+            new_size = (
+                max(1, int(image.width * scale)),
+                max(1, int(image.height * scale)),
+            )
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        output = io.BytesIO()
+        if has_alpha:
+            output_format = "png"
+            image.convert("RGBA").save(output, format="PNG", optimize=True)
+        else:
+            output_format = AppConfig.IMAGE_OUTPUT_FORMAT
+            if output_format == "jpeg":
+                image.convert("RGB").save(
+                    output,
+                    format="JPEG",
+                    quality=AppConfig.IMAGE_JPEG_QUALITY,
+                    optimize=True,
+                )
+            else:
+                image.save(output, format="PNG", optimize=True)
+
+    result = (output.getvalue(), output_format)
+    _preprocessed_cache.put(content_hash, result)
+    return result
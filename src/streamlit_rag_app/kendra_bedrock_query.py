@@ -1,10 +1,45 @@
+import concurrent.futures
+import hashlib
+import logging
 import os
+import threading
+import time
 import urllib
 
-import boto3
 from app_config import AppConfig
-from botocore.client import Config
-from dotenv import load_dotenv
+from attachment_store import (
+    getAttachmentStore,
+    makeAttachmentRef,
+    resolveAttachments,
+)
+from aws_clients import getKendraClient, getS3Client
+from bedrock_scheduler import getSchedulerStats
+from caches import PresignedUrlCache
+from context_builder import (
+    buildRagContext,
+    estimateTokens,
+    extractPassagesFromQuery,
+    extractPassagesFromRetrieve,
+)
+from doc_summarizer import mapReduceSummarize, needsMapReduce
+from history_manager import HistoryManager
+from image_preprocess import preprocessImage
+from model_router import getRouterStats, routedConverse
+from pdf_extract import buildPdfText, extractPdf, isTextBasedPdf
+from prompt_cache import applyPromptCache, getUsageStats, recordUsage
+from region_pool import region_pool
+from s3_index import S3KeyIndex
+from startup import startup_report
+from telemetry import (
+    getRequestId,
+    recordSpan,
+    renderPrometheus,
+    retryAttempts,
+    span,
+    stage_metrics,
+    submitWithContext,
+    traced,
+)
 
 """
 Step2 Kendra RAG検索/マルチモーダル
@@ -14,129 +49,381 @@ Step2 Kendra RAG検索/マルチモーダル
 
 """
 
-# 環境変数の読み込み
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 
-# boto3セッションの定義
-boto3_session = boto3.session.Session(profile_name=os.getenv("profile_name"))
+# 署名付きURL生成（S3への存在確認・署名）用のスレッドプール（全セッションで共有）
+_presign_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AppConfig.PRESIGN_MAX_WORKERS, thread_name_prefix="presign"
+)
 
+# RAG検索のパイプラインで、LLMの回答生成と並行して署名付きURLを生成するスレッドプール（全セッションで共有）
+_pipeline_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AppConfig.PIPELINE_MAX_WORKERS, thread_name_prefix="rag-pipeline"
+)
 
-# リトライ設定の作成（Amazon Bedrock ConverseAPI利用時のThrottlingエラー回避策）
-retries_config = Config(AppConfig.RETRY_CONFIGS)
+# 署名付きURLのキャッシュ（よく参照されるドキュメントの存在確認・署名を省略するため、全セッションで共有）
+presigned_url_cache = PresignedUrlCache(
+    max_entries=AppConfig.PRESIGNED_URL_CACHE_MAX_ENTRIES,
+    expires_in_seconds=AppConfig.PRESIGNED_URL_EXPIRES_IN_SECONDS,
+    min_remaining_seconds=AppConfig.PRESIGNED_URL_MIN_REMAINING_SECONDS,
+)
 
+# PDFファイル（hogehoge/配下）の存在確認用インデックス（初回の署名付きURL生成時に構築を開始）
+_pdf_key_index = None
+_pdf_key_index_lock = threading.Lock()
 
-# Bedrock clientの初期化
-bedrock = boto3_session.client(
-    "bedrock-runtime",
-    region_name=AppConfig.REGION_NAME_DICT["oregon"],
-    config=retries_config,
-)
-# デバッグ用
-# print(bedrock)
 
+class ConverseStream:
+    """
+    ConverseStream APIのレスポンスを、テキストの差分を返すジェネレータとして扱うクラス
+    イテレートするとテキストの差分を順に返し、イテレート完了後に最終的な回答(text)と
+    トークン使用量(usage)を参照できる（st.write_streamにそのまま渡すことができる）
+    """
 
-# RAG検索を行う関数
-def ragSearch(
-    question, history, selected_model_id, selected_temperature, selected_category_key
+    def __init__(self, response, model_id=None, started_at=None, reconcile_usage=None):
+        """
+        :param response: bedrock.converse_streamのレスポンス
+        :param model_id: BedrockのモデルID（指定した場合、トークン使用量を累計に記録する）
+        :param started_at: ConverseStreamAPIの呼び出しを開始した時刻（time.perf_counter基準）
+        :param reconcile_usage: 流量制御のトークン数を、実際の使用量で補正する関数 reconcile_usage(実際のトークン数)
+        """
+        self._event_stream = response["stream"]
+        self.model_id = model_id
+        self.reconcile_usage = reconcile_usage
+        self.text = ""
+        self.usage = {}
+        self.metrics = {}
+        self.stop_reason = None
+        # 最初/最後のテキストを受け取るまでの時間（秒。ConverseStreamAPIの呼び出し開始から計測）
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.first_token_seconds = None
+        self.total_seconds = None
+        # ストリームは呼び出し元の関数を抜けた後に読み込まれるため、計測用のリクエストIDを保持しておく
+        self.request_id = getRequestId()
+
+    def __iter__(self):
+        chunks = []
+        try:
+            for event in self._event_stream:
+                delta_text = self._handleEvent(event)
+                if delta_text:
+                    # テキストの差分を受け取り次第、呼び出し元に返す
+                    chunks.append(delta_text)
+                    yield delta_text
+        except Exception as e:
+            self._recordFailure(type(e).__name__)
+            raise
+        self._finish(chunks)
+
+    def _handleEvent(self, event):
+        """
+        ストリームのイベント1件を処理する（同期/非同期のストリームで共通）
+        :param event: ConverseStreamAPIのイベント
+        :return: テキストの差分（テキスト以外のイベントの場合はNone）
+        """
+        if "contentBlockDelta" in event:
+            delta_text = event["contentBlockDelta"]["delta"].get("text")
+            if delta_text and self.first_token_seconds is None:
+                self.first_token_seconds = time.perf_counter() - self.started_at
+                recordSpan(
+                    "bedrock.stream.first_token",
+                    self.first_token_seconds,
+                    request_id=self.request_id,
+                    model_id=self.model_id,
+                )
+            return delta_text
+        if "messageStop" in event:
+            self.stop_reason = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            # ストリームの最後にトークン使用量とレイテンシが返却される
+            self.usage = event["metadata"].get("usage", {})
+            self.metrics = event["metadata"].get("metrics", {})
+            if self.model_id:
+                recordUsage(self.model_id, self.usage)
+            if self.reconcile_usage and "totalTokens" in self.usage:
+                self.reconcile_usage(self.usage["totalTokens"])
+        return None
+
+    def _recordFailure(self, error_name):
+        recordSpan(
+            "bedrock.stream.last_token",
+            time.perf_counter() - self.started_at,
+            request_id=self.request_id,
+            model_id=self.model_id,
+            error=error_name,
+        )
+
+    def _finish(self, chunks):
+        # 最終的に画面に表示する回答
+        self.total_seconds = time.perf_counter() - self.started_at
+        recordSpan(
+            "bedrock.stream.last_token",
+            self.total_seconds,
+            request_id=self.request_id,
+            model_id=self.model_id,
+            stop_reason=self.stop_reason,
+            input_tokens=self.usage.get("inputTokens"),
+            output_tokens=self.usage.get("outputTokens"),
+            cache_read_tokens=self.usage.get("cacheReadInputTokens"),
+        )
+        self.text = "".join(chunks)
+        if not self.text:
+            raise ValueError("Bedrock response content is empty.")
+
+
+class RagPipelineResult:
+    """
+    RAG検索のパイプライン（ragSearchPipeline）の結果
+    LLMの回答（answer、またはstream）と並行して署名付きURLの生成が進むため、
+    signed_urlsは参照した時点で生成の完了を待つ
+    """
+
+    def __init__(
+        self,
+        answer,
+        stream,
+        signed_urls_future,
+        has_more,
+        timings,
+        presign_timings,
+        model_id=None,
+    ):
+        """
+        :param answer: LLMの回答（ストリーミングモードの場合はNone）
+        :param stream: LLMの回答のConverseStream（ストリーミングモードでない場合はNone）
+        :param signed_urls_future: 署名付きURLのリストを返すFuture
+        :param has_more: 検索結果の次のページが存在するかどうか
+        :param timings: ステージごとの処理時間（秒）
+        :param presign_timings: 署名付きURLの生成の処理時間（生成の完了時に記録される）
+        :param model_id: 実際に回答したモデルのID（ルーティングにより、選択したモデルと異なる場合がある）
+        """
+        self.answer = answer
+        self.stream = stream
+        self.model_id = model_id
+        self.has_more = has_more
+        self._signed_urls_future = signed_urls_future
+        self._timings = timings
+        self._presign_timings = presign_timings
+
+    @property
+    def signed_urls(self):
+        """
+        署名付きURLのリスト（生成が完了していない場合は完了を待つ）
+        """
+        return self._signed_urls_future.result()
+
+    @property
+    def timings(self):
+        """
+        ステージごとの処理時間（秒）
+        kendra_query, context, presign（完了後のみ）, llm（ストリーミングの場合は
+        llm_first_token, llm_total。ストリームの読み込み完了後のみ）
+        """
+        timings = dict(self._timings)
+        timings.update(self._presign_timings)
+        if self.stream is not None and self.stream.total_seconds is not None:
+            timings["llm_first_token"] = self.stream.first_token_seconds
+            timings["llm_total"] = self.stream.total_seconds
+        return timings
+
+
+# RAG検索のパイプライン（署名付きURLの生成をLLMの回答生成と並行して行う）
+@traced("rag_search")
+def ragSearchPipeline(
+    question,
+    history,
+    selected_model_id,
+    selected_temperature,
+    selected_category_key,
+    stream=False,
+    query_cache=None,
+    history_manager=None,
 ):
     """
-    Kendraの query APIを使用して、その回答をLLMに渡す関数
+    RAG検索を、Kendra検索 → (LLMによる回答生成 ∥ 署名付きURLの生成) → 画面表示 のパイプラインで実行する
+    署名付きURLは画面表示にのみ使用するため、LLMの回答生成と並行して生成する
     :param question: ユーザーの質問
     :param history: ユーザーの会話履歴
     :param selected_model_id ユーザーが画面で選択したClaudeのモデル
     :param selected_temperature ユーザーが画面で選択した「振る舞い」（temperature）の値
     :param selected_category_key 画面上で選択された検索対象のドキュメントのkey（KendraのAttributeFilterで絞り込みに使用される値)
-    :return: 過去の会話履歴+ユーザーの質問を踏まえて、LLMによって生成された回答
+    :param stream: Trueの場合、回答をConverseStream（テキストの差分を返すジェネレータ）として返す
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: RagPipelineResult
     """
+    timings = {}
 
-    # kendra clientの初期化
-    kendra = boto3_session.client(
-        "kendra", region_name=AppConfig.REGION_NAME_DICT["oregon"]
+    # 会話の順番が`user`と`assistant`となるように制御
+    validateHistoryRoles(history)
+
+    # queryAPIを使ってKendraを呼び出す（キャッシュ済みの場合はキャッシュから取得）
+    # （最初の1ページ分のみ取得し、以降のページは画面で要求された時点で取得する）
+    stage_started = time.perf_counter()
+    kendra_response = queryKendra(
+        question,
+        selected_category_key,
+        query_cache,
+        page_size=AppConfig.SEARCH_RESULTS_PAGE_SIZE,
     )
+    timings["kendra_query"] = time.perf_counter() - stage_started
 
-    # ユーザーが選択したカテゴリの値に応じて、検索条件を動的に構築
-    # デフォルトは検索条件の絞り込みなし（_language_codeの絞り込みのみ）
-    attribute_filter = {
-        "AndAllFilters": [
-            {"EqualsTo": {"Key": "_language_code", "Value": {"StringValue": "ja"}}}
-        ]
-    }
-    # 絞込み条件の追加
-    additional_attribute_filter = {
-        "OrAllFilters": [
-            {
-                "EqualsTo": {
-                    "Key": "_category",
-                    "Value": {"StringValue": selected_category_key},
-                }
-            }
-        ]
-    }
-    # 「全て」以外が選択された時は検索条件の絞り込みを行う
-    if selected_category_key != "all":
-        attribute_filter["AndAllFilters"].append(additional_attribute_filter)
+    # デバッグ用:print(kendra_response)
 
-    # queryAPIを使ってKendraを呼び出す
-    kendra_response = kendra.query(
-        IndexId=os.getenv("kendra_index"),  # Put INDEX in .env file
-        QueryText=question,
-        PageNumber=1,
-        PageSize=30,
-        AttributeFilter=attribute_filter,
+    # ドキュメントのメタデータを取得し、署名付きURLを生成（LLMの回答生成と並行して実行）
+    presign_timings = {}
+    signed_urls_future = submitWithContext(
+        _pipeline_executor, _timedGenerateSignedUrls, kendra_response, presign_timings
     )
 
-    # デバッグ用:print(kendra_response)
+    # 検索結果のパッセージから、コンテキストと会話履歴を含むConverseAPIの引数を組み立てる
+    stage_started = time.perf_counter()
+    if AppConfig.RAG_CONTEXT_SOURCE == "retrieve":
+        passages = extractPassagesFromRetrieve(
+            retrieveKendraPassages(question, selected_category_key, query_cache)
+        )
+    else:
+        passages = extractPassagesFromQuery(kendra_response)
+    converse_kwargs, context_tokens = buildRagConverseKwargs(
+        question,
+        history,
+        selected_model_id,
+        selected_temperature,
+        passages,
+        history_manager,
+    )
+    timings["context"] = time.perf_counter() - stage_started
+    recordSpan(
+        "rag.context",
+        timings["context"],
+        result_count=len(passages),
+        context_tokens=context_tokens,
+        message_count=len(converse_kwargs["messages"]),
+    )
 
-    # ドキュメントのメタデータを取得し、署名付きURLを生成
-    signed_urls = generateSignedUrls(kendra_response)
-    # デバッグ用
-    # print(signed_urls)
+    # デバッグ用（会話履歴の確認。DEBUGレベルのログを有効にした場合のみ出力する）
+    logger.debug("messages: %s", converse_kwargs["messages"])
+
+    has_more = hasMoreResults(kendra_response, 1, AppConfig.SEARCH_RESULTS_PAGE_SIZE)
 
-    # 参照ドキュメントを生成 回答の参照ドキュメントが画面に出力されてしまうためマークダウンで表示できるよう整形
-    document_references = "\n".join(
-        [f"- [{doc['document_name']}]({doc['signed_url']})" for doc in signed_urls]
+    # ストリーミングモードの場合は、ConverseStreamAPIで回答の差分を逐次受け取る
+    stage_started = time.perf_counter()
+    # （選択したモデルが飽和している場合は、ルーティングにより代替モデルで回答する）
+    routing_policy = AppConfig.MODEL_ROUTING_POLICY_DICT["rag_search"]
+    if stream:
+        response, answered_model_id, reconcile_usage = routedConverse(
+            converse_kwargs, routing_policy, stream=True
+        )
+        answer_stream = ConverseStream(
+            response, answered_model_id, stage_started, reconcile_usage
+        )
+        return RagPipelineResult(
+            None,
+            answer_stream,
+            signed_urls_future,
+            has_more,
+            timings,
+            presign_timings,
+            model_id=answered_model_id,
+        )
+
+    # ConverseAPIに会話履歴を渡した上で質問を行う
+    response, answered_model_id, _ = routedConverse(converse_kwargs, routing_policy)
+    timings["llm"] = time.perf_counter() - stage_started
+    # デバッグ用
+    # print(f"Converse API response: {response}")
+    # レスポンスの中身チェックと、トークン使用量（キャッシュの読み込み/書き込みトークン数を含む）の記録
+    answer = parseConverseAnswer(response, answered_model_id)
+    return RagPipelineResult(
+        answer,
+        None,
+        signed_urls_future,
+        has_more,
+        timings,
+        presign_timings,
+        model_id=answered_model_id,
     )
 
-    # Claudeモデルに渡すシステムプロンプトを定義
-    system_prompt = AppConfig.SYSTEM_PROMPT
 
-    # 会話の順番が`user`と`assistant`となるように制御
+def validateHistoryRoles(history):
+    """
+    会話履歴のロールが`user`と`assistant`で交互になっているかを確認する
+    :param history: ユーザーの会話履歴
+    """
     for i in range(len(history) - 1):
         if history[i]["role"] == history[i + 1]["role"]:
             raise ValueError(
                 "会話履歴のロールはuserとassistantで交互である必要があります。"
             )
-    # デバッグ用
-    # print(f"messages:{messages}")
 
-    # 現在の質問と検索結果を会話履歴に追加
+
+def buildRagConverseKwargs(
+    question,
+    history,
+    selected_model_id,
+    selected_temperature,
+    passages,
+    history_manager=None,
+):
+    """
+    RAG検索で使用する、ConverseAPIの引数を組み立てる（同期/非同期のRAG検索で共通）
+    検索結果のパッセージからトークン数の上限に収まるコンテキストを構築し、会話履歴・質問と合わせて送信するメッセージとする
+    :param question: ユーザーの質問
+    :param history: ユーザーの会話履歴
+    :param selected_model_id ユーザーが画面で選択したClaudeのモデル
+    :param selected_temperature ユーザーが画面で選択した「振る舞い」（temperature）の値
+    :param passages: 検索結果のパッセージ（extractPassagesFromQuery/extractPassagesFromRetrieveの結果）
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: (ConverseAPIの引数の辞書, コンテキストのトークン数)
+    """
+    # 検索結果の本文の抜粋から、トークン数の上限に収まるコンテキストを構築
+    # （署名付きURLは画面表示にのみ使用し、プロンプトには含めない）
+    rag_context = buildRagContext(passages, selected_model_id)
+    context_tokens = estimateTokens(rag_context)
+
+    # トークン数の上限に収まる直近の会話履歴を取得（session stateの会話履歴は変更しない）
+    history_manager = history_manager or HistoryManager(summarize=False)
+    messages = history_manager.buildMessages(
+        history, selected_model_id, reserved_tokens=context_tokens
+    )
+
+    # Claudeモデルに渡すシステムプロンプトを定義（古い会話の要約がある場合は追加）
+    system_prompt = AppConfig.SYSTEM_PROMPT + history_manager.getSummarySystemPrompt()
+
+    # 現在の質問と検索結果を、送信する会話履歴に追加
     context_message = {
         "role": "assistant",
-        "content": [{"text": f"Kendra検索結果:\n\n{document_references}"}],
+        "content": [{"text": rag_context}],
     }
-    history.append(context_message)
+    messages.append(context_message)
 
     question_message = {"role": "user", "content": [{"text": question}]}
-    history.append(question_message)
+    messages.append(question_message)
 
-    # デバッグ用（会話履歴の確認
-    print("-----------------------")
-    print(f"history:{history}")
-    print("-----------------------")
+    # システムプロンプトと過去の会話履歴（今回の検索結果と質問より前）にキャッシュのチェックポイントを置く
+    system_prompt, messages = applyPromptCache(
+        selected_model_id,
+        system_prompt,
+        messages,
+        stable_message_count=len(messages) - 2,
+    )
+    converse_kwargs = {
+        "modelId": selected_model_id,
+        "messages": messages,
+        "system": system_prompt,
+        "inferenceConfig": {"temperature": selected_temperature},
+    }
+    return converse_kwargs, context_tokens
 
-    # # デバッグ用
-    # # print(bedrock)
 
-    # ConverseAPIに会話履歴を渡した上で質問を行う
-    response = bedrock.converse(
-        modelId=selected_model_id,
-        messages=history,
-        system=system_prompt,
-        inferenceConfig={"temperature": selected_temperature},
-    )
-    # デバッグ用
-    # print(f"Converse API response: {response}")
+def parseConverseAnswer(response, model_id):
+    """
+    ConverseAPIのレスポンスから回答を取り出し、トークン使用量を記録する
+    :param response: ConverseAPIのレスポンス
+    :param model_id: 回答したモデルのID
+    :return: 回答のテキスト
+    """
     # レスポンスの中身チェック
     if (
         "content" not in response["output"]["message"]
@@ -144,27 +431,138 @@ def ragSearch(
     ):
         raise ValueError("Bedrock response content is empty.")
 
+    recordUsage(model_id, response.get("usage", {}))
     # 最終的に画面に表示する回答
-    answer = response["output"]["message"]["content"][0]["text"]
-    return answer, signed_urls
+    return response["output"]["message"]["content"][0]["text"]
+
+
+def _timedGenerateSignedUrls(kendra_response, presign_timings):
+    """
+    署名付きURLを生成し、処理時間をpresign_timingsに記録する（パイプラインのステージとして実行）
+    """
+    stage_started = time.perf_counter()
+    try:
+        return generateSignedUrls(kendra_response)
+    finally:
+        presign_timings["presign"] = time.perf_counter() - stage_started
+
+
+# RAG検索を行う関数
+def ragSearch(
+    question,
+    history,
+    selected_model_id,
+    selected_temperature,
+    selected_category_key,
+    stream=False,
+    query_cache=None,
+    history_manager=None,
+):
+    """
+    Kendraの query APIを使用して、その回答をLLMに渡す関数
+    （ragSearchPipelineの結果を、回答と署名付きURLの組として返す）
+    stream=Trueの場合は、署名付きURLの生成を待たずに回答のストリームを返すため、
+    署名付きURLの代わりにRagPipelineResultを返す（ストリームの読み込み後にsigned_urlsを参照する）
+    :param question: ユーザーの質問
+    :param history: ユーザーの会話履歴
+    :param selected_model_id ユーザーが画面で選択したClaudeのモデル
+    :param selected_temperature ユーザーが画面で選択した「振る舞い」（temperature）の値
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey（KendraのAttributeFilterで絞り込みに使用される値)
+    :param stream: Trueの場合、回答をConverseStream（テキストの差分を返すジェネレータ）として返す
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: 過去の会話履歴+ユーザーの質問を踏まえて、LLMによって生成された回答, 署名付きURL
+        （stream=Trueの場合はConverseStream, RagPipelineResult）
+    """
+    result = ragSearchPipeline(
+        question,
+        history,
+        selected_model_id,
+        selected_temperature,
+        selected_category_key,
+        stream=stream,
+        query_cache=query_cache,
+        history_manager=history_manager,
+    )
+    if stream:
+        return result.stream, result
+    return result.answer, result.signed_urls
 
 
 # Kendra検索時に使用する関数
-def kendraSearch(kendra_query, selected_category_key):
+@traced("kendra_search")
+def kendraSearch(kendra_query, selected_category_key, query_cache=None, page_number=1):
     """
     Kendra検索用の関数
-    queryAPIを使った検索のみを行い、検索結果と、メタデータから署名付きURLを生成し、返却する
+    queryAPIを使った検索のみを行い、指定したページの検索結果と、メタデータから署名付きURLを生成し、返却する
     :param question: ユーザーが画面で入力した質問
     :param selected_category_key 画面上で選択された検索対象のドキュメントのkey（KendraのAttributeFilterで絞り込みに使用される値)
-    :return: 署名つきURL
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param page_number: 取得するページ番号（1ページあたりの件数はAppConfig.SEARCH_RESULTS_PAGE_SIZE）
+    :return: 署名つきURL, 次のページが存在するかどうか
     """
+    page_size = AppConfig.SEARCH_RESULTS_PAGE_SIZE
 
-    # Kendra clientの初期化
-    kendra = boto3_session.client(
-        "kendra", region_name=AppConfig.REGION_NAME_DICT["oregon"]
+    # Kendraの queryAPIの呼び出し（キャッシュ済みの場合はキャッシュから取得）
+    kendra_response = queryKendra(
+        kendra_query,
+        selected_category_key,
+        query_cache,
+        page_number=page_number,
+        page_size=page_size,
     )
 
-    # ユーザーが選択したカテゴリの値に応じて、検索条件を動的に構築
+    # デバッグ用
+    # print(kendra_response)
+    # 署名付きURLを取得
+    signed_urls = generateSignedUrls(kendra_response)
+    # デバッグ用
+    # print(f"署名つきURL:{signed_urls}")
+
+    return signed_urls, hasMoreResults(kendra_response, page_number, page_size)
+
+
+def hasMoreResults(kendra_response, page_number, page_size):
+    """
+    表示する検索結果の上限（AppConfig.SEARCH_RESULTS_MAX_COUNT）までに、次のページが存在するか
+    """
+    total_count = min(
+        kendra_response.get("TotalNumberOfResults", 0),
+        AppConfig.SEARCH_RESULTS_MAX_COUNT,
+    )
+    return page_number * page_size < total_count
+
+
+def iterSearchResultPages(
+    kendra_query, selected_category_key, query_cache=None, start_page=1
+):
+    """
+    Kendraの検索結果をページ単位で遅延取得するジェネレータ
+    次のページが要求された時点で初めて、そのページの検索と署名付きURLの生成を行う
+    :param kendra_query: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param start_page: 取得を開始するページ番号
+    :return: (ページの署名付きURLのリスト, 次のページが存在するかどうか)を順に返すジェネレータ
+    """
+    page_number = start_page
+    while True:
+        signed_urls, has_more = kendraSearch(
+            kendra_query, selected_category_key, query_cache, page_number=page_number
+        )
+        yield signed_urls, has_more
+        if not has_more:
+            return
+        page_number += 1
+
+
+# Kendraの検索条件を構築する関数（Kendra検索, RAG検索共通
+def buildAttributeFilter(selected_category_key):
+    """
+    ユーザーが選択したカテゴリの値に応じて、Kendraの検索条件（AttributeFilter）を動的に構築する
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :return: KendraのAttributeFilter
+    """
     # デフォルトは検索条件の絞り込みなし（_language_codeの絞り込みのみ）
     attribute_filter = {
         "AndAllFilters": [
@@ -185,142 +583,393 @@ def kendraSearch(kendra_query, selected_category_key):
     # 「全て」以外が選択された時は検索条件の絞り込みを行う
     if selected_category_key != "all":
         attribute_filter["AndAllFilters"].append(additional_attribute_filter)
-    # Kendraの queryAPIの呼び出し
-    kendra_response = kendra.query(
-        IndexId=os.getenv("kendra_index"),  # Put INDEX in .env file
-        QueryText=kendra_query,
-        PageNumber=1,
-        PageSize=30,
-        AttributeFilter=attribute_filter,
-    )
+    return attribute_filter
 
-    # デバッグ用
-    # print(kendra_response)
-    # 署名付きURLを取得
-    signed_urls = generateSignedUrls(kendra_response)
-    # デバッグ用
-    # print(f"署名つきURL:{signed_urls}")
 
-    return signed_urls
+# Kendraの queryAPIを呼び出す関数（Kendra検索, RAG検索共通
+def queryKendra(
+    query_text,
+    selected_category_key,
+    query_cache=None,
+    page_number=1,
+    page_size=AppConfig.SEARCH_RESULTS_PAGE_SIZE,
+    rate_limiter=None,
+):
+    """
+    Kendraの queryAPIを呼び出す
+    query_cacheが指定された場合、同じ検索条件の結果はキャッシュから返却する
+    :param query_text: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param page_number: ページ番号
+    :param page_size: 1ページあたりの件数
+    :param rate_limiter: リクエスト数の上限（acquireを持つもの）。Kendraを呼び出す場合のみ待機し、キャッシュから返却する場合は待機しない
+    :return: Kendraの検索結果
+    """
+    attribute_filter = buildAttributeFilter(selected_category_key)
+
+    if query_cache is not None:
+        cache_key = query_cache.makeKey(
+            query_text, attribute_filter, page_number, page_size
+        )
+        kendra_response = query_cache.get(cache_key)
+        if kendra_response is not None:
+            return kendra_response
+
+    rate_limit_wait_seconds = rate_limiter.acquire() if rate_limiter else None
+
+    # kendra clientの取得（共有プールから取得）
+    kendra = getKendraClient()
+    with span("kendra.query", page_number=page_number) as attributes:
+        if rate_limit_wait_seconds is not None:
+            attributes["rate_limit_wait_seconds"] = rate_limit_wait_seconds
+        kendra_response = kendra.query(
+            IndexId=os.getenv("kendra_index"),  # Put INDEX in .env file
+            QueryText=query_text,
+            PageNumber=page_number,
+            PageSize=page_size,
+            AttributeFilter=attribute_filter,
+        )
+        attributes["result_count"] = len(kendra_response.get("ResultItems", []))
+        attributes["retries"] = retryAttempts(kendra_response)
+
+    if query_cache is not None:
+        query_cache.put(cache_key, kendra_response)
+    return kendra_response
+
+
+# Kendraの retrieveAPIを呼び出す関数（RAG検索用
+def retrieveKendraPassages(query_text, selected_category_key, query_cache=None):
+    """
+    Kendraの retrieveAPIを呼び出し、質問に関連するパッセージ（本文の抜粋）を取得する
+    query APIの抜粋よりも長いパッセージが返却されるため、RAGのコンテキストに使用する
+    :param query_text: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :return: Kendraの retrieveAPIのレスポンス
+    """
+    attribute_filter = buildAttributeFilter(selected_category_key)
+    page_size = AppConfig.RAG_RETRIEVE_PAGE_SIZE
+
+    if query_cache is not None:
+        cache_key = query_cache.makeKey(
+            query_text, attribute_filter, 1, page_size, api="retrieve"
+        )
+        retrieve_response = query_cache.get(cache_key)
+        if retrieve_response is not None:
+            return retrieve_response
+
+    # kendra clientの取得（共有プールから取得）
+    kendra = getKendraClient()
+    with span("kendra.retrieve") as attributes:
+        retrieve_response = kendra.retrieve(
+            IndexId=os.getenv("kendra_index"),  # Put INDEX in .env file
+            QueryText=query_text,
+            PageSize=page_size,
+            AttributeFilter=attribute_filter,
+        )
+        attributes["result_count"] = len(retrieve_response.get("ResultItems", []))
+        attributes["retries"] = retryAttempts(retrieve_response)
+
+    if query_cache is not None:
+        query_cache.put(cache_key, retrieve_response)
+    return retrieve_response
 
 
 # 署名付きURLを返却する関数（Kendra検索, RAG検索共通
 def generateSignedUrls(kendra_response):
     """
     Kendraの検索結果から署名付きURLを生成する
+    検索結果ごとのS3への存在確認と署名は、共有のスレッドプールで並列に実行する
     :param kendra_response: Kendraの検索結果
-    :return: Kendra検索結果のドキュメントの署名付きURLのリスト
-    """
-    # プロファイルを元にセッションを確立
-    boto3_session = boto3.session.Session(profile_name=os.getenv("profile_name"))
-    s3_client = boto3_session.client(
-        "s3",
-        region_name=AppConfig.REGION_NAME_DICT["oregon"],
-        config=Config(signature_version="s3v4"),
-        verify=False,
-    )
-    signed_urls = []
-
-    for result in kendra_response.get("ResultItems", []):
-        # ドキュメントのパスの存在確認
-        if (
-            "DocumentURI" in result
-            and "s3.us-west-2.amazonaws.com" in result["DocumentURI"]
-        ):
-            # 検索結果のS3ドキュメントのURIを取得
-            s3_url = result["DocumentURI"]
-            try:
-                # Debug: print the DocumentURI to verify its structure
-                # print(f"DocumentURI: {s3_url}")
-                # Parse S3 bucket and key from the DocumentURI
-
-                # プロトコル部分を取り除く
-                s3_path = s3_url.replace("https://", "")
-
-                # パスをバケット名とオブジェクトキーに分割
-                parts = s3_path.split("/", 1)
-                if len(parts) == 2:
-                    bucket_name = os.getenv("bucket_name")
-                    # オブジェクトキーを取得（取得時はすでにエンコードされている）
-                    object_key_encoded = parts[1]
-
-                    # 取得したオブジェクトキーをデコード（オブジェクトキーが日本語だと二重でエンコードされてしまい、エラーとなってしまうため）
-                    # 参照: https://github.com/aws-samples/generative-ai-use-cases-jp/issues/189
-                    object_key = urllib.parse.unquote(object_key_encoded)
-                    # print(f"Decoded Object Key: {object_key}")
-                    if object_key.startswith("transcription/") and object_key.endswith(
-                        ".txt"
-                    ):
-                        txt_file_name = object_key.split("/")[-1]  # XXXX.txt
-                        pdf_object_key = f"hogehoge/{
-                           txt_file_name.replace('.txt', '.pdf')}"
-
-                        # .txtファイルの名前と同名の.pdfファイルが存在するかを確認し、存在する場合はそちらを署名付きURLに変換して返却
-                        try:
-                            s3_client.head_object(
-                                Bucket=bucket_name, Key=pdf_object_key
-                            )
-                            print(f"PDF file exists: {pdf_object_key}")
-
-                            # 署名付きURLを生成
-                            signed_url = s3_client.generate_presigned_url(
-                                "get_object",
-                                Params={"Bucket": bucket_name, "Key": pdf_object_key},
-                                ExpiresIn=3600,
-                            )
-                            signed_urls.append(
-                                {
-                                    "document_name": txt_file_name.replace(
-                                        ".txt", ".pdf"
-                                    ),
-                                    "signed_url": signed_url,
-                                }
-                            )
-                        except s3_client.exceptions.ClientError as e:
-                            if e.response["Error"]["Code"] == "404":
-                                print(f"PDF file not found: {pdf_object_key}")
-                            else:
-                                raise
-                    else:
-                        # 同名のファイルが存在しない場合は検索結果のファイルをそのまま署名付きURLに変換
-                        signed_url = s3_client.generate_presigned_url(
-                            "get_object",
-                            Params={"Bucket": bucket_name, "Key": object_key},
-                            ExpiresIn=3600,  # URL valid for 1 hour
-                        )
-                        signed_urls.append(
-                            {
-                                "document_name": result.get(
-                                    "DocumentTitle", "Unknown Document"
-                                ).get("Text"),
-                                "signed_url": signed_url,
-                            }
-                        )
-                    print(f"signed_urls: {signed_urls}")
-                else:
-                    print(f"Unexpected S3 path format: {s3_url}")
-            except Exception as e:
-                print(f"Error generating signed URL: {e}")
+    :return: Kendra検索結果のドキュメントの署名付きURLのリスト（Kendraのランキング順）
+    """
+    # S3 clientの取得（共有プールから取得）
+    s3_client = getS3Client()
+
+    with span("presign.stage") as attributes:
+        # 検索結果ごとの存在確認・署名処理をスレッドプールに投入
+        futures = [
+            submitWithContext(_presign_executor, _resolveSignedUrl, result, s3_client)
+            for result in kendra_response.get("ResultItems", [])
+        ]
+        # ステージ全体のタイムアウトまで待機し、間に合わなかった処理は結果から除外する
+        _, not_done = concurrent.futures.wait(
+            futures, timeout=AppConfig.PRESIGN_STAGE_TIMEOUT_SECONDS
+        )
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            logger.warning(
+                "Signed URL generation timed out: %d results skipped", len(not_done)
+            )
+
+        # Kendraのランキング順を保ったまま結果をまとめる
+        signed_urls = [
+            future.result()
+            for future in futures
+            if future not in not_done and future.result() is not None
+        ]
+        attributes["result_count"] = len(signed_urls)
+        attributes["timed_out"] = len(not_done)
+    logger.debug("signed_urls: %s", signed_urls)
 
     return signed_urls
 
 
-def invokeLLMWithFile(question, uploaded_file, messages):
+def getPdfKeyIndex(s3_client, bucket_name):
+    """
+    PDFファイルの存在確認用インデックスを取得する（初回呼び出し時にバックグラウンドで構築を開始する）
+    :param s3_client: S3クライアント
+    :param bucket_name: バケット名
+    :return: S3KeyIndex。インデックスを使用しない設定の場合はNone
+    """
+    global _pdf_key_index
+    if not AppConfig.PDF_KEY_INDEX_ENABLED:
+        return None
+    if _pdf_key_index is None:
+        with _pdf_key_index_lock:
+            if _pdf_key_index is None:
+                index = S3KeyIndex(
+                    s3_client,
+                    bucket_name,
+                    prefix=AppConfig.PDF_KEY_PREFIX,
+                    refresh_interval_seconds=AppConfig.PDF_KEY_INDEX_REFRESH_INTERVAL_SECONDS,
+                    min_refresh_interval_seconds=AppConfig.PDF_KEY_INDEX_MIN_REFRESH_INTERVAL_SECONDS,
+                )
+                index.start()
+                _pdf_key_index = index
+    return _pdf_key_index
+
+
+def planSignedUrl(result):
+    """
+    Kendraの検索結果1件から、署名付きURLを生成するS3のオブジェクトを求める（同期/非同期の署名付きURLの生成で共通）
+    文字起こし（transcription/配下の.txt）の場合は、同名のPDFファイル（存在確認が必要）を対象とする
+    :param result: Kendraの検索結果（ResultItemsの1件）
+    :return: {"bucket_name", "object_key", "document_name", "check_exists"}の辞書。対象外の場合はNone
+    """
+    # ドキュメントのパスの存在確認
+    if not (
+        "DocumentURI" in result
+        and "s3.us-west-2.amazonaws.com" in result["DocumentURI"]
+    ):
+        return None
+
+    # 検索結果のS3ドキュメントのURIを取得
+    s3_url = result["DocumentURI"]
+    # Debug: print the DocumentURI to verify its structure
+    # print(f"DocumentURI: {s3_url}")
+    # Parse S3 bucket and key from the DocumentURI
+
+    # プロトコル部分を取り除く
+    s3_path = s3_url.replace("https://", "")
+
+    # パスをバケット名とオブジェクトキーに分割
+    parts = s3_path.split("/", 1)
+    if len(parts) != 2:
+        logger.warning("Unexpected S3 path format: %s", s3_url)
+        return None
+
+    bucket_name = os.getenv("bucket_name")
+    # オブジェクトキーを取得（取得時はすでにエンコードされている）
+    object_key_encoded = parts[1]
+
+    # 取得したオブジェクトキーをデコード（オブジェクトキーが日本語だと二重でエンコードされてしまい、エラーとなってしまうため）
+    # 参照: https://github.com/aws-samples/generative-ai-use-cases-jp/issues/189
+    object_key = urllib.parse.unquote(object_key_encoded)
+    # print(f"Decoded Object Key: {object_key}")
+    if object_key.startswith("transcription/") and object_key.endswith(".txt"):
+        # .txtファイルの名前と同名の.pdfファイルが存在する場合は、そちらを署名付きURLに変換して返却
+        txt_file_name = object_key.split("/")[-1]  # XXXX.txt
+        return {
+            "bucket_name": bucket_name,
+            "object_key": f"{AppConfig.PDF_KEY_PREFIX}{txt_file_name.replace('.txt', '.pdf')}",
+            "document_name": txt_file_name.replace(".txt", ".pdf"),
+            "check_exists": True,
+        }
+
+    # 同名のファイルが存在しない場合は検索結果のファイルをそのまま署名付きURLに変換
+    return {
+        "bucket_name": bucket_name,
+        "object_key": object_key,
+        "document_name": result.get("DocumentTitle", "Unknown Document").get("Text"),
+        "check_exists": False,
+    }
+
+
+def needsExistenceCheck(plan, s3_client):
+    """
+    署名付きURLを生成する前に、head_objectでの存在確認が必要か
+    キャッシュ済みの場合、またはインデックスにある場合は存在確認済みとする
+    インデックスにない場合は、インデックスの構築後に追加されたファイルの可能性があるため、head_objectで確認する
+    :param plan: planSignedUrlの結果
+    :param s3_client: S3クライアント（インデックスの構築に使用する）
+    :return: 存在確認が必要な場合はTrue、不要な場合はFalse
+    """
+    if not plan["check_exists"]:
+        return False
+    # 直後のsignPlannedUrlでキャッシュを取得するため、ここではヒット/ミスを数えない
+    if presigned_url_cache.peek((plan["bucket_name"], plan["object_key"])) is not None:
+        return False
+    pdf_key_index = getPdfKeyIndex(s3_client, plan["bucket_name"])
+    return not (pdf_key_index and pdf_key_index.contains(plan["object_key"]))
+
+
+def recordPdfExists(plan, s3_client):
+    """
+    head_objectで存在を確認したPDFファイルを、存在確認用インデックスに追加する
+    :param plan: planSignedUrlの結果
+    :param s3_client: S3クライアント
+    """
+    logger.debug("PDF file exists: %s", plan["object_key"])
+    pdf_key_index = getPdfKeyIndex(s3_client, plan["bucket_name"])
+    if pdf_key_index:
+        pdf_key_index.add(plan["object_key"])
+
+
+def signPlannedUrl(plan, s3_client):
+    """
+    署名付きURLを生成する（キャッシュ済みの場合はキャッシュから取得する）
+    署名はローカルの計算のみで、S3への通信は発生しない
+    :param plan: planSignedUrlの結果
+    :param s3_client: S3クライアント
+    :return: {"document_name", "signed_url"}の辞書
+    """
+    with span("s3.presign"):
+        signed_url = presigned_url_cache.getOrSign(
+            s3_client, plan["bucket_name"], plan["object_key"]
+        )
+    return {"document_name": plan["document_name"], "signed_url": signed_url}
+
+
+def _resolveSignedUrl(result, s3_client):
+    """
+    Kendraの検索結果1件から署名付きURLを生成する（generateSignedUrlsからスレッドプール上で呼び出される）
+    :param result: Kendraの検索結果（ResultItemsの1件）
+    :param s3_client: S3クライアント
+    :return: {"document_name", "signed_url"}の辞書。対象外またはエラーの場合はNone
+    """
+    try:
+        plan = planSignedUrl(result)
+        if plan is None:
+            return None
+        if needsExistenceCheck(plan, s3_client):
+            # インデックスが未構築、またはインデックスにない場合のみ、head_objectで確認する
+            try:
+                with span("s3.head_object") as attributes:
+                    head_response = s3_client.head_object(
+                        Bucket=plan["bucket_name"], Key=plan["object_key"]
+                    )
+                    attributes["retries"] = retryAttempts(head_response)
+                recordPdfExists(plan, s3_client)
+            except s3_client.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "404":
+                    logger.debug("PDF file not found: %s", plan["object_key"])
+                    return None
+                raise
+        # 署名付きURLを生成し、キャッシュに格納
+        return signPlannedUrl(plan, s3_client)
+    except Exception as e:
+        logger.warning("Error generating signed URL: %s", e)
+        return None
+
+
+def getMaxUploadBytes(file_format):
+    """
+    アップロードできるファイルのサイズの上限を返す
+    （Claudeが受け付ける4.5MB。画像は送信前に縮小・再エンコードし、
+    PDFはローカルでテキストを抽出するため、より大きなファイルも受け付ける）
+    :param file_format: ファイル形式（AppConfig.SUPPORTED_FORMATSの値）
+    :return: サイズの上限（バイト）
+    """
+    if file_format in ["png", "jpeg"] and AppConfig.IMAGE_PREPROCESS_ENABLED:
+        return AppConfig.IMAGE_MAX_UPLOAD_BYTES
+    if file_format == "pdf" and AppConfig.PDF_EXTRACT_ENABLED:
+        return AppConfig.PDF_MAX_UPLOAD_BYTES
+    return 4.5 * 1024 * 1024  # 4.5MB
+
+
+@traced("multi_modal")
+def invokeLLMWithFile(
+    question, uploaded_file, messages, history_manager=None, on_progress=None
+):
     """
     マルチモーダルでのBedrock呼び出しを行う
     ファイルがアップロードされなかった場合、通常のチャットとして動作する
+    モデルの入力の上限を超える大きなPDFは、分割して並列に要約した上で回答する
     :param question: ユーザーの質問
     :param uploaded_file: アップロードされたファイル
     :param messages:  過去の会話履歴
-    :return answer: LLMからの回答
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :param on_progress: 分割要約の進捗の通知先 on_progress(完了した処理数, 全体の処理数)
+    :return: (LLMからの回答, 実際に回答したモデルのID（エラーの場合はNone）)
     """
     # モデルIDと推論パラメータのセット
     model_id = AppConfig.MODEL_ID_DICT["claude_3_haiku"]
     inference_config = AppConfig.INFERENCE_CONFIG_DICT
 
+    # ファイルの前処理（画像の縮小、PDFのテキスト抽出）を行い、質問のメッセージを構築
+    user_message, question, map_reduce_pages, file_content = buildFileUserMessage(
+        question, uploaded_file
+    )
+
+    # メッセージを追加
+    if messages and messages[-1]["role"] != "assistant":
+        messages.append({"role": "assistant", "content": [{"text": "準備中..."}]})
+    messages.append(user_message)
+
+    if map_reduce_pages is not None:
+        try:
+            answer = mapReduceSummarize(
+                map_reduce_pages,
+                question,
+                hashlib.sha256(file_content).hexdigest(),
+                model_id=model_id,
+                on_progress=on_progress,
+            )
+            return answer, model_id
+        except Exception as e:
+            return f"エラーが発生しました: {e}", None
+
+    # トークン数の上限に収まる直近の会話履歴を取得
+    history_manager = history_manager or HistoryManager(summarize=False)
+    converse_kwargs = buildConverseKwargs(
+        model_id,
+        history_manager.buildMessages(messages, model_id),
+        inference_config,
+        history_manager.getSummarySystemPrompt(),
+    )
+
+    # Bedrock API呼び出し
+    try:
+        response, answered_model_id, _ = routedConverse(
+            converse_kwargs, AppConfig.MODEL_ROUTING_POLICY_DICT["multi_modal"]
+        )
+        recordUsage(answered_model_id, response.get("usage", {}))
+        answer = response["output"]["message"]["content"][0]["text"]
+    except Exception as e:
+        return f"エラーが発生しました: {e}", None
+
+    return answer, answered_model_id
+
+
+def buildFileUserMessage(question, uploaded_file):
+    """
+    マルチモーダルの質問のメッセージを構築する（同期/非同期のマルチモーダルで共通）
+    アップロードされた画像は縮小・再エンコード、PDFはテキストを抽出し、ファイルの内容は保存領域に保存して参照のみを保持する
+    :param question: ユーザーの質問
+    :param uploaded_file: アップロードされたファイル（Noneの場合は質問のみのメッセージ）
+    :return: (ユーザーのメッセージ, 質問（空の場合はデフォルトの質問）,
+              分割要約を行う場合のPDFのページ（行わない場合はNone）, ファイルの内容)
+    """
     # マルチモーダルでサポートされるファイル形式
     supported_formats_dict = AppConfig.SUPPORTED_FORMATS
 
+    # 分割要約を行う場合の、PDFから抽出したページ
+    map_reduce_pages = None
+    file_content = None
+
     if uploaded_file:
         # ファイル形式を判別
         file_format = supported_formats_dict.get(uploaded_file.type)
@@ -332,25 +981,39 @@ def invokeLLMWithFile(question, uploaded_file, messages):
 
         # ファイルの内容を読み込む
         file_content = uploaded_file.getvalue()
+        attachment_store = getAttachmentStore()
 
         # 画像のバリデーションと処理
         if file_format in ["png", "jpeg"]:
-            file_message = {
-                "image": {"format": file_format, "source": {"bytes": file_content}}
-            }
+            # モデルが使用する解像度への縮小と再エンコードを行う
+            attachment_format = file_format
+            if AppConfig.IMAGE_PREPROCESS_ENABLED:
+                file_content, attachment_format = preprocessImage(file_content)
+            # ファイルの内容を保存領域に保存し、会話履歴には参照のみを保持する
+            # （同じファイルの再アップロードは1つにまとめられる）
+            file_blocks = [
+                makeAttachmentRef(
+                    attachment_store.put(file_content),
+                    "image",
+                    attachment_format,
+                    uploaded_file.name,
+                )
+            ]
             default_question = (
                 f"アップロードされた画像（{file_format}）の内容を要約してください。"
             )
         elif file_format == "pdf":
-            # PDFの処理
-            # TODO nameの部分に関して、ファイル名の名前を使用するとなぜかconverseAPIのエラーになってしまうため決めうちで指定
-            file_message = {
-                "document": {
-                    "format": "pdf",
-                    "name": "pdf",
-                    "source": {"bytes": file_content},
-                }
-            }
+            # PDFの処理（入力の上限を超える場合は、会話履歴にはファイル名のみを残して分割要約する）
+            pages = extractPdf(file_content) if AppConfig.PDF_EXTRACT_ENABLED else None
+            if pages and needsMapReduce(pages):
+                map_reduce_pages = pages
+                file_blocks = [
+                    {
+                        "text": f"（{uploaded_file.name}: {len(pages)}ページの文書を分割して要約）"
+                    }
+                ]
+            else:
+                file_blocks = buildPdfBlocks(file_content, uploaded_file.name, pages)
             default_question = f"アップロードされたPDF（{uploaded_file.name}）の内容を要約してください。"
         else:
             raise ValueError("サポートされていないファイル形式です。")
@@ -363,7 +1026,7 @@ def invokeLLMWithFile(question, uploaded_file, messages):
             "role": "user",
             "content": [
                 {"text": f"Uploaded {file_format} content:"},
-                file_message,
+                *file_blocks,
                 {"text": question},
             ],
         }
@@ -376,48 +1039,254 @@ def invokeLLMWithFile(question, uploaded_file, messages):
             ],
         }
 
-    # メッセージを追加
-    if messages and messages[-1]["role"] != "assistant":
-        messages.append({"role": "assistant", "content": [{"text": "準備中..."}]})
-    messages.append(user_message)
+    return user_message, question, map_reduce_pages, file_content
 
-    # Bedrock API呼び出し
-    try:
-        response = bedrock.converse(
-            modelId=model_id, messages=messages, inferenceConfig=inference_config
+
+def buildPdfBlocks(pdf_bytes, name, pages):
+    """
+    アップロードされたPDFを、会話履歴に保持するコンテンツブロックに変換する
+    テキストを含むPDFは、ページ番号付きのテキストとスキャンされたページの画像として、
+    全てのページがスキャンされたPDFは、PDFそのもの（document）として送信する
+    :param pdf_bytes: PDFの内容
+    :param name: ファイル名
+    :param pages: extractPdfで抽出したページのリスト（抽出しない・できなかった場合はNone）
+    :return: コンテンツブロックのリスト
+    """
+    # テキストを抽出できないPDF（パスワードで保護されたPDFなど）は、documentとして送信できるサイズのみ受け付ける
+    if not pages and len(pdf_bytes) > AppConfig.PDF_DOCUMENT_MAX_BYTES:
+        raise ValueError(
+            f"テキストを抽出できないPDF（パスワードで保護されたPDFなど）は、最大{AppConfig.PDF_DOCUMENT_MAX_BYTES / (1024 * 1024):g}MBまでアップロードできます。"
         )
-        answer = response["output"]["message"]["content"][0]["text"]
-    except Exception as e:
-        answer = f"エラーが発生しました: {e}"
 
-    return answer
+    attachment_store = getAttachmentStore()
+
+    # テキストを抽出できない場合は、PDFそのものを送信する
+    # （documentとして送信できないサイズの場合は、スキャンされたページを画像として送信する）
+    if not pages or (
+        not isTextBasedPdf(pages) and len(pdf_bytes) <= AppConfig.PDF_DOCUMENT_MAX_BYTES
+    ):
+        return [
+            makeAttachmentRef(attachment_store.put(pdf_bytes), "document", "pdf", name)
+        ]
+
+    pdf_text, pdf_tokens = buildPdfText(pages)
+    blocks = [
+        makeAttachmentRef(
+            attachment_store.put(pdf_text.encode("utf-8")),
+            "text",
+            "txt",
+            name,
+            tokens=pdf_tokens,
+        )
+    ]
+    scanned_pages = [page for page in pages if page["image"] is not None]
+    for page in scanned_pages[: AppConfig.PDF_SCANNED_PAGE_MAX_IMAGES]:
+        image_bytes, image_format = preprocessImage(page["image"])
+        blocks.append({"text": f"{page['page_number']}ページ（スキャン）:"})
+        blocks.append(
+            makeAttachmentRef(
+                attachment_store.put(image_bytes),
+                "image",
+                image_format,
+                f"{name} {page['page_number']}ページ",
+            )
+        )
+    if len(scanned_pages) > AppConfig.PDF_SCANNED_PAGE_MAX_IMAGES:
+        blocks.append(
+            {
+                "text": f"（スキャンされたページのうち、{AppConfig.PDF_SCANNED_PAGE_MAX_IMAGES}ページを超える分は省略されました）"
+            }
+        )
+    return blocks
 
 
-def invokeLLMWithoutFile(history):
+@traced("chat")
+def invokeLLMWithoutFile(history, stream=False, history_manager=None):
     """
     通常のLLMとのチャットを行う関数（会話履歴を考慮した回答をさせる）
     :param history: ユーザーの会話履歴
-    :return answer: 過去の会話履歴を踏まえて、LLMによって生成された回答
+    :param stream: Trueの場合、回答をConverseStream（テキストの差分を返すジェネレータ）として返す
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return answer: 過去の会話履歴を踏まえて、LLMによって生成された回答（stream=Trueの場合はConverseStream）
     """
 
     # モデルIDと推論パラメータのセット
     model_id = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
     inference_config = AppConfig.INFERENCE_CONFIG_DICT
 
-    # ConverseAPIに会話履歴を渡した上で質問を行う
-    response = bedrock.converse(
-        modelId=model_id, messages=history, inferenceConfig=inference_config
+    # トークン数の上限に収まる直近の会話履歴を取得（session stateの会話履歴は変更しない）
+    history_manager = history_manager or HistoryManager(summarize=False)
+    converse_kwargs = buildConverseKwargs(
+        model_id,
+        history_manager.buildMessages(history, model_id),
+        inference_config,
+        history_manager.getSummarySystemPrompt(),
     )
+
+    # ストリーミングモードの場合は、ConverseStreamAPIで回答の差分を逐次受け取る
+    # （短い質問や、モデルが飽和している場合は、ルーティングにより別のモデルで回答する）
+    routing_policy = AppConfig.MODEL_ROUTING_POLICY_DICT["chat"]
+    if stream:
+        response, answered_model_id, reconcile_usage = routedConverse(
+            converse_kwargs, routing_policy, stream=True
+        )
+        return ConverseStream(
+            response, answered_model_id, reconcile_usage=reconcile_usage
+        )
+
+    # ConverseAPIに会話履歴を渡した上で質問を行う
+    response, answered_model_id, _ = routedConverse(converse_kwargs, routing_policy)
     # デバッグ用
     # print(f"Converse API response: {response}")
-    # レスポンスの中身チェック
-    if (
-        "content" not in response["output"]["message"]
-        or not response["output"]["message"]["content"]
-    ):
-        raise ValueError("Bedrock response content is empty.")
+    return parseConverseAnswer(response, answered_model_id)
 
-    # 最終的に画面に表示する回答
-    answer = response["output"]["message"]["content"][0]["text"]
-    print(answer)
-    return answer
+
+def buildConverseKwargs(model_id, messages, inference_config, system_prompt):
+    """
+    マルチモーダル/通常のチャットで使用する、ConverseAPIの引数を組み立てる
+    会話履歴のファイルの参照をファイルの内容に置き換え、
+    システムプロンプトと、今回の質問より前の会話履歴にキャッシュのチェックポイントを置く
+    :param model_id: BedrockのモデルID
+    :param messages: ConverseAPIに渡す会話履歴（最後のメッセージが今回の質問）
+    :param inference_config: 推論パラメータ
+    :param system_prompt: システムプロンプトのリスト（空の場合はシステムプロンプトを渡さない）
+    :return: ConverseAPIの引数の辞書
+    """
+    messages = resolveAttachments(messages, getAttachmentStore())
+    system_prompt, messages = applyPromptCache(
+        model_id, system_prompt, messages, stable_message_count=len(messages) - 1
+    )
+    converse_kwargs = {
+        "modelId": model_id,
+        "messages": messages,
+        "inferenceConfig": inference_config,
+    }
+    if system_prompt:
+        converse_kwargs["system"] = system_prompt
+    return converse_kwargs
+
+
+def getBackendStats(query_cache=None):
+    """
+    バックエンドの計測結果と、流量制御・ルーティング・キャッシュの状況をまとめて返す（管理画面の表示用）
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合は含めない
+    :return: {stages, scheduler, router, regions, usage, caches, startup}
+    """
+    caches = {
+        "presigned_url": presigned_url_cache.stats(),
+        "attachments": getAttachmentStore().stats(),
+    }
+    if query_cache is not None:
+        caches["kendra_query"] = query_cache.stats()
+    return {
+        "stages": stage_metrics.stats(),
+        "scheduler": getSchedulerStats(),
+        "router": getRouterStats(),
+        "regions": region_pool.stats(),
+        "usage": getUsageStats(),
+        "caches": caches,
+        "startup": startup_report.stats(),
+    }
+
+
+def getMetricsText(query_cache=None):
+    """
+    バックエンドの計測結果を、Prometheusのテキスト形式で返す
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合は含めない
+    :return: Prometheusのテキスト形式の文字列
+    """
+    stats = getBackendStats(query_cache)
+    token_types = [
+        "inputTokens",
+        "outputTokens",
+        "cacheReadInputTokens",
+        "cacheWriteInputTokens",
+    ]
+    gauges = [
+        (
+            "bedrock_requests_total",
+            "counter",
+            "Bedrock requests per model.",
+            [
+                ({"model": model_id}, totals["requests"])
+                for model_id, totals in stats["usage"].items()
+            ],
+        ),
+        (
+            "bedrock_tokens_total",
+            "counter",
+            "Bedrock token usage per model and token type.",
+            [
+                ({"model": model_id, "type": token_type}, totals[token_type])
+                for model_id, totals in stats["usage"].items()
+                for token_type in token_types
+            ],
+        ),
+        (
+            "bedrock_admission_queue_depth",
+            "gauge",
+            "Requests waiting for admission per model and region.",
+            [
+                ({"target": target}, target_stats["queue_depth"])
+                for target, target_stats in stats["scheduler"].items()
+            ],
+        ),
+        (
+            "bedrock_admission_rejected_total",
+            "counter",
+            "Requests rejected by the admission controller.",
+            [
+                ({"target": target}, target_stats["rejected"])
+                for target, target_stats in stats["scheduler"].items()
+            ],
+        ),
+        (
+            "bedrock_model_throttle_rate",
+            "gauge",
+            "Recent throttle rate per model.",
+            [
+                ({"model": model_id}, model_stats["throttle_rate"])
+                for model_id, model_stats in stats["router"].items()
+            ],
+        ),
+        (
+            "bedrock_region_latency_seconds",
+            "gauge",
+            "Smoothed Bedrock time to first byte (streaming) per region and model.",
+            [
+                ({"region": region_name, "model": model_id}, latency_seconds)
+                for region_name, region_stats in stats["regions"].items()
+                for model_id, latency_seconds in region_stats["latency_seconds"].items()
+            ],
+        ),
+        (
+            "cache_hit_rate",
+            "gauge",
+            "Hit rate per shared cache.",
+            [
+                ({"cache": cache_name}, cache_stats["hit_rate"])
+                for cache_name, cache_stats in stats["caches"].items()
+                if "hit_rate" in cache_stats
+            ],
+        ),
+        (
+            "cache_entries",
+            "gauge",
+            "Entries held per shared cache.",
+            [
+                ({"cache": cache_name}, cache_stats["entries"])
+                for cache_name, cache_stats in stats["caches"].items()
+                if "entries" in cache_stats
+            ],
+        ),
+        (
+            "startup_seconds",
+            "gauge",
+            "Time spent on imports, initialisation and warm-up at startup.",
+            [
+                ({"phase": phase}, seconds)
+                for phase, seconds in stats["startup"]["totals"].items()
+            ],
+        ),
+    ]
+    return renderPrometheus(gauges)
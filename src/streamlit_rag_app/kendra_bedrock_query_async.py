@@ -0,0 +1,551 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from app_config import AppConfig
+from async_aws_clients import getAsyncKendraClient, getAsyncS3Client
+from aws_clients import getS3Client
+from context_builder import extractPassagesFromQuery, extractPassagesFromRetrieve
+from doc_summarizer import mapReduceSummarize
+from history_manager import HistoryManager
+from kendra_bedrock_query import (
+    ConverseStream,
+    RagPipelineResult,
+    buildAttributeFilter,
+    buildConverseKwargs,
+    buildFileUserMessage,
+    buildRagConverseKwargs,
+    hasMoreResults,
+    needsExistenceCheck,
+    parseConverseAnswer,
+    planSignedUrl,
+    recordPdfExists,
+    signPlannedUrl,
+    validateHistoryRoles,
+)
+from model_router import routedConverseAsync
+from telemetry import recordSpan, retryAttempts, span, traced
+
+"""
+Kendra RAG検索/マルチモーダルの非同期版（asyncio）
+Kendra・S3・Bedrockの呼び出しを非同期のクライアント（aiobotocore）で行い、
+リクエストごとにスレッドを占有せずに、1つのイベントループで多数のリクエストを並行して処理する
+（ASGIサーバー向け。Streamlitの画面は、引き続き同期版のkendra_bedrock_queryを使用する）
+プロンプトの組み立て・署名付きURLの対象の判定・キャッシュ・ルーティング・流量制御は同期版と共有し、
+ファイルの前処理や分割要約などCPUを使用する処理は、スレッドで実行してイベントループを止めない
+呼び出し元のタスクがキャンセルされた場合（クライアントの切断など）は、実行中のAWSへのリクエストも中止される
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConverseStream(ConverseStream):
+    """
+    ConverseStreamの非同期版（async forでテキストの差分を順に返す）
+    読み込みの途中でタスクがキャンセルされた場合は、Bedrockのストリームを閉じて回答の生成を打ち切る
+    """
+
+    def __iter__(self):
+        raise TypeError("AsyncConverseStreamはasync forで読み込んでください。")
+
+    async def __aiter__(self):
+        chunks = []
+        try:
+            async for event in self._event_stream:
+                delta_text = self._handleEvent(event)
+                if delta_text:
+                    chunks.append(delta_text)
+                    yield delta_text
+        except BaseException as e:
+            # キャンセル（CancelledError）を含め、読み込みを中断した場合はストリームを閉じる
+            self._recordFailure(type(e).__name__)
+            self.close()
+            raise
+        self._finish(chunks)
+
+    def close(self):
+        """
+        Bedrockのストリームを閉じる（コネクションを切断し、以降の回答の生成を打ち切る）
+        """
+        close = getattr(self._event_stream, "close", None)
+        if close is not None:
+            close()
+
+
+class AsyncRagPipelineResult(RagPipelineResult):
+    """
+    RAG検索のパイプライン（ragSearchPipelineAsync）の結果
+    署名付きURLはLLMの回答と並行して生成されるため、getSignedUrlsで生成の完了を待つ
+    """
+
+    @property
+    def signed_urls(self):
+        """
+        署名付きURLのリスト（生成が完了していない場合は、イベントループを止めないようエラーとする）
+        """
+        if not self._signed_urls_future.done():
+            raise RuntimeError(
+                "署名付きURLの生成が完了していません。getSignedUrlsで完了を待ってください。"
+            )
+        return self._signed_urls_future.result()
+
+    async def getSignedUrls(self):
+        """
+        署名付きURLの生成の完了を待ち、署名付きURLのリストを返す
+        :return: 署名付きURLのリスト
+        """
+        return await self._signed_urls_future
+
+    def cancel(self):
+        """
+        署名付きURLの生成を中止し、回答のストリームを閉じる（クライアントが切断した場合に使用する）
+        """
+        self._signed_urls_future.cancel()
+        if self.stream is not None:
+            self.stream.close()
+
+
+async def queryKendraAsync(
+    query_text,
+    selected_category_key,
+    query_cache=None,
+    page_number=1,
+    page_size=AppConfig.SEARCH_RESULTS_PAGE_SIZE,
+):
+    """
+    queryKendraの非同期版（Kendraの queryAPIを呼び出す）
+    :param query_text: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param page_number: ページ番号
+    :param page_size: 1ページあたりの件数
+    :return: Kendraの検索結果
+    """
+    attribute_filter = buildAttributeFilter(selected_category_key)
+
+    if query_cache is not None:
+        cache_key = query_cache.makeKey(
+            query_text, attribute_filter, page_number, page_size
+        )
+        kendra_response = query_cache.get(cache_key)
+        if kendra_response is not None:
+            return kendra_response
+
+    kendra = await getAsyncKendraClient()
+    with span("kendra.query", page_number=page_number) as attributes:
+        kendra_response = await kendra.query(
+            IndexId=os.getenv("kendra_index"),
+            QueryText=query_text,
+            PageNumber=page_number,
+            PageSize=page_size,
+            AttributeFilter=attribute_filter,
+        )
+        attributes["result_count"] = len(kendra_response.get("ResultItems", []))
+        attributes["retries"] = retryAttempts(kendra_response)
+
+    if query_cache is not None:
+        query_cache.put(cache_key, kendra_response)
+    return kendra_response
+
+
+async def retrieveKendraPassagesAsync(
+    query_text, selected_category_key, query_cache=None
+):
+    """
+    retrieveKendraPassagesの非同期版（Kendraの retrieveAPIを呼び出す）
+    :param query_text: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :return: Kendraの retrieveAPIのレスポンス
+    """
+    attribute_filter = buildAttributeFilter(selected_category_key)
+    page_size = AppConfig.RAG_RETRIEVE_PAGE_SIZE
+
+    if query_cache is not None:
+        cache_key = query_cache.makeKey(
+            query_text, attribute_filter, 1, page_size, api="retrieve"
+        )
+        retrieve_response = query_cache.get(cache_key)
+        if retrieve_response is not None:
+            return retrieve_response
+
+    kendra = await getAsyncKendraClient()
+    with span("kendra.retrieve") as attributes:
+        retrieve_response = await kendra.retrieve(
+            IndexId=os.getenv("kendra_index"),
+            QueryText=query_text,
+            PageSize=page_size,
+            AttributeFilter=attribute_filter,
+        )
+        attributes["result_count"] = len(retrieve_response.get("ResultItems", []))
+        attributes["retries"] = retryAttempts(retrieve_response)
+
+    if query_cache is not None:
+        query_cache.put(cache_key, retrieve_response)
+    return retrieve_response
+
+
+async def generateSignedUrlsAsync(kendra_response):
+    """
+    generateSignedUrlsの非同期版（Kendraの検索結果から署名付きURLを生成する）
+    検索結果ごとのS3への存在確認をタスクとして並行に実行する
+    :param kendra_response: Kendraの検索結果
+    :return: Kendra検索結果のドキュメントの署名付きURLのリスト（Kendraのランキング順）
+    """
+    # 署名はローカルの計算のみのため同期のクライアントで行い、存在確認のみ非同期のクライアントで行う
+    s3_client = getS3Client()
+
+    with span("presign.stage") as attributes:
+        tasks = [
+            asyncio.create_task(_resolveSignedUrlAsync(result, s3_client))
+            for result in kendra_response.get("ResultItems", [])
+        ]
+        not_done = set()
+        if tasks:
+            try:
+                # ステージ全体のタイムアウトまで待機し、間に合わなかった処理は中止して結果から除外する
+                _, not_done = await asyncio.wait(
+                    tasks, timeout=AppConfig.PRESIGN_STAGE_TIMEOUT_SECONDS
+                )
+            finally:
+                # 呼び出し元がキャンセルされた場合も、実行中の存在確認を残さない
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+        if not_done:
+            logger.warning(
+                "Signed URL generation timed out: %d results skipped", len(not_done)
+            )
+
+        # Kendraのランキング順を保ったまま結果をまとめる
+        signed_urls = [
+            task.result()
+            for task in tasks
+            if task not in not_done and task.result() is not None
+        ]
+        attributes["result_count"] = len(signed_urls)
+        attributes["timed_out"] = len(not_done)
+    logger.debug("signed_urls: %s", signed_urls)
+
+    return signed_urls
+
+
+async def _resolveSignedUrlAsync(result, s3_client):
+    """
+    _resolveSignedUrlの非同期版（Kendraの検索結果1件から署名付きURLを生成する）
+    :param result: Kendraの検索結果（ResultItemsの1件）
+    :param s3_client: 署名・インデックスの構築に使用する同期のS3クライアント
+    :return: {"document_name", "signed_url"}の辞書。対象外またはエラーの場合はNone
+    """
+    try:
+        plan = planSignedUrl(result)
+        if plan is None:
+            return None
+        if needsExistenceCheck(plan, s3_client):
+            async_s3_client = await getAsyncS3Client()
+            try:
+                with span("s3.head_object") as attributes:
+                    head_response = await async_s3_client.head_object(
+                        Bucket=plan["bucket_name"], Key=plan["object_key"]
+                    )
+                    attributes["retries"] = retryAttempts(head_response)
+                recordPdfExists(plan, s3_client)
+            except async_s3_client.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "404":
+                    logger.debug("PDF file not found: %s", plan["object_key"])
+                    return None
+                raise
+        return signPlannedUrl(plan, s3_client)
+    except Exception as e:
+        logger.warning("Error generating signed URL: %s", e)
+        return None
+
+
+async def _timedGenerateSignedUrlsAsync(kendra_response, presign_timings):
+    stage_started = time.perf_counter()
+    try:
+        return await generateSignedUrlsAsync(kendra_response)
+    finally:
+        presign_timings["presign"] = time.perf_counter() - stage_started
+
+
+@traced("rag_search")
+async def ragSearchPipelineAsync(
+    question,
+    history,
+    selected_model_id,
+    selected_temperature,
+    selected_category_key,
+    stream=False,
+    query_cache=None,
+    history_manager=None,
+):
+    """
+    ragSearchPipelineの非同期版
+    Kendra検索 → (LLMによる回答生成 ∥ 署名付きURLの生成) のパイプラインで実行する
+    （retrieveAPIでコンテキストを取得する設定の場合は、queryAPIとretrieveAPIも並行して呼び出す）
+    :param question: ユーザーの質問
+    :param history: ユーザーの会話履歴
+    :param selected_model_id ユーザーが画面で選択したClaudeのモデル
+    :param selected_temperature ユーザーが画面で選択した「振る舞い」（temperature）の値
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey（KendraのAttributeFilterで絞り込みに使用される値)
+    :param stream: Trueの場合、回答をAsyncConverseStream（テキストの差分を返す非同期イテレータ）として返す
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: AsyncRagPipelineResult
+    """
+    timings = {}
+    validateHistoryRoles(history)
+
+    stage_started = time.perf_counter()
+    retrieve_task = None
+    if AppConfig.RAG_CONTEXT_SOURCE == "retrieve":
+        retrieve_task = asyncio.create_task(
+            retrieveKendraPassagesAsync(question, selected_category_key, query_cache)
+        )
+    try:
+        kendra_response = await queryKendraAsync(
+            question,
+            selected_category_key,
+            query_cache,
+            page_size=AppConfig.SEARCH_RESULTS_PAGE_SIZE,
+        )
+    except BaseException:
+        if retrieve_task is not None:
+            retrieve_task.cancel()
+        raise
+    timings["kendra_query"] = time.perf_counter() - stage_started
+
+    # ドキュメントのメタデータを取得し、署名付きURLを生成（LLMの回答生成と並行して実行）
+    presign_timings = {}
+    signed_urls_task = asyncio.create_task(
+        _timedGenerateSignedUrlsAsync(kendra_response, presign_timings)
+    )
+
+    try:
+        stage_started = time.perf_counter()
+        if retrieve_task is not None:
+            passages = extractPassagesFromRetrieve(await retrieve_task)
+        else:
+            passages = extractPassagesFromQuery(kendra_response)
+        converse_kwargs, context_tokens = buildRagConverseKwargs(
+            question,
+            history,
+            selected_model_id,
+            selected_temperature,
+            passages,
+            history_manager,
+        )
+        timings["context"] = time.perf_counter() - stage_started
+        recordSpan(
+            "rag.context",
+            timings["context"],
+            result_count=len(passages),
+            context_tokens=context_tokens,
+            message_count=len(converse_kwargs["messages"]),
+        )
+        logger.debug("messages: %s", converse_kwargs["messages"])
+
+        has_more = hasMoreResults(
+            kendra_response, 1, AppConfig.SEARCH_RESULTS_PAGE_SIZE
+        )
+
+        stage_started = time.perf_counter()
+        routing_policy = AppConfig.MODEL_ROUTING_POLICY_DICT["rag_search"]
+        if stream:
+            response, answered_model_id, reconcile_usage = await routedConverseAsync(
+                converse_kwargs, routing_policy, stream=True
+            )
+            answer_stream = AsyncConverseStream(
+                response, answered_model_id, stage_started, reconcile_usage
+            )
+            return AsyncRagPipelineResult(
+                None,
+                answer_stream,
+                signed_urls_task,
+                has_more,
+                timings,
+                presign_timings,
+                model_id=answered_model_id,
+            )
+
+        response, answered_model_id, _ = await routedConverseAsync(
+            converse_kwargs, routing_policy
+        )
+        timings["llm"] = time.perf_counter() - stage_started
+        answer = parseConverseAnswer(response, answered_model_id)
+    except BaseException:
+        # 回答を生成できない場合（キャンセルを含む）は、署名付きURLの生成も中止する
+        signed_urls_task.cancel()
+        if retrieve_task is not None:
+            retrieve_task.cancel()
+        raise
+    return AsyncRagPipelineResult(
+        answer,
+        None,
+        signed_urls_task,
+        has_more,
+        timings,
+        presign_timings,
+        model_id=answered_model_id,
+    )
+
+
+async def ragSearchAsync(
+    question,
+    history,
+    selected_model_id,
+    selected_temperature,
+    selected_category_key,
+    stream=False,
+    query_cache=None,
+    history_manager=None,
+):
+    """
+    ragSearchの非同期版（ragSearchPipelineAsyncの結果を、回答と署名付きURLの組として返す）
+    stream=Trueの場合は、署名付きURLの生成を待たずに回答のストリームを返すため、
+    署名付きURLの代わりにAsyncRagPipelineResultを返す（ストリームの読み込み後にgetSignedUrlsで取得する）
+    :param question: ユーザーの質問
+    :param history: ユーザーの会話履歴
+    :param selected_model_id ユーザーが画面で選択したClaudeのモデル
+    :param selected_temperature ユーザーが画面で選択した「振る舞い」（temperature）の値
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param stream: Trueの場合、回答をAsyncConverseStreamとして返す
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: LLMによって生成された回答, 署名付きURL（stream=Trueの場合はAsyncConverseStream, AsyncRagPipelineResult）
+    """
+    result = await ragSearchPipelineAsync(
+        question,
+        history,
+        selected_model_id,
+        selected_temperature,
+        selected_category_key,
+        stream=stream,
+        query_cache=query_cache,
+        history_manager=history_manager,
+    )
+    if stream:
+        return result.stream, result
+    return result.answer, await result.getSignedUrls()
+
+
+@traced("kendra_search")
+async def kendraSearchAsync(
+    kendra_query, selected_category_key, query_cache=None, page_number=1
+):
+    """
+    kendraSearchの非同期版（指定したページの検索結果から署名付きURLを生成し、返却する）
+    :param kendra_query: 検索クエリ
+    :param selected_category_key 画面上で選択された検索対象のドキュメントのkey
+    :param query_cache: Kendraの検索結果のキャッシュ（KendraQueryCache）。Noneの場合はキャッシュしない
+    :param page_number: 取得するページ番号（1ページあたりの件数はAppConfig.SEARCH_RESULTS_PAGE_SIZE）
+    :return: 署名つきURL, 次のページが存在するかどうか
+    """
+    page_size = AppConfig.SEARCH_RESULTS_PAGE_SIZE
+    kendra_response = await queryKendraAsync(
+        kendra_query,
+        selected_category_key,
+        query_cache,
+        page_number=page_number,
+        page_size=page_size,
+    )
+    signed_urls = await generateSignedUrlsAsync(kendra_response)
+    return signed_urls, hasMoreResults(kendra_response, page_number, page_size)
+
+
+@traced("multi_modal")
+async def invokeLLMWithFileAsync(
+    question, uploaded_file, messages, history_manager=None, on_progress=None
+):
+    """
+    invokeLLMWithFileの非同期版（マルチモーダルでのBedrock呼び出しを行う）
+    ファイルの前処理と、大きなPDFの分割要約はスレッドで実行する
+    :param question: ユーザーの質問
+    :param uploaded_file: アップロードされたファイル
+    :param messages:  過去の会話履歴
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :param on_progress: 分割要約の進捗の通知先 on_progress(完了した処理数, 全体の処理数)。スレッドから呼ばれる
+    :return: (LLMからの回答, 実際に回答したモデルのID（エラーの場合はNone）)
+    """
+    model_id = AppConfig.MODEL_ID_DICT["claude_3_haiku"]
+    inference_config = AppConfig.INFERENCE_CONFIG_DICT
+
+    user_message, question, map_reduce_pages, file_content = await asyncio.to_thread(
+        buildFileUserMessage, question, uploaded_file
+    )
+
+    if messages and messages[-1]["role"] != "assistant":
+        messages.append({"role": "assistant", "content": [{"text": "準備中..."}]})
+    messages.append(user_message)
+
+    if map_reduce_pages is not None:
+        try:
+            answer = await asyncio.to_thread(
+                mapReduceSummarize,
+                map_reduce_pages,
+                question,
+                hashlib.sha256(file_content).hexdigest(),
+                model_id=model_id,
+                on_progress=on_progress,
+            )
+            return answer, model_id
+        except Exception as e:
+            return f"エラーが発生しました: {e}", None
+
+    # 会話履歴のファイルの参照は保存領域から読み込むため、スレッドで組み立てる
+    history_manager = history_manager or HistoryManager(summarize=False)
+    converse_kwargs = await asyncio.to_thread(
+        buildConverseKwargs,
+        model_id,
+        history_manager.buildMessages(messages, model_id),
+        inference_config,
+        history_manager.getSummarySystemPrompt(),
+    )
+
+    try:
+        response, answered_model_id, _ = await routedConverseAsync(
+            converse_kwargs, AppConfig.MODEL_ROUTING_POLICY_DICT["multi_modal"]
+        )
+        answer = parseConverseAnswer(response, answered_model_id)
+    except Exception as e:
+        return f"エラーが発生しました: {e}", None
+
+    return answer, answered_model_id
+
+
+@traced("chat")
+async def invokeLLMWithoutFileAsync(history, stream=False, history_manager=None):
+    """
+    invokeLLMWithoutFileの非同期版（会話履歴を考慮したLLMとのチャットを行う）
+    :param history: ユーザーの会話履歴
+    :param stream: Trueの場合、回答をAsyncConverseStream（テキストの差分を返す非同期イテレータ）として返す
+    :param history_manager: 会話履歴の管理（HistoryManager）。Noneの場合は要約を行わずに直近の会話のみ送信する
+    :return: 過去の会話履歴を踏まえて、LLMによって生成された回答（stream=Trueの場合はAsyncConverseStream）
+    """
+    model_id = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+    inference_config = AppConfig.INFERENCE_CONFIG_DICT
+
+    history_manager = history_manager or HistoryManager(summarize=False)
+    converse_kwargs = buildConverseKwargs(
+        model_id,
+        history_manager.buildMessages(history, model_id),
+        inference_config,
+        history_manager.getSummarySystemPrompt(),
+    )
+
+    routing_policy = AppConfig.MODEL_ROUTING_POLICY_DICT["chat"]
+    if stream:
+        response, answered_model_id, reconcile_usage = await routedConverseAsync(
+            converse_kwargs, routing_policy, stream=True
+        )
+        return AsyncConverseStream(
+            response, answered_model_id, reconcile_usage=reconcile_usage
+        )
+
+    response, answered_model_id, _ = await routedConverseAsync(
+        converse_kwargs, routing_policy
+    )
+    return parseConverseAnswer(response, answered_model_id)
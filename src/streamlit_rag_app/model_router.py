@@ -0,0 +1,453 @@
+import collections
+import threading
+import time
+
+from app_config import AppConfig
+from bedrock_scheduler import (
+    BedrockAdmissionError,
+    admission_controller,
+    scheduledConverse,
+    scheduledConverseAsync,
+    scheduledConverseStream,
+    scheduledConverseStreamAsync,
+)
+from botocore.exceptions import BotoCoreError, ClientError
+from context_builder import estimateMessageTokens, getModelKey
+from prompt_cache import CACHE_POINT_BLOCK, supportsPromptCache
+from region_pool import region_pool
+from telemetry import retryAttempts, span
+
+"""
+Bedrockのモデルのルーティング
+モデルIDごとに直近のレイテンシ（ストリーミングの最初の1バイトまでの時間）とスロットリングの発生率を記録し、
+優先するモデルが飽和している場合は、AppConfig.MODEL_FALLBACK_DICTの代替モデルに切り替える
+ポリシーが"auto"の場合は、短い質問を自動的に軽量なモデル（Haiku）に振り分ける
+"""
+
+# スロットリング（またはモデルの一時的な利用不可）とみなすBedrockのエラーコード
+THROTTLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+
+# モデルがリージョンで利用できない（モデルへのアクセスが有効でない、リージョンで提供されていない）とみなすBedrockのエラーコード
+MODEL_UNAVAILABLE_ERROR_CODES = {
+    "AccessDeniedException",
+    "ResourceNotFoundException",
+}
+# モデルがリージョンで利用できないとみなすValidationExceptionのメッセージ
+# （それ以外のValidationExceptionはリクエストの誤りのため、呼び出し直さない）
+MODEL_UNAVAILABLE_VALIDATION_MESSAGES = (
+    "model identifier is invalid",
+    "on-demand throughput",
+    "not supported in this region",
+)
+
+
+class BedrockRoutingError(Exception):
+    """
+    呼び出せるモデル・リージョンの組がない場合のエラー
+    （AppConfig.BEDROCK_MODEL_REGION_KEYS_DICTで、候補のモデルがBEDROCK_REGION_KEYSのいずれのリージョンでも利用できない設定の場合）
+    """
+
+
+class ModelRouter:
+    """
+    モデルIDごとの直近の呼び出し結果を元に、呼び出すモデルの候補を決定するクラス（全セッションで共有）
+    """
+
+    def __init__(self, window_seconds, min_samples, throttle_rate_threshold):
+        """
+        :param window_seconds: レイテンシとスロットリングの発生率を集計する期間（秒）
+        :param min_samples: 飽和の判定に必要な、期間内の最小の呼び出し回数
+        :param throttle_rate_threshold: 飽和とみなすスロットリングの発生率（0〜1）
+        """
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.throttle_rate_threshold = throttle_rate_threshold
+        # モデルIDごとの直近の呼び出し結果 {モデルID: deque[(時刻, 最初の1バイトまでの時間（秒。計測していない場合はNone）, スロットリングの有無)]}
+        self._samples = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def _prune(self, samples, now):
+        while samples and samples[0][0] < now - self.window_seconds:
+            samples.popleft()
+
+    def recordSuccess(self, model_id, latency_seconds=None):
+        """
+        呼び出しの成功とレイテンシを記録する
+        :param model_id: BedrockのモデルID
+        :param latency_seconds: 最初の1バイトまでの時間（秒）。Noneの場合（ストリーミングでない場合）は成功のみ記録する
+        """
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples[model_id]
+            samples.append((now, latency_seconds, False))
+            self._prune(samples, now)
+
+    def recordThrottle(self, model_id):
+        """
+        スロットリングの発生を記録する
+        :param model_id: BedrockのモデルID
+        """
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples[model_id]
+            samples.append((now, None, True))
+            self._prune(samples, now)
+
+    def modelStats(self, model_id):
+        """
+        モデルの直近の呼び出し結果を集計する
+        :param model_id: BedrockのモデルID
+        :return: {samples, throttle_rate, latency_avg_seconds}
+        """
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples[model_id]
+            self._prune(samples, now)
+            latencies = [latency for _, latency, _ in samples if latency is not None]
+            throttles = sum(1 for _, _, throttled in samples if throttled)
+            count = len(samples)
+        return {
+            "samples": count,
+            "throttle_rate": throttles / count if count else 0.0,
+            "latency_avg_seconds": (
+                sum(latencies) / len(latencies) if latencies else None
+            ),
+        }
+
+    def isSaturated(self, model_id):
+        """
+        モデルが飽和しているかどうか
+        （スロットリングの発生率、平均レイテンシ、流量制御の待ち行列の長さのいずれかが上限を超えている場合）
+        :param model_id: BedrockのモデルID
+        :return: 飽和している場合はTrue
+        """
+        stats = self.modelStats(model_id)
+        if (
+            stats["samples"] >= self.min_samples
+            and stats["throttle_rate"] >= self.throttle_rate_threshold
+        ):
+            return True
+        latency_threshold = AppConfig.MODEL_ROUTING_LATENCY_THRESHOLD_SECONDS_DICT.get(
+            getModelKey(model_id)
+        )
+        if (
+            latency_threshold is not None
+            and stats["latency_avg_seconds"] is not None
+            and stats["latency_avg_seconds"] > latency_threshold
+        ):
+            return True
+        queue_depth = admission_controller.queueDepth(model_id)
+        return queue_depth >= AppConfig.MODEL_ROUTING_QUEUE_DEPTH_THRESHOLD
+
+    def selectModels(self, preferred_model_id, messages, policy):
+        """
+        呼び出すモデルの候補を、試す順に返す
+        :param preferred_model_id: 優先するモデルのID
+        :param messages: ConverseAPIに渡す会話履歴（短い質問の判定に使用）
+        :param policy: "fixed"（常に優先するモデル）、"fallback"（飽和時に代替モデルへ切り替え）、
+                       "auto"（fallbackに加え、短い質問を軽量なモデルに振り分ける）
+        :return: モデルIDのリスト
+        """
+        if policy == "fixed":
+            return [preferred_model_id]
+
+        candidates = [preferred_model_id]
+        if policy == "auto" and isSimplePrompt(messages):
+            short_prompt_model_id = AppConfig.MODEL_ID_DICT[
+                AppConfig.MODEL_ROUTING_SHORT_PROMPT_MODEL_KEY
+            ]
+            candidates.insert(0, short_prompt_model_id)
+        for fallback_key in AppConfig.MODEL_FALLBACK_DICT.get(
+            getModelKey(preferred_model_id), []
+        ):
+            candidates.append(AppConfig.MODEL_ID_DICT[fallback_key])
+        candidates = list(dict.fromkeys(candidates))
+
+        # 飽和していないモデルを先に試す（飽和しているモデルも最後の手段として残す）
+        return sorted(candidates, key=self.isSaturated)
+
+
+def isSimplePrompt(messages):
+    """
+    軽量なモデルで回答できる短い質問かどうか
+    （最後のメッセージがファイルを含まない短いテキストで、会話履歴全体も短い場合）
+    :param messages: ConverseAPIに渡す会話履歴
+    :return: 短い質問の場合はTrue
+    """
+    if not messages:
+        return False
+    last_message = messages[-1]
+    if any("text" not in block for block in last_message["content"]):
+        return False
+    return (
+        estimateMessageTokens(last_message)
+        <= AppConfig.MODEL_ROUTING_SHORT_PROMPT_TOKENS
+        and sum(estimateMessageTokens(message) for message in messages)
+        <= AppConfig.MODEL_ROUTING_SIMPLE_MAX_INPUT_TOKENS
+    )
+
+
+# プロセス全体で共有するモデルのルーティング
+model_router = ModelRouter(
+    window_seconds=AppConfig.MODEL_ROUTING_WINDOW_SECONDS,
+    min_samples=AppConfig.MODEL_ROUTING_MIN_SAMPLES,
+    throttle_rate_threshold=AppConfig.MODEL_ROUTING_THROTTLE_RATE_THRESHOLD,
+)
+
+
+def _isThrottleError(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+    )
+
+
+def _isModelUnavailableError(error):
+    if not isinstance(error, ClientError):
+        return False
+    error_info = error.response.get("Error", {})
+    if error_info.get("Code") in MODEL_UNAVAILABLE_ERROR_CODES:
+        return True
+    message = error_info.get("Message", "").lower()
+    return error_info.get("Code") == "ValidationException" and any(
+        pattern in message for pattern in MODEL_UNAVAILABLE_VALIDATION_MESSAGES
+    )
+
+
+def _isConnectionError(error):
+    # 非同期クライアント（aiobotocore）の場合は、接続のタイムアウトがTimeoutErrorとして送出される
+    return isinstance(error, (BotoCoreError, ConnectionError, TimeoutError))
+
+
+def _withModel(converse_kwargs, model_id):
+    """
+    ConverseAPIの引数のモデルIDを置き換える
+    （プロンプトキャッシュに対応していないモデルの場合は、キャッシュのチェックポイントを取り除く）
+    """
+    converse_kwargs = dict(converse_kwargs, modelId=model_id)
+    if not supportsPromptCache(model_id):
+        if "system" in converse_kwargs:
+            converse_kwargs["system"] = [
+                block
+                for block in converse_kwargs["system"]
+                if block != CACHE_POINT_BLOCK
+            ]
+        converse_kwargs["messages"] = [
+            {
+                "role": message["role"],
+                "content": [
+                    block for block in message["content"] if block != CACHE_POINT_BLOCK
+                ],
+            }
+            for message in converse_kwargs["messages"]
+        ]
+    return converse_kwargs
+
+
+def _planAttempts(converse_kwargs, policy):
+    """
+    呼び出すモデル・リージョンの組を、試す順に返す
+    :param converse_kwargs: ConverseAPIの引数（modelIdは優先するモデル）
+    :param policy: ルーティングのポリシー（ModelRouter.selectModelsを参照）
+    :return: [(モデルID, リージョン)]
+    """
+    model_ids = model_router.selectModels(
+        converse_kwargs["modelId"], converse_kwargs["messages"], policy
+    )
+    attempts = [
+        (model_id, region_name)
+        for model_id in model_ids
+        for region_name in region_pool.selectRegions(model_id)
+    ]
+    if not attempts:
+        raise BedrockRoutingError(
+            f"呼び出せるリージョンがありません（モデル: {', '.join(model_ids)}）。"
+            "AppConfig.BEDROCK_REGION_KEYSとBEDROCK_MODEL_REGION_KEYS_DICTの設定を確認してください。"
+        )
+    return attempts
+
+
+def _recordAttemptError(error, model_id, region_name):
+    """
+    呼び出しのエラーを記録する
+    :param error: 送出された例外
+    :param model_id: 呼び出したモデルのID
+    :param region_name: 呼び出したリージョン
+    :return: 呼び出し直せる候補 "any"（スロットリング・接続エラー。次のリージョン・モデル）、
+             "region"（モデルがリージョンで利用できない。同じモデルの次のリージョンのみ）、
+             None（呼び出し直せないエラー）
+    """
+    if _isThrottleError(error):
+        region_pool.recordThrottle(region_name, model_id)
+        model_router.recordThrottle(model_id)
+        return "any"
+    if _isConnectionError(error):
+        region_pool.recordError(region_name)
+        return "any"
+    if _isModelUnavailableError(error):
+        region_pool.recordUnavailable(region_name, model_id)
+        return "region"
+    return None
+
+
+def _canRetry(retry, attempts, index):
+    """
+    エラーが発生した後に、次の候補で呼び出し直すかどうか
+    :param retry: _recordAttemptErrorの結果
+    :param attempts: _planAttemptsの結果
+    :param index: エラーが発生した候補の位置
+    :return: 呼び出し直す場合はTrue
+    """
+    if retry is None or index == len(attempts) - 1:
+        return False
+    # モデルがリージョンで利用できない場合は、代替モデルには切り替えない
+    return retry == "any" or attempts[index + 1][0] == attempts[index][0]
+
+
+def _recordAttemptSuccess(model_id, region_name, timings):
+    # リージョンの比較とモデルの飽和の判定には、最初の1バイトまでの時間（ストリーミングの場合のみ）を使用する
+    # （ストリーミングでない場合のレスポンスまでの時間は出力の長さに比例するため、成功のみ記録する）
+    first_byte_seconds = timings.get("first_byte_seconds")
+    region_pool.recordSuccess(region_name, first_byte_seconds, model_id)
+    model_router.recordSuccess(model_id, first_byte_seconds)
+
+
+def _recordResponseAttributes(attributes, response, stream):
+    if not stream:
+        usage = response.get("usage", {})
+        attributes["input_tokens"] = usage.get("inputTokens")
+        attributes["output_tokens"] = usage.get("outputTokens")
+        attributes["cache_read_tokens"] = usage.get("cacheReadInputTokens")
+    attributes["retries"] = retryAttempts(response)
+
+
+def routedConverse(converse_kwargs, policy, stream=False, priority="interactive"):
+    """
+    ルーティングで決定したモデル・リージョンでConverse（ConverseStream）APIを呼び出す
+    モデルごとにレイテンシの小さいリージョンから順に試し、スロットリングや接続エラー、
+    モデルがリージョンで利用できないエラーが発生した場合は次のリージョン、
+    スロットリングや接続エラーで全てのリージョンで失敗した場合は次の候補のモデルで呼び出し直す
+    （次の候補がある場合は、Bedrockクライアントのリトライ回数と流量制御の待ち時間
+    （AppConfig.MODEL_ROUTING_ADMISSION_WAIT_SECONDS）を抑えて早めに切り替える）
+    :param converse_kwargs: ConverseAPIの引数（modelIdは優先するモデル）
+    :param policy: ルーティングのポリシー（ModelRouter.selectModelsを参照）
+    :param stream: Trueの場合、ConverseStreamAPIを呼び出す
+    :param priority: 流量制御の優先度
+    :return: (レスポンス, 回答したモデルのID, 流量制御のトークン数の補正を行う関数（ストリーミングの場合のみ。それ以外はNone）)
+    """
+    attempts = _planAttempts(converse_kwargs, policy)
+    for i, (model_id, region_name) in enumerate(attempts):
+        is_last = i == len(attempts) - 1
+        client = region_pool.getClient(
+            region_name,
+            max_attempts=None if is_last else AppConfig.MODEL_ROUTING_MAX_ATTEMPTS,
+        )
+        kwargs = _withModel(converse_kwargs, model_id)
+        # 次の候補がある場合は、流量制御で短時間のみ待ち、それ以上待つ見込みの場合（飽和している場合）は次の候補を試す
+        timeout_seconds = (
+            None if is_last else AppConfig.MODEL_ROUTING_ADMISSION_WAIT_SECONDS
+        )
+        timings = {}
+        try:
+            # ストリーミングの場合は、レスポンスのヘッダーを受け取るまでの時間を計測する
+            # （最初/最後のトークンまでの時間は、ConverseStreamで計測する）
+            with span(
+                "bedrock.converse_stream" if stream else "bedrock.converse",
+                model_id=model_id,
+                region=region_name,
+                priority=priority,
+                attempt=i + 1,
+            ) as attributes:
+                if stream:
+                    response, reconcile_usage = scheduledConverseStream(
+                        client, priority, timeout_seconds, timings, **kwargs
+                    )
+                else:
+                    response = scheduledConverse(
+                        client, priority, timeout_seconds, **kwargs
+                    )
+                    reconcile_usage = None
+                _recordResponseAttributes(attributes, response, stream)
+        except BedrockAdmissionError:
+            if is_last:
+                raise
+            continue
+        except Exception as e:
+            if not _canRetry(
+                _recordAttemptError(e, model_id, region_name), attempts, i
+            ):
+                raise
+            continue
+        _recordAttemptSuccess(model_id, region_name, timings)
+        return response, model_id, reconcile_usage
+
+
+async def routedConverseAsync(
+    converse_kwargs, policy, stream=False, priority="interactive"
+):
+    """
+    routedConverseの非同期版（非同期のBedrockクライアントで呼び出す）
+    ルーティング・流量制御・リージョンの選択は、同期版と共有する
+    :param converse_kwargs: ConverseAPIの引数（modelIdは優先するモデル）
+    :param policy: ルーティングのポリシー（ModelRouter.selectModelsを参照）
+    :param stream: Trueの場合、ConverseStreamAPIを呼び出す
+    :param priority: 流量制御の優先度
+    :return: (レスポンス, 回答したモデルのID, 流量制御のトークン数の補正を行う関数（ストリーミングの場合のみ。それ以外はNone）)
+    """
+    attempts = _planAttempts(converse_kwargs, policy)
+    for i, (model_id, region_name) in enumerate(attempts):
+        is_last = i == len(attempts) - 1
+        client = await region_pool.getAsyncClient(
+            region_name,
+            max_attempts=None if is_last else AppConfig.MODEL_ROUTING_MAX_ATTEMPTS,
+        )
+        kwargs = _withModel(converse_kwargs, model_id)
+        timeout_seconds = (
+            None if is_last else AppConfig.MODEL_ROUTING_ADMISSION_WAIT_SECONDS
+        )
+        timings = {}
+        try:
+            with span(
+                "bedrock.converse_stream" if stream else "bedrock.converse",
+                model_id=model_id,
+                region=region_name,
+                priority=priority,
+                attempt=i + 1,
+            ) as attributes:
+                if stream:
+                    response, reconcile_usage = await scheduledConverseStreamAsync(
+                        client, priority, timeout_seconds, timings, **kwargs
+                    )
+                else:
+                    response = await scheduledConverseAsync(
+                        client, priority, timeout_seconds, **kwargs
+                    )
+                    reconcile_usage = None
+                _recordResponseAttributes(attributes, response, stream)
+        except BedrockAdmissionError:
+            if is_last:
+                raise
+            continue
+        except Exception as e:
+            if not _canRetry(
+                _recordAttemptError(e, model_id, region_name), attempts, i
+            ):
+                raise
+            continue
+        _recordAttemptSuccess(model_id, region_name, timings)
+        return response, model_id, reconcile_usage
+
+
+def getRouterStats():
+    """
+    モデルごとの直近のレイテンシとスロットリングの発生率を返す
+    :return: {モデルID: ModelRouter.modelStatsの結果}
+    """
+    return {
+        model_id: model_router.modelStats(model_id)
+        for model_id in AppConfig.MODEL_ID_DICT.values()
+    }
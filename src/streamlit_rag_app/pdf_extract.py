@@ -0,0 +1,165 @@
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from app_config import AppConfig
+from caches import TTLLRUCache
+from context_builder import estimateTokens
+
+"""
+PDFのテキスト抽出
+アップロードされたPDFをローカルで解析し、テキストを含むページはページ番号付きのテキストとして、
+テキストを含まないページ（スキャンされたページ）のみ画像としてBedrockに送信する
+ページ数の多いPDFは、プロセスプールでページを分割して並列に抽出する
+（PDFは一時ファイルに1度だけ書き出し、ワーカーにはファイルのパスとページの範囲のみを渡す）
+"""
+
+logger = logging.getLogger(__name__)
+
+# 抽出済みのPDFのキャッシュ {PDFのハッシュ値: 抽出結果}
+_extracted_cache = TTLLRUCache(max_entries=AppConfig.PDF_EXTRACT_CACHE_MAX_ENTRIES)
+
+# ページの抽出を行うプロセスプール（初回利用時に生成）
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _getProcessPool():
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                # Streamlit/uvicornのプロセスは複数のスレッドを持つため、forkでワーカーを生成しない
+                # （ロックを保持したままのスレッドの状態を複製し、デッドロックすることがある）
+                start_method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                _process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=AppConfig.PDF_EXTRACT_MAX_WORKERS,
+                    mp_context=multiprocessing.get_context(start_method),
+                )
+    return _process_pool
+
+
+def _extractPageRange(pdf_source, start, end):
+    """
+    指定した範囲のページからテキストを抽出する（プロセスプールのワーカーで実行される）
+    テキストがほとんどなく、画像を含むページはスキャンされたページとみなし、画像として書き出す
+    :param pdf_source: PDFの内容（bytes）、またはPDFファイルのパス（ワーカーで実行する場合）
+    :param start: 抽出を開始するページのインデックス
+    :param end: 抽出を終了するページのインデックス（このページは含まない）
+    :return: ページ（page_number, text, image）のリスト
+    """
+    import pymupdf
+
+    pages = []
+    if isinstance(pdf_source, bytes):
+        document = pymupdf.open(stream=pdf_source, filetype="pdf")
+    else:
+        document = pymupdf.open(pdf_source, filetype="pdf")
+    with document:
+        for index in range(start, end):
+            page = document[index]
+            text = page.get_text("text").strip()
+            image = None
+            if len(text) < AppConfig.PDF_SCANNED_PAGE_MIN_CHARS and page.get_images():
+                text = ""
+                image = page.get_pixmap(dpi=AppConfig.PDF_SCANNED_PAGE_DPI).tobytes(
+                    "png"
+                )
+            pages.append({"page_number": index + 1, "text": text, "image": image})
+    return pages
+
+
+def extractPdf(pdf_bytes):
+    """
+    PDFからページごとのテキストと、スキャンされたページの画像を抽出する
+    ページ数がAppConfig.PDF_EXTRACT_PARALLEL_MIN_PAGES以上の場合は、プロセスプールで並列に抽出する
+    :param pdf_bytes: PDFの内容
+    :return: ページ（page_number, text, image）のリスト。PDFとして読み込めない場合はNone
+    """
+    content_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached = _extracted_cache.get(content_hash)
+    if cached is not None:
+        return cached
+
+    # PyMuPDFは読み込みに時間がかかるため、PDFがアップロードされるまで読み込まない（起動時間の短縮）
+    import pymupdf
+
+    try:
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as document:
+            if document.needs_pass:
+                return None
+            page_count = document.page_count
+    except Exception as e:
+        logger.warning("Error opening PDF: %s", e)
+        return None
+
+    if page_count < AppConfig.PDF_EXTRACT_PARALLEL_MIN_PAGES:
+        pages = _extractPageRange(pdf_bytes, 0, page_count)
+    else:
+        # ワーカーごとにPDFの内容を渡さないよう、一時ファイルに書き出してパスを渡す
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+            pdf_file.write(pdf_bytes)
+        try:
+            chunk_size = AppConfig.PDF_EXTRACT_PAGES_PER_TASK
+            futures = [
+                _getProcessPool().submit(
+                    _extractPageRange,
+                    pdf_file.name,
+                    start,
+                    min(start + chunk_size, page_count),
+                )
+                for start in range(0, page_count, chunk_size)
+            ]
+            # ページ順を維持するため、投入した順に結果を受け取る
+            pages = [page for future in futures for page in future.result()]
+        finally:
+            os.remove(pdf_file.name)
+
+    _extracted_cache.put(content_hash, pages)
+    return pages
+
+
+def buildPdfText(pages, max_tokens=None):
+    """
+    抽出したページのテキストを、ページ番号の区切り付きで連結する
+    トークン数の上限を超えた以降のページは省略する
+    :param pages: extractPdfで抽出したページのリスト
+    :param max_tokens: トークン数の上限（省略時はAppConfig.PDF_EXTRACT_MAX_TOKENS）
+    :return: (連結したテキスト, 概算のトークン数)
+    """
+    max_tokens = max_tokens or AppConfig.PDF_EXTRACT_MAX_TOKENS
+    sections = []
+    used_tokens = 0
+    for page in pages:
+        if page["image"] is not None:
+            section = f"--- {page['page_number']}ページ ---\n（スキャンされたページ）"
+        elif page["text"]:
+            section = f"--- {page['page_number']}ページ ---\n{page['text']}"
+        else:
+            continue
+        tokens = estimateTokens(section)
+        if used_tokens + tokens > max_tokens:
+            sections.append(
+                f"（{page['page_number']}ページ以降は、長さの上限のため省略されました）"
+            )
+            break
+        sections.append(section)
+        used_tokens += tokens
+    return "\n\n".join(sections), used_tokens
+
+
+def isTextBasedPdf(pages):
+    """
+    テキストとして送信するPDFかどうか（全てのページがスキャンされたページでないこと）
+    :param pages: extractPdfで抽出したページのリスト
+    :return: テキストを含むページがある場合はTrue
+    """
+    return any(page["text"] for page in pages)
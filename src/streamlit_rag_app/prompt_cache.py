@@ -0,0 +1,97 @@
+import threading
+
+from app_config import AppConfig
+from context_builder import estimateMessageTokens, estimateTokens
+
+"""
+Amazon Bedrockのプロンプトキャッシュ
+連続するConverseAPIの呼び出しで変わらない部分（システムプロンプトと、過去の会話履歴）の末尾に
+キャッシュのチェックポイント（cachePoint）を置き、2回目以降の入力トークンの処理を省略させる
+"""
+
+# キャッシュのチェックポイントを表すコンテンツブロック
+CACHE_POINT_BLOCK = {"cachePoint": {"type": "default"}}
+
+# モデルごとのトークン使用量の累計（キャッシュの効果を確認するため）
+_usage_totals = {}
+_usage_lock = threading.Lock()
+
+
+def supportsPromptCache(model_id):
+    """
+    モデルがプロンプトキャッシュに対応しているかどうか
+    （クロスリージョン推論プロファイルのID（"us.anthropic..."など）にも対応する）
+    :param model_id: BedrockのモデルID
+    :return: 対応している場合はTrue
+    """
+    return any(
+        model_id.endswith(supported_model_id)
+        for supported_model_id in AppConfig.PROMPT_CACHE_SUPPORTED_MODEL_IDS
+    )
+
+
+def applyPromptCache(model_id, system_prompt, messages, stable_message_count):
+    """
+    システムプロンプトと、変わらない会話履歴の末尾にキャッシュのチェックポイントを置く
+    チェックポイントより前のトークン数が、キャッシュできる最小のトークン数に満たない場合は置かない
+    （元のシステムプロンプト・会話履歴は変更せず、チェックポイントを追加したコピーを返す）
+    :param model_id: BedrockのモデルID
+    :param system_prompt: システムプロンプトのリスト
+    :param messages: ConverseAPIに渡す会話履歴
+    :param stable_message_count: 次回の呼び出しでも変わらない、先頭からのメッセージ数
+    :return: (システムプロンプト, 会話履歴)
+    """
+    if not supportsPromptCache(model_id):
+        return system_prompt, messages
+
+    min_tokens = AppConfig.PROMPT_CACHE_MIN_TOKENS
+    system_tokens = sum(
+        estimateTokens(block.get("text", "")) for block in system_prompt
+    )
+    if system_prompt and system_tokens >= min_tokens:
+        system_prompt = system_prompt + [CACHE_POINT_BLOCK]
+
+    # チェックポイントまでのトークン数はシステムプロンプトを含めて数える
+    prefix_tokens = system_tokens + sum(
+        estimateMessageTokens(message) for message in messages[:stable_message_count]
+    )
+    if stable_message_count > 0 and prefix_tokens >= min_tokens:
+        messages = list(messages)
+        last_stable = messages[stable_message_count - 1]
+        messages[stable_message_count - 1] = {
+            "role": last_stable["role"],
+            "content": last_stable["content"] + [CACHE_POINT_BLOCK],
+        }
+    return system_prompt, messages
+
+
+def recordUsage(model_id, usage):
+    """
+    ConverseAPIのレスポンスのトークン使用量を、モデルごとに累計する
+    :param model_id: BedrockのモデルID
+    :param usage: レスポンスのusage（inputTokens, outputTokens, cacheReadInputTokens, cacheWriteInputTokens）
+    """
+    with _usage_lock:
+        totals = _usage_totals.setdefault(
+            model_id,
+            {
+                "requests": 0,
+                "inputTokens": 0,
+                "outputTokens": 0,
+                "cacheReadInputTokens": 0,
+                "cacheWriteInputTokens": 0,
+            },
+        )
+        totals["requests"] += 1
+        for key in totals:
+            if key != "requests":
+                totals[key] += usage.get(key, 0)
+
+
+def getUsageStats():
+    """
+    モデルごとのトークン使用量の累計を返す
+    :return: {モデルID: {requests, inputTokens, outputTokens, cacheReadInputTokens, cacheWriteInputTokens}}
+    """
+    with _usage_lock:
+        return {model_id: dict(totals) for model_id, totals in _usage_totals.items()}
@@ -0,0 +1,246 @@
+import random
+import threading
+import time
+
+from app_config import AppConfig
+from aws_clients import getBedrockClient
+from context_builder import getModelKey
+
+"""
+複数リージョンのBedrockクライアントのプール
+AppConfig.BEDROCK_REGION_KEYSのリージョンごとに、(リージョン, モデル)ごとのレイテンシ（指数移動平均）とスロットリング・エラーの発生状況を記録し、
+リクエストごとに、正常なリージョンの中から最もレイテンシの小さいリージョンを選択する
+（レイテンシは、ストリーミングのレスポンスのヘッダーを受け取るまでの時間（最初の1バイトまでの時間）のみを記録する。
+出力の長さに比例する生成全体の時間は、リージョンの比較に使用しない）
+スロットリングやエラーが発生したリージョンは、一定時間（連続して発生するほど長く）選択の優先度を下げる
+（Bedrockのクォータはモデルごとに設定されるため、スロットリングは(リージョン, モデル)ごと、接続エラーはリージョン全体に適用する）
+"""
+
+
+class RegionClientPool:
+    """
+    リージョンごとの状態を元に、Bedrockクライアントを選択するクラス（全セッションで共有）
+    """
+
+    def __init__(
+        self,
+        region_names,
+        client_factory=None,
+        async_client_factory=None,
+        latency_alpha=0.3,
+        cooldown_seconds=10,
+        max_cooldown_seconds=300,
+        explore_rate=0.0,
+    ):
+        """
+        :param region_names: リージョン名のリスト（先頭ほど、レイテンシが同じ場合に優先する）
+        :param client_factory: クライアントの生成関数 client_factory(region_name, max_attempts)（省略時はgetBedrockClient）
+        :param async_client_factory: 非同期クライアントの生成関数（コルーチン） async_client_factory(region_name, max_attempts)
+                                     （省略時はasync_aws_clients.getAsyncBedrockClient）
+        :param latency_alpha: レイテンシの指数移動平均の係数（0〜1。大きいほど直近の値を重視する）
+        :param cooldown_seconds: スロットリング・エラーが発生したリージョンの優先度を下げる時間（秒）
+        :param max_cooldown_seconds: 連続して発生した場合の、優先度を下げる時間の上限（秒）
+        :param explore_rate: レイテンシの推定値を更新するため、最速以外のリージョン（未計測のリージョンを含む）を先に試す確率（0〜1）
+        """
+        self.region_names = list(region_names)
+        self.client_factory = client_factory or (
+            lambda region_name, max_attempts: getBedrockClient(
+                region_name, max_attempts=max_attempts
+            )
+        )
+        self.async_client_factory = async_client_factory
+        self.latency_alpha = latency_alpha
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.explore_rate = explore_rate
+        # リージョンごとの状態
+        self._regions = {
+            region_name: {
+                "successes": 0,
+                "throttles": 0,
+                "errors": 0,
+                "unavailable": 0,
+            }
+            for region_name in self.region_names
+        }
+        # (リージョン名, モデルID)ごとのレイテンシ（最初の1バイトまでの時間の指数移動平均。秒）
+        self._latencies = {}
+        # 優先度を下げている期間 {(リージョン名, モデルID（リージョン全体の場合はNone）): (終了時刻, 連続した失敗の回数)}
+        self._cooldowns = {}
+        self._lock = threading.Lock()
+
+    def getClient(self, region_name, max_attempts=None):
+        """
+        リージョンのBedrockクライアントを取得する
+        :param region_name: リージョン名
+        :param max_attempts: 最大試行回数（省略時はAppConfig.RETRY_CONFIGSの設定）
+        :return: Bedrock Runtimeクライアント
+        """
+        return self.client_factory(region_name, max_attempts)
+
+    async def getAsyncClient(self, region_name, max_attempts=None):
+        """
+        リージョンの非同期のBedrockクライアントを取得する
+        :param region_name: リージョン名
+        :param max_attempts: 最大試行回数（省略時はAppConfig.RETRY_CONFIGSの設定）
+        :return: Bedrock Runtimeの非同期クライアント（aiobotocore）
+        """
+        if self.async_client_factory is None:
+            # aiobotocoreは非同期のバックエンドを使用する場合のみ必要なため、ここで読み込む
+            from async_aws_clients import getAsyncBedrockClient
+
+            self.async_client_factory = getAsyncBedrockClient
+        return await self.async_client_factory(region_name, max_attempts)
+
+    def selectRegions(self, model_id=None):
+        """
+        リクエストを送信するリージョンを、試す順に返す
+        正常なリージョンをモデルのレイテンシの小さい順に並べ（未計測のリージョンは計測済みのリージョンの後に、設定の順に並べる）、
+        スロットリング・エラーで優先度を下げているリージョンは最後に並べる
+        （未計測のリージョンは、explore_rateの確率で先に試すことで計測する）
+        :param model_id: BedrockのモデルID（AppConfig.BEDROCK_MODEL_REGION_KEYS_DICTで、利用できるリージョンを絞り込む）
+        :return: リージョン名のリスト
+        """
+        region_names = self.region_names
+        allowed_region_keys = AppConfig.BEDROCK_MODEL_REGION_KEYS_DICT.get(
+            getModelKey(model_id)
+        )
+        if allowed_region_keys:
+            allowed = {
+                AppConfig.REGION_NAME_DICT[region_key]
+                for region_key in allowed_region_keys
+            }
+            region_names = [name for name in region_names if name in allowed]
+
+        now = time.monotonic()
+        with self._lock:
+            healthy = []
+            cooling = []
+            for priority, region_name in enumerate(region_names):
+                state = self._regions[region_name]
+                cooldown_until = max(
+                    self._cooldowns.get((region_name, None), (0.0, 0))[0],
+                    self._cooldowns.get((region_name, model_id), (0.0, 0))[0],
+                )
+                if cooldown_until > now:
+                    cooling.append((cooldown_until, region_name))
+                else:
+                    latency = self._latencies.get((region_name, model_id))
+                    healthy.append(
+                        (
+                            latency is None,
+                            latency or 0.0,
+                            priority,
+                            region_name,
+                        )
+                    )
+        ordered = [region_name for *_, region_name in sorted(healthy)]
+        # 一定の確率で、最速以外のリージョンを先に試してレイテンシの推定値を更新する
+        if len(ordered) > 1 and random.random() < self.explore_rate:
+            explored = ordered.pop(random.randrange(1, len(ordered)))
+            ordered.insert(0, explored)
+        return ordered + [region_name for _, region_name in sorted(cooling)]
+
+    def recordSuccess(self, region_name, latency_seconds=None, model_id=None):
+        """
+        リクエストの成功とレイテンシを記録する
+        :param region_name: リージョン名
+        :param latency_seconds: 最初の1バイトまでの時間（秒）。Noneの場合（ストリーミングでない場合）は成功のみ記録する
+        :param model_id: BedrockのモデルID
+        """
+        with self._lock:
+            if latency_seconds is not None:
+                previous = self._latencies.get((region_name, model_id))
+                self._latencies[(region_name, model_id)] = (
+                    latency_seconds
+                    if previous is None
+                    else self.latency_alpha * latency_seconds
+                    + (1 - self.latency_alpha) * previous
+                )
+            state = self._regions[region_name]
+            state["successes"] += 1
+            self._cooldowns.pop((region_name, None), None)
+            self._cooldowns.pop((region_name, model_id), None)
+
+    def recordThrottle(self, region_name, model_id=None):
+        """
+        スロットリングの発生を記録し、リージョンでのモデルの優先度を一定時間下げる
+        :param region_name: リージョン名
+        :param model_id: BedrockのモデルID（Noneの場合はリージョン全体）
+        """
+        self._recordFailure(region_name, model_id, "throttles")
+
+    def recordError(self, region_name):
+        """
+        接続エラーなどの発生を記録し、リージョン全体の優先度を一定時間下げる
+        :param region_name: リージョン名
+        """
+        self._recordFailure(region_name, None, "errors")
+
+    def recordUnavailable(self, region_name, model_id):
+        """
+        モデルがリージョンで利用できない（モデルへのアクセスが有効でない・提供されていない）ことを記録し、
+        リージョンでのモデルの優先度をmax_cooldown_secondsの間下げる
+        :param region_name: リージョン名
+        :param model_id: BedrockのモデルID
+        """
+        with self._lock:
+            self._regions[region_name]["unavailable"] += 1
+            self._cooldowns[(region_name, model_id)] = (
+                time.monotonic() + self.max_cooldown_seconds,
+                0,
+            )
+
+    def _recordFailure(self, region_name, model_id, counter):
+        with self._lock:
+            self._regions[region_name][counter] += 1
+            _, failures = self._cooldowns.get((region_name, model_id), (0.0, 0))
+            failures += 1
+            cooldown = min(
+                self.cooldown_seconds * 2 ** (failures - 1),
+                self.max_cooldown_seconds,
+            )
+            self._cooldowns[(region_name, model_id)] = (
+                time.monotonic() + cooldown,
+                failures,
+            )
+
+    def stats(self):
+        """
+        リージョンごとの状態を返す
+        :return: {リージョン名: {latency_seconds（{モデルID: 最初の1バイトまでの時間}）, healthy（接続エラーで優先度を下げていないか）, successes, throttles, errors, unavailable}}
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                region_name: {
+                    "latency_seconds": {
+                        model_id: latency
+                        for (
+                            latency_region,
+                            model_id,
+                        ), latency in self._latencies.items()
+                        if latency_region == region_name
+                    },
+                    "healthy": self._cooldowns.get((region_name, None), (0.0, 0))[0]
+                    <= now,
+                    "successes": state["successes"],
+                    "throttles": state["throttles"],
+                    "errors": state["errors"],
+                    "unavailable": state["unavailable"],
+                }
+                for region_name, state in self._regions.items()
+            }
+
+
+# プロセス全体で共有するリージョンのプール
+region_pool = RegionClientPool(
+    [
+        AppConfig.REGION_NAME_DICT[region_key]
+        for region_key in AppConfig.BEDROCK_REGION_KEYS
+    ],
+    latency_alpha=AppConfig.BEDROCK_REGION_LATENCY_ALPHA,
+    cooldown_seconds=AppConfig.BEDROCK_REGION_COOLDOWN_SECONDS,
+    max_cooldown_seconds=AppConfig.BEDROCK_REGION_MAX_COOLDOWN_SECONDS,
+    explore_rate=AppConfig.BEDROCK_REGION_EXPLORE_RATE,
+)
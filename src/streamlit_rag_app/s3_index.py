@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+from telemetry import span
+
+"""
+S3のプレフィックス配下のオブジェクトキーのインデックス
+list_objects_v2でまとめて取得したキーをメモリ上のsetとして保持し、
+検索結果ごとのhead_objectによる存在確認をローカルでの参照に置き換える
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class S3KeyIndex:
+    """
+    指定したプレフィックス配下のオブジェクトキーを保持するインデックス
+    一定間隔で、または存在しないキーを参照した際に、バックグラウンドで再構築する
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket_name,
+        prefix,
+        refresh_interval_seconds,
+        min_refresh_interval_seconds,
+    ):
+        """
+        :param s3_client: S3クライアント（list_objects_v2のpaginatorが使えるもの）
+        :param bucket_name: バケット名
+        :param prefix: インデックス対象のプレフィックス（"hogehoge/"など）
+        :param refresh_interval_seconds: 定期的に再構築する間隔（秒）
+        :param min_refresh_interval_seconds: 再構築を行う最短の間隔（秒）。存在しないキーの参照が続いた場合の連続した再構築を防ぐ
+        """
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        # 構築済みのキーの集合（未構築の場合はNone）
+        self._keys = None
+        # 最後に構築を開始した時刻（time.monotonic基準）
+        self._last_refresh_started = None
+        # 構築中にaddで追加されたキー（構築中でない場合はNone。構築した集合に含めてから差し替える）
+        self._added_during_build = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+
+    def build(self):
+        """
+        list_objects_v2でプレフィックス配下の全てのキーを取得し、インデックスを構築する
+        （構築の開始から、min_refresh_interval_seconds以内の再構築の要求は行わない）
+        :return: 取得したキーの数
+        """
+        with self._lock:
+            self._last_refresh_started = time.monotonic()
+            self._added_during_build = set()
+        keys = set()
+        try:
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+                for obj in page.get("Contents", []):
+                    keys.add(obj["Key"])
+        except Exception:
+            with self._lock:
+                self._added_during_build = None
+            raise
+        # 構築が完了したタイミングでまとめて差し替える（参照中のスレッドに影響を与えないため）
+        # 一覧の取得後にaddで追加されたキーが失われないよう、構築中に追加されたキーを含めてから差し替える
+        with self._lock:
+            keys |= self._added_during_build or set()
+            self._added_during_build = None
+            self._keys = keys
+        return len(keys)
+
+    @property
+    def is_ready(self):
+        """
+        インデックスが構築済みかどうか
+        """
+        return self._keys is not None
+
+    def contains(self, object_key):
+        """
+        キーが存在するかをインデックスから判定する
+        存在しない場合は、インデックスが古い可能性があるためバックグラウンドで再構築を要求する
+        :param object_key: オブジェクトキー
+        :return: 存在する場合はTrue、存在しない場合はFalse、インデックスが未構築の場合はNone
+        """
+        keys = self._keys
+        if keys is None:
+            return None
+        if object_key in keys:
+            return True
+        self.refreshAsync()
+        return False
+
+    def add(self, object_key):
+        """
+        存在を確認したキーをインデックスに追加する（インデックスの再構築を待たずに、以降の参照で存在すると判定するため）
+        :param object_key: オブジェクトキー
+        """
+        with self._lock:
+            if self._keys is not None:
+                self._keys.add(object_key)
+            if self._added_during_build is not None:
+                self._added_during_build.add(object_key)
+
+    def refreshAsync(self):
+        """
+        バックグラウンドでインデックスを再構築する
+        （再構築中、または前回の構築開始からmin_refresh_interval_seconds以内の場合は何もしない）
+        :return: 再構築を開始した場合はTrue
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or (
+                self._last_refresh_started is not None
+                and now - self._last_refresh_started < self.min_refresh_interval_seconds
+            ):
+                return False
+            self._refreshing = True
+            self._last_refresh_started = now
+
+        threading.Thread(
+            target=self._refresh, name="s3-key-index-refresh", daemon=True
+        ).start()
+        return True
+
+    def _refresh(self):
+        """
+        インデックスを再構築する（失敗した場合は構築済みのインデックスをそのまま使う）
+        """
+        try:
+            with span("s3.key_index_refresh") as attributes:
+                key_count = self.build()
+                attributes["result_count"] = key_count
+            logger.info(
+                "S3 key index refreshed: s3://%s/%s (%d keys)",
+                self.bucket_name,
+                self.prefix,
+                key_count,
+            )
+        except Exception as e:
+            logger.warning("Error refreshing S3 key index: %s", e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def start(self):
+        """
+        インデックスの初回構築と、定期的な再構築をバックグラウンドで開始する
+        """
+        if self._refresh_thread is not None:
+            return
+        self._refresh_thread = threading.Thread(
+            target=self._refreshPeriodically, name="s3-key-index", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _refreshPeriodically(self):
+        while not self._stop_event.is_set():
+            self.refreshAsync()
+            self._stop_event.wait(self.refresh_interval_seconds)
+
+    def stop(self):
+        """
+        定期的な再構築を停止する
+        """
+        self._stop_event.set()
@@ -0,0 +1,205 @@
+import contextlib
+import functools
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from app_config import AppConfig
+from telemetry import recordSpan
+
+"""
+起動時間の短縮
+バックエンド（kendra_bedrock_query）の読み込みと、AWSクライアントの生成を初回利用時まで遅延させ、
+起動直後にバックグラウンドで読み込み・クライアントの生成・接続の確立（ウォームアップ）を行う
+読み込み・初期化・ウォームアップの処理時間は、起動時間のレポート（startup_report）に記録する
+
+起動時間のレポートの確認方法（src/streamlit_rag_appで実行。新しいプロセスで計測する）:
+    python startup.py
+"""
+
+logger = logging.getLogger(__name__)
+
+# 読み込み時間を計測するバックエンドのモジュール（依存される順。先に読み込んだモジュールに、共通の依存の読み込み時間が計上される）
+BACKEND_MODULES = [
+    "app_config",
+    "telemetry",
+    "caches",
+    "context_builder",
+    "prompt_cache",
+    "aws_clients",
+    "bedrock_scheduler",
+    "region_pool",
+    "model_router",
+    "history_manager",
+    "attachment_store",
+    "image_preprocess",
+    "pdf_extract",
+    "doc_summarizer",
+    "s3_index",
+    "kendra_bedrock_query",
+]
+
+
+class StartupReport:
+    """
+    起動時の処理（読み込み・初期化・ウォームアップ）ごとの処理時間を記録するクラス（プロセス全体で共有）
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, phase, name):
+        """
+        ブロックの処理時間を、起動時の処理として記録する
+        :param phase: 処理の種類（"import", "init", "warmup"）
+        :param name: 処理の対象（モジュール名、サービス名など）
+        """
+        entry = {"phase": phase, "name": name, "seconds": None, "error": None}
+        started_at = time.perf_counter()
+        try:
+            yield entry
+        except Exception as e:
+            entry["error"] = type(e).__name__
+            raise
+        finally:
+            entry["seconds"] = time.perf_counter() - started_at
+            with self._lock:
+                self._entries.append(entry)
+            attributes = {"target": name}
+            if entry["error"]:
+                attributes["error"] = entry["error"]
+            recordSpan(f"startup.{phase}", entry["seconds"], **attributes)
+
+    def entries(self):
+        """
+        記録した処理のリスト（記録した順）
+        :return: [{phase, name, seconds, error, already_loaded（importのみ。読み込み済みだったかどうか）}]
+        """
+        with self._lock:
+            return [dict(entry) for entry in self._entries]
+
+    def stats(self):
+        """
+        処理の種類ごとの合計時間と、処理ごとの処理時間を返す
+        :return: {totals: {処理の種類: 合計時間（秒）}, entries: entriesの結果}
+        """
+        entries = self.entries()
+        totals = {}
+        for entry in entries:
+            totals[entry["phase"]] = totals.get(entry["phase"], 0.0) + entry["seconds"]
+        return {"totals": totals, "entries": entries}
+
+
+# プロセス全体で共有する起動時間のレポート
+startup_report = StartupReport()
+
+# 読み込み済みのバックエンドのモジュール
+_backend = None
+_backend_lock = threading.Lock()
+# ウォームアップのスレッド
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+
+
+def getBackend():
+    """
+    バックエンドのモジュール（kendra_bedrock_query）を返す（初回呼び出し時に読み込み、モジュールごとの読み込み時間を記録する）
+    ウォームアップで読み込み中の場合は、読み込みの完了を待つ
+    :return: kendra_bedrock_queryモジュール
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                for module_name in BACKEND_MODULES:
+                    with startup_report.phase("import", module_name) as entry:
+                        # 読み込み済みのモジュール（app.pyなどで先に読み込まれたもの）は、処理時間がほぼ0となる
+                        entry["already_loaded"] = module_name in sys.modules
+                        module = importlib.import_module(module_name)
+                _backend = module
+    return _backend
+
+
+def _openConnection(client):
+    """
+    クライアントのエンドポイントへの接続（名前解決・TLSのハンドシェイク）を確立し、クライアントのコネクションプールに残す
+    署名なしのHEADリクエストを送信し、レスポンス（認証エラーなど）は使用しない
+    :param client: boto3のクライアント
+    """
+    from botocore.awsrequest import AWSRequest
+
+    request = AWSRequest(method="HEAD", url=client.meta.endpoint_url + "/")
+    client._endpoint.http_session.send(request.prepare())
+
+
+def warmUp():
+    """
+    バックエンドの読み込み、AWSクライアントの生成、エンドポイントへの接続の確立を行う
+    （AppConfig.STARTUP_WARMUP_SERVICESのサービス。Bedrockは利用する全てのリージョン）
+    失敗しても初回のリクエストで改めて行われるため、エラーはログに出力するのみとする
+    """
+    try:
+        backend = getBackend()
+        from aws_clients import getKendraClient, getS3Client, loadEnvironment
+        from region_pool import region_pool
+
+        with startup_report.phase("init", "dotenv"):
+            loadEnvironment()
+        with startup_report.phase("import", "boto3"):
+            importlib.import_module("boto3")
+
+        targets = []
+        if "kendra" in AppConfig.STARTUP_WARMUP_SERVICES:
+            targets.append(("kendra", getKendraClient))
+        if "bedrock-runtime" in AppConfig.STARTUP_WARMUP_SERVICES:
+            targets.extend(
+                (
+                    f"bedrock-runtime:{region_name}",
+                    functools.partial(region_pool.getClient, region_name),
+                )
+                for region_name in region_pool.region_names
+            )
+        for name, factory in targets:
+            with startup_report.phase("init", name):
+                client = factory()
+            try:
+                with startup_report.phase("warmup", name):
+                    _openConnection(client)
+            except Exception as e:
+                logger.warning("Warm-up connection to %s failed: %s", name, e)
+
+        # S3は、PDFファイルの存在確認用インデックスの構築（list_objects_v2）で接続を確立する
+        bucket_name = os.getenv("bucket_name")
+        if "s3" in AppConfig.STARTUP_WARMUP_SERVICES and bucket_name:
+            with startup_report.phase("init", "s3"):
+                s3_client = getS3Client()
+            with startup_report.phase("warmup", "s3"):
+                backend.getPdfKeyIndex(s3_client, bucket_name)
+    except Exception as e:
+        logger.warning("Backend warm-up failed: %s", e)
+
+
+def startWarmUp():
+    """
+    ウォームアップ（warmUp）をバックグラウンドのスレッドで開始する（プロセスで1度だけ）
+    :return: ウォームアップのスレッド
+    """
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(
+                target=warmUp, name="backend-warm-up", daemon=True
+            )
+            _warm_up_thread.start()
+    return _warm_up_thread
+
+
+if __name__ == "__main__":
+    warmUp()
+    print(json.dumps(startup_report.stats(), ensure_ascii=False, indent=2))
@@ -0,0 +1,400 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import http.server
+import inspect
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+
+from app_config import AppConfig
+
+"""
+処理のステージごとの計測（レイテンシ・検索結果の件数・リトライ回数・トークン使用量）
+ステージ（kendra.query, s3.head_object, bedrock.converseなど）ごとの計測結果をスパンとして記録し、
+ステージごとのヒストグラムに集計する（AppConfig.TELEMETRY_SPAN_LOG_ENABLEDがTrueの場合は、リクエストIDを付けたJSON形式のログにも出力する）
+集計結果はPrometheusのテキスト形式で出力でき、HTTPサーバー（AppConfig.TELEMETRY_METRICS_PORT）や画面から参照する
+"""
+
+# スパンのログの出力先（標準エラー出力に、1スパン1行のJSONで出力する）
+logger = logging.getLogger("streamlit_rag_app.telemetry")
+if AppConfig.TELEMETRY_SPAN_LOG_ENABLED and not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# 処理中のリクエストのID（スレッドプールに投入した処理へは、submitWithContextで引き継ぐ）
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+# スパンの記録時に呼び出す関数のリスト（ベンチマークなどで、集計前の値を参照するために使用する）
+_span_listeners = []
+
+
+class Histogram:
+    """
+    処理時間のヒストグラム（Prometheusのhistogramと同じく、区切りごとの累積の件数を保持する）
+    ※排他制御は呼び出し元で行うこと
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: 区切りの値（昇順）のリスト
+        """
+        self.buckets = list(buckets)
+        # 区切りごとの件数（最後の要素は、全ての区切りを超えた件数）
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        値を記録する
+        :param value: 記録する値
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        分位数を、区切りの中で線形補間して推定する
+        :param q: 分位（0〜1）
+        :return: 推定値（記録がない場合はNone。最後の区切りを超える場合は最後の区切りの値）
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class StageMetrics:
+    """
+    ステージごとのスパンの集計（全セッションで共有）
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: 処理時間のヒストグラムの区切り（秒）
+        """
+        self.buckets = buckets
+        # ステージ名ごとの集計 {ステージ名: {"histogram", "errors", "retries", "results"}}
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, error=False, retries=0, results=None):
+        """
+        スパンの計測結果を集計する
+        :param stage: ステージ名
+        :param seconds: 処理時間（秒）
+        :param error: エラーが発生したかどうか
+        :param retries: AWS SDKによるリトライ回数
+        :param results: 結果の件数（検索結果の件数など。件数のないステージはNone）
+        """
+        with self._lock:
+            metrics = self._stages.get(stage)
+            if metrics is None:
+                metrics = {
+                    "histogram": Histogram(self.buckets),
+                    "errors": 0,
+                    "retries": 0,
+                    "results": 0,
+                }
+                self._stages[stage] = metrics
+            metrics["histogram"].observe(seconds)
+            metrics["errors"] += bool(error)
+            metrics["retries"] += retries
+            if results is not None:
+                metrics["results"] += results
+
+    def stats(self):
+        """
+        ステージごとの集計結果を返す
+        :return: {ステージ名: {count, errors, retries, results, sum_seconds, p50_seconds, p95_seconds, p99_seconds, buckets}}
+        """
+        with self._lock:
+            result = {}
+            for stage, metrics in sorted(self._stages.items()):
+                histogram = metrics["histogram"]
+                result[stage] = {
+                    "count": histogram.count,
+                    "errors": metrics["errors"],
+                    "retries": metrics["retries"],
+                    "results": metrics["results"],
+                    "sum_seconds": histogram.sum,
+                    "p50_seconds": histogram.quantile(0.5),
+                    "p95_seconds": histogram.quantile(0.95),
+                    "p99_seconds": histogram.quantile(0.99),
+                    "buckets": list(zip(histogram.buckets, histogram.counts)),
+                    "overflow": histogram.counts[-1],
+                }
+            return result
+
+    def reset(self):
+        """
+        集計結果を破棄する
+        """
+        with self._lock:
+            self._stages.clear()
+
+
+# プロセス全体で共有するステージごとの集計
+stage_metrics = StageMetrics(AppConfig.TELEMETRY_HISTOGRAM_BUCKETS_SECONDS)
+
+
+def addSpanListener(listener):
+    """
+    スパンの記録時に呼び出す関数を登録する
+    :param listener: listener(スパン名, 処理時間（秒）, 属性の辞書)
+    """
+    _span_listeners.append(listener)
+
+
+def removeSpanListener(listener):
+    """
+    addSpanListenerで登録した関数の登録を解除する
+    :param listener: 登録した関数
+    """
+    _span_listeners.remove(listener)
+
+
+def getRequestId():
+    """
+    処理中のリクエストのIDを返す
+    :return: リクエストID（リクエストの外で呼び出された場合はNone）
+    """
+    return _request_id.get()
+
+
+@contextlib.contextmanager
+def requestScope(name, **attributes):
+    """
+    リクエストの範囲を表すスパン（新しいリクエストIDを発行する。既にリクエストの中の場合は、そのIDを引き継ぐ）
+    :param name: スパン名（rag_search, kendra_searchなど）
+    :param attributes: スパンに付加する属性
+    :return: スパンの属性の辞書（処理中に属性を追加できる）
+    """
+    if _request_id.get() is not None:
+        with span(name, **attributes) as span_attributes:
+            yield span_attributes
+        return
+    token = _request_id.set(uuid.uuid4().hex)
+    try:
+        with span(name, **attributes) as span_attributes:
+            yield span_attributes
+    finally:
+        _request_id.reset(token)
+
+
+def traced(name):
+    """
+    関数の呼び出しを、リクエストの範囲のスパンとして計測するデコレータ
+    （コルーチン関数の場合は、awaitで完了するまでを計測する）
+    :param name: スパン名
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with requestScope(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with requestScope(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    ブロックの処理時間を計測し、スパンとして記録する
+    ブロック内で返却された辞書に、result_count（結果の件数）、retries（リトライ回数）、
+    input_tokens/output_tokens（トークン使用量）などの属性を追加できる
+    例外が発生した場合は、エラーとして記録した上で例外をそのまま送出する
+    :param name: スパン名（ステージ名）
+    :param attributes: スパンに付加する属性
+    :return: スパンの属性の辞書
+    """
+    started_at = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = _describeError(e)
+        attributes.setdefault("retries", retryAttempts(getattr(e, "response", None)))
+        raise
+    finally:
+        recordSpan(name, time.perf_counter() - started_at, **attributes)
+
+
+def recordSpan(name, seconds, request_id=None, **attributes):
+    """
+    計測済みのスパンを記録する（ストリーミングの最初/最後のトークンなど、ブロックで囲めない処理に使用する）
+    :param name: スパン名（ステージ名）
+    :param seconds: 処理時間（秒）
+    :param request_id: リクエストID（省略時は処理中のリクエストのID）
+    :param attributes: スパンに付加する属性（error, retries, result_countは集計にも使用する）
+    """
+    stage_metrics.observe(
+        name,
+        seconds,
+        error="error" in attributes,
+        retries=attributes.get("retries") or 0,
+        results=attributes.get("result_count"),
+    )
+    for listener in _span_listeners:
+        listener(name, seconds, attributes)
+    # ログを出力しない場合は、JSONへの変換を省略する
+    if logger.isEnabledFor(logging.INFO):
+        record = {
+            "type": "span",
+            "timestamp": time.time(),
+            "request_id": request_id or _request_id.get(),
+            "span": name,
+            "duration_ms": round(seconds * 1000, 3),
+            **attributes,
+        }
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def retryAttempts(response):
+    """
+    AWS SDKのレスポンスから、リトライ回数を取得する
+    :param response: AWS SDKのレスポンス（ClientErrorの場合はe.response）
+    :return: リトライ回数
+    """
+    if not isinstance(response, dict):
+        return 0
+    return response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+
+def _describeError(error):
+    code = getattr(error, "response", None)
+    if isinstance(code, dict):
+        code = code.get("Error", {}).get("Code")
+    return f"{type(error).__name__}:{code}" if code else type(error).__name__
+
+
+def submitWithContext(executor, func, *args, **kwargs):
+    """
+    リクエストIDを引き継いで、スレッドプールに処理を投入する
+    :param executor: スレッドプール
+    :param func: 実行する関数
+    :return: Future
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, func, *args, **kwargs)
+
+
+def _escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{_escapeLabel(value)}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def renderPrometheus(gauges=None):
+    """
+    ステージごとの集計結果を、Prometheusのテキスト形式で出力する
+    :param gauges: 追加で出力するメトリクスのリスト [(メトリクス名, 種類（gauge/counter）, 説明, [(ラベルの辞書, 値)])]
+    :return: Prometheusのテキスト形式の文字列
+    """
+    stats = stage_metrics.stats()
+    lines = [
+        "# HELP rag_stage_duration_seconds Duration of each backend stage.",
+        "# TYPE rag_stage_duration_seconds histogram",
+    ]
+    for stage, stage_stats in stats.items():
+        cumulative = 0
+        for upper_bound, count in stage_stats["buckets"]:
+            cumulative += count
+            labels = _formatLabels({"stage": stage, "le": f"{upper_bound:g}"})
+            lines.append(f"rag_stage_duration_seconds_bucket{labels} {cumulative}")
+        labels = _formatLabels({"stage": stage, "le": "+Inf"})
+        lines.append(
+            f"rag_stage_duration_seconds_bucket{labels} {stage_stats['count']}"
+        )
+        labels = _formatLabels({"stage": stage})
+        lines.append(
+            f"rag_stage_duration_seconds_sum{labels} {stage_stats['sum_seconds']}"
+        )
+        lines.append(f"rag_stage_duration_seconds_count{labels} {stage_stats['count']}")
+
+    for key, description in [
+        ("errors", "Spans that ended with an error."),
+        ("retries", "AWS SDK retry attempts."),
+        ("results", "Results returned by the stage."),
+    ]:
+        lines.append(f"# HELP rag_stage_{key}_total {description}")
+        lines.append(f"# TYPE rag_stage_{key}_total counter")
+        for stage, stage_stats in stats.items():
+            labels = _formatLabels({"stage": stage})
+            lines.append(f"rag_stage_{key}_total{labels} {stage_stats[key]}")
+
+    for name, metric_type, description, samples in gauges or []:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f"{name}{_formatLabels(labels)} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def startMetricsServer(port, render):
+    """
+    Prometheus形式のメトリクスを公開するHTTPサーバーを、バックグラウンドのスレッドで起動する
+    :param port: 待ち受けるポート番号
+    :param render: メトリクスのテキストを返す関数
+    :return: HTTPサーバー
+    """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # スクレイピングごとのアクセスログは出力しない
+            pass
+
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    return server
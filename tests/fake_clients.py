@@ -0,0 +1,271 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_ROOT, "src", "streamlit_rag_app"))
+sys.path.insert(0, os.path.join(REPOSITORY_ROOT, "benchmarks"))
+
+import bedrock_scheduler  # noqa: E402
+import kendra_bedrock_query as backend  # noqa: E402
+import model_router  # noqa: E402
+from app_config import AppConfig  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from caches import PresignedUrlCache  # noqa: E402
+from fake_aws import (  # noqa: E402
+    FakeBedrockClient,
+    FakeKendraClient,
+    FakeS3Client,
+    FakeServiceProfile,
+)
+from region_pool import RegionClientPool, region_pool  # noqa: E402
+
+"""
+テストで共通の、Kendra・S3・Bedrockの代替クライアント（ベンチマーク用のfake_aws）への差し替えと、
+レイテンシ・エラーを指定できるリージョンごとのBedrockのスタブ
+"""
+
+BUCKET_NAME = "test-bucket"
+
+
+def transcriptionResult(document_name):
+    """
+    文字起こし（transcription/配下の.txt）のKendraの検索結果を作成する
+    :param document_name: 拡張子を除いたファイル名
+    :return: Kendraの検索結果（ResultItemsの1件）
+    """
+    return {
+        "DocumentURI": f"https://{BUCKET_NAME}.s3.us-west-2.amazonaws.com/transcription/{document_name}.txt",
+        "DocumentTitle": {"Text": f"{document_name}.txt"},
+    }
+
+
+def pdfDocumentName(object_key):
+    """
+    PDFファイルのオブジェクトキーから、拡張子を除いたファイル名を求める
+    :param object_key: オブジェクトキー（AppConfig.PDF_KEY_PREFIX配下の.pdf）
+    :return: 拡張子を除いたファイル名
+    """
+    return object_key[len(AppConfig.PDF_KEY_PREFIX) : -len(".pdf")]
+
+
+class PatchingTestCase(unittest.TestCase):
+    """
+    unittest.mockによる差し替えを、テストの終了時に元に戻すテストケース
+    """
+
+    def patch(self, patcher):
+        """
+        差し替えを開始し、テストの終了時に元に戻す
+        :param patcher: unittest.mockのpatch
+        :return: 差し替えた値
+        """
+        patched = patcher.start()
+        self.addCleanup(patcher.stop)
+        return patched
+
+
+class FakeAwsTestCase(PatchingTestCase):
+    """
+    アプリが使用するKendra・S3・Bedrockのクライアントを代替クライアントに差し替えるテストケース
+    署名付きURLのキャッシュはテストごとに空のものを使用し、PDFファイルの存在確認用インデックスは使用しない（usePdfKeyIndexで指定する）
+    差し替えは、テストの終了時に元に戻す
+    """
+
+    # 代替クライアントの応答の設定（FakeServiceProfileの引数。既定では待機しない）
+    profile_options = {
+        "kendra_latency_ms": 0,
+        "s3_latency_ms": 0,
+        "bedrock_first_token_ms": 0,
+        "bedrock_tokens_per_second": 1_000_000,
+        "jitter": 0,
+    }
+
+    def setUp(self):
+        self.profile = FakeServiceProfile(**self.profile_options)
+        self.kendra_client = FakeKendraClient(self.profile, BUCKET_NAME)
+        self.s3_client = FakeS3Client(self.profile, AppConfig.PDF_KEY_PREFIX)
+        self.bedrock_clients = {}
+        self.presigned_url_cache = PresignedUrlCache(
+            max_entries=100,
+            expires_in_seconds=AppConfig.PRESIGNED_URL_EXPIRES_IN_SECONDS,
+            min_remaining_seconds=AppConfig.PRESIGNED_URL_MIN_REMAINING_SECONDS,
+        )
+        self._bedrock_clients_lock = threading.Lock()
+
+        self.patch(
+            mock.patch.dict(
+                os.environ, {"bucket_name": BUCKET_NAME, "kendra_index": "test-index"}
+            )
+        )
+        self.patch(
+            mock.patch.object(backend, "getKendraClient", lambda: self.kendra_client)
+        )
+        self.patch(mock.patch.object(backend, "getS3Client", lambda: self.s3_client))
+        self.patch(
+            mock.patch.object(backend, "presigned_url_cache", self.presigned_url_cache)
+        )
+        self.patch(
+            mock.patch.object(region_pool, "client_factory", self._bedrockClient)
+        )
+        self.usePdfKeyIndex(None)
+
+    def usePdfKeyIndex(self, pdf_key_index):
+        """
+        PDFファイルの存在確認に使用するインデックスを指定する
+        :param pdf_key_index: S3KeyIndex。Noneの場合はインデックスを使用しない（head_objectで確認する）
+        """
+        self.patch(
+            mock.patch.object(
+                backend,
+                "getPdfKeyIndex",
+                lambda s3_client, bucket_name: pdf_key_index,
+            )
+        )
+
+    def _bedrockClient(self, region_name, max_attempts):
+        with self._bedrock_clients_lock:
+            if region_name not in self.bedrock_clients:
+                self.bedrock_clients[region_name] = FakeBedrockClient(
+                    self.profile, region_name
+                )
+            return self.bedrock_clients[region_name]
+
+
+class _Meta:
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+class StubBedrockClient:
+    """
+    レスポンスのヘッダーを受け取るまでの時間と、エラーを指定できるBedrock Runtimeのスタブ
+    （リージョンの選択・モデルのルーティングのテストに使用する）
+    """
+
+    def __init__(self, region_name, first_byte_seconds=0.0):
+        """
+        :param region_name: リージョン名
+        :param first_byte_seconds: レスポンスを返すまでの時間（秒）
+        """
+        self.meta = _Meta(region_name)
+        self.first_byte_seconds = first_byte_seconds
+        # モデルIDごとに送出するエラー {モデルID（全てのモデルの場合はNone）: (エラーコード, メッセージ)}
+        self.errors = {}
+        # 呼び出されたモデルIDのリスト
+        self.calls = []
+        # 受け取ったConverseAPIの引数のリスト
+        self.requests = []
+
+    def fail(self, error_code, message="", model_id=None):
+        """
+        以降の呼び出しでエラーを送出する
+        :param error_code: Bedrockのエラーコード
+        :param message: エラーメッセージ
+        :param model_id: エラーとするモデルID（Noneの場合は全てのモデル）
+        """
+        self.errors[model_id] = (error_code, message)
+
+    def _respond(self, converse_kwargs, operation_name):
+        model_id = converse_kwargs["modelId"]
+        self.calls.append(model_id)
+        self.requests.append(converse_kwargs)
+        time.sleep(self.first_byte_seconds)
+        error = self.errors.get(model_id) or self.errors.get(None)
+        if error:
+            raise ClientError(
+                {
+                    "Error": {"Code": error[0], "Message": error[1]},
+                    "ResponseMetadata": {"HTTPStatusCode": 400, "RetryAttempts": 0},
+                },
+                operation_name,
+            )
+
+    def converse(self, **converse_kwargs):
+        self._respond(converse_kwargs, "Converse")
+        return {
+            "output": {
+                "message": {
+                    "role": "assistant",
+                    "content": [{"text": f"{self.meta.region_name}の回答です。"}],
+                }
+            },
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 10, "outputTokens": 10, "totalTokens": 20},
+            "ResponseMetadata": {"RetryAttempts": 0},
+        }
+
+    def converse_stream(self, **converse_kwargs):
+        self._respond(converse_kwargs, "ConverseStream")
+        events = [
+            {"messageStart": {"role": "assistant"}},
+            {
+                "contentBlockDelta": {
+                    "delta": {"text": f"{self.meta.region_name}の回答です。"},
+                    "contentBlockIndex": 0,
+                }
+            },
+            {"messageStop": {"stopReason": "end_turn"}},
+            {
+                "metadata": {
+                    "usage": {"inputTokens": 10, "outputTokens": 10, "totalTokens": 20}
+                }
+            },
+        ]
+        return {"stream": iter(events), "ResponseMetadata": {"RetryAttempts": 0}}
+
+
+class StubBedrockTestCase(PatchingTestCase):
+    """
+    Bedrockの呼び出しを、リージョンごとのStubBedrockClientに差し替えるテストケース
+    リージョンのプール・モデルのルーティング・流量制御は、テストごとに新しいもの（履歴なし）を使用する
+    """
+
+    region_names = ["us-west-2", "us-east-1", "ap-northeast-1"]
+
+    def setUp(self):
+        self.clients = {
+            region_name: StubBedrockClient(region_name)
+            for region_name in self.region_names
+        }
+        self.region_pool = RegionClientPool(
+            self.region_names,
+            client_factory=lambda region_name, max_attempts: self.clients[region_name],
+            cooldown_seconds=60,
+            max_cooldown_seconds=300,
+        )
+        self.model_router = model_router.ModelRouter(
+            window_seconds=60, min_samples=3, throttle_rate_threshold=0.5
+        )
+        self.admission_controller = bedrock_scheduler.AdmissionController(
+            rate_limits_dict={},
+            default_rate_limits={
+                "requests_per_minute": 10000,
+                "tokens_per_minute": 10**9,
+            },
+            max_queue_size=100,
+        )
+        self.patch(mock.patch.object(model_router, "region_pool", self.region_pool))
+        self.patch(mock.patch.object(model_router, "model_router", self.model_router))
+        for module in (model_router, bedrock_scheduler):
+            self.patch(
+                mock.patch.object(
+                    module, "admission_controller", self.admission_controller
+                )
+            )
+
+    def converseKwargs(self, model_key, text="質問です。"):
+        """
+        ConverseAPIの引数を作成する
+        :param model_key: AppConfig.MODEL_ID_DICTのキー
+        :param text: 質問
+        :return: ConverseAPIの引数
+        """
+        return {
+            "modelId": AppConfig.MODEL_ID_DICT[model_key],
+            "messages": [{"role": "user", "content": [{"text": text}]}],
+            "inferenceConfig": {"maxTokens": 100},
+        }
@@ -0,0 +1,160 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from fake_clients import StubBedrockTestCase, bedrock_scheduler, model_router
+from app_config import AppConfig
+from bedrock_scheduler import AdmissionController, BedrockAdmissionError
+
+"""
+Bedrockへのリクエストの流量制御のテスト
+python -m unittest discover -s tests
+"""
+
+MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+REGION_NAME = "us-west-2"
+
+
+def makeController(requests_per_minute=60, tokens_per_minute=60000, max_queue_size=10):
+    """
+    全てのモデルに同じ上限を設定した流量制御を作成する
+    :param requests_per_minute: 1分あたりのリクエスト数の上限
+    :param tokens_per_minute: 1分あたりのトークン数の上限
+    :param max_queue_size: 待ち行列の長さの上限
+    :return: AdmissionController
+    """
+    return AdmissionController(
+        rate_limits_dict={},
+        default_rate_limits={
+            "requests_per_minute": requests_per_minute,
+            "tokens_per_minute": tokens_per_minute,
+        },
+        max_queue_size=max_queue_size,
+    )
+
+
+def drainRequests(controller, requests_per_minute):
+    """
+    リクエスト数の上限を使い切る（以降は1分あたりrequests_per_minuteの速度で補充される）
+    :param controller: AdmissionController
+    :param requests_per_minute: 1分あたりのリクエスト数の上限
+    """
+    for _ in range(requests_per_minute):
+        controller.acquire(MODEL_ID, 1, timeout_seconds=0, region_name=REGION_NAME)
+
+
+class AcquireTest(unittest.TestCase):
+    def stats(self, controller):
+        return controller.stats()[f"{MODEL_ID}@{REGION_NAME}"]
+
+    def testAdmitsImmediatelyWithinLimits(self):
+        controller = makeController()
+
+        waited = controller.acquire(
+            MODEL_ID, 100, timeout_seconds=0, region_name=REGION_NAME
+        )
+
+        self.assertLess(waited, 0.05)
+        self.assertEqual(self.stats(controller)["admitted"], 1)
+
+    def testFailsFastWhenWaitExceedsDeadline(self):
+        # 1秒に1リクエストずつ補充されるため、次の送信まで約1秒待つ必要がある
+        controller = makeController(requests_per_minute=60)
+        drainRequests(controller, 60)
+
+        started_at = time.monotonic()
+        with self.assertRaises(BedrockAdmissionError):
+            controller.acquire(
+                MODEL_ID, 1, timeout_seconds=0.5, region_name=REGION_NAME
+            )
+
+        # 待ち時間の上限（0.5秒）まで待たずにエラーとする
+        self.assertLess(time.monotonic() - started_at, 0.1)
+        self.assertEqual(self.stats(controller)["rejected"], 1)
+        self.assertEqual(self.stats(controller)["queue_depth"], 0)
+
+    def testWaitsWhenWithinDeadline(self):
+        # 1秒に10トークンずつ補充されるため、5トークンの送信まで約0.5秒待つ
+        controller = makeController(tokens_per_minute=600)
+        controller.acquire(MODEL_ID, 600, timeout_seconds=0, region_name=REGION_NAME)
+
+        waited = controller.acquire(
+            MODEL_ID, 5, timeout_seconds=2, region_name=REGION_NAME
+        )
+
+        self.assertGreaterEqual(waited, 0.4)
+        self.assertLess(waited, 1.0)
+
+    def testRejectsWhenQueueIsFull(self):
+        controller = makeController(requests_per_minute=60, max_queue_size=1)
+        drainRequests(controller, 60)
+        waiting = threading.Thread(
+            target=controller.acquire,
+            args=(MODEL_ID, 1),
+            kwargs={"timeout_seconds": 5, "region_name": REGION_NAME},
+        )
+        waiting.start()
+        self.addCleanup(waiting.join)
+        while controller.queueDepth(MODEL_ID) == 0:
+            time.sleep(0.01)
+
+        with self.assertRaisesRegex(BedrockAdmissionError, "待ち行列"):
+            controller.acquire(MODEL_ID, 1, timeout_seconds=5, region_name=REGION_NAME)
+
+    def testInteractiveRequestIsAdmittedBeforeBulk(self):
+        controller = makeController(requests_per_minute=60)
+        drainRequests(controller, 60)
+        admitted = []
+
+        def acquire(priority):
+            controller.acquire(
+                MODEL_ID, 1, priority, timeout_seconds=5, region_name=REGION_NAME
+            )
+            admitted.append(priority)
+
+        bulk = threading.Thread(target=acquire, args=("bulk",))
+        bulk.start()
+        while controller.queueDepth(MODEL_ID) == 0:
+            time.sleep(0.01)
+        interactive = threading.Thread(target=acquire, args=("interactive",))
+        interactive.start()
+        bulk.join()
+        interactive.join()
+
+        # 後から並んだ画面のリクエストを、バックグラウンド処理より先に送信する
+        self.assertEqual(admitted, ["interactive", "bulk"])
+
+
+class RoutedConverseAdmissionTest(StubBedrockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admission_controller = makeController(requests_per_minute=1)
+        for module in (model_router, bedrock_scheduler):
+            self.patch(
+                mock.patch.object(
+                    module, "admission_controller", self.admission_controller
+                )
+            )
+
+    def testSaturatedRegionFallsBackToNextRegion(self):
+        # us-west-2のリクエスト数の上限を使い切り、待ち時間の上限を超える見込みの状態にする
+        drainRequests(self.admission_controller, 1)
+
+        started_at = time.monotonic()
+        _, model_id, _ = model_router.routedConverse(
+            self.converseKwargs("claude_3_5_sonnet"), "fixed"
+        )
+
+        # 流量制御で待たずに、次のリージョンで呼び出す
+        self.assertLess(
+            time.monotonic() - started_at,
+            AppConfig.MODEL_ROUTING_ADMISSION_WAIT_SECONDS,
+        )
+        self.assertEqual(model_id, MODEL_ID)
+        self.assertEqual(self.clients[REGION_NAME].calls, [])
+        self.assertEqual(self.clients["us-east-1"].calls, [MODEL_ID])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import fake_clients  # noqa: F401 （アプリのモジュールを読み込めるようにする）
+from attachment_store import (
+    ATTACHMENT_REF_KEY,
+    PROCESS_DIR_PREFIX,
+    AttachmentStore,
+    makeAttachmentRef,
+    removeStaleAttachmentDirs,
+    resolveAttachments,
+)
+
+"""
+アップロードされたファイルの保存領域のテスト
+python -m unittest discover -s tests
+"""
+
+
+class AttachmentStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = os.path.join(
+            temp_dir.name, f"{PROCESS_DIR_PREFIX}{os.getpid()}"
+        )
+        # 10バイト以下はメモリ上（合計25バイトまで）、それより大きいファイルはディスク上（合計250バイトまで）に保存する
+        self.store = AttachmentStore(
+            self.cache_dir,
+            memory_threshold_bytes=10,
+            max_memory_bytes=25,
+            max_disk_bytes=250,
+        )
+
+
+class MemoryEvictionTest(AttachmentStoreTestCase):
+    def testLeastRecentlyUsedIsEvicted(self):
+        first = self.store.put(b"a" * 10)
+        second = self.store.put(b"b" * 10)
+        # 参照したファイルは、最も新しく参照されたものとして扱う
+        self.assertEqual(self.store.get(first), b"a" * 10)
+
+        self.store.put(b"c" * 10)
+
+        self.assertIsNone(self.store.get(second))
+        self.assertEqual(self.store.get(first), b"a" * 10)
+        self.assertEqual(self.store.stats()["memory_bytes"], 20)
+
+    def testSameContentIsStoredOnce(self):
+        first = self.store.put(b"a" * 10)
+        self.store.put(b"b" * 10)
+        # 同じ内容の再アップロードは、最も新しく参照されたものとして扱う
+        self.assertEqual(self.store.put(b"a" * 10), first)
+
+        self.store.put(b"c" * 10)
+
+        self.assertEqual(self.store.stats()["memory_entries"], 2)
+        self.assertEqual(self.store.get(first), b"a" * 10)
+
+
+class DiskEvictionTest(AttachmentStoreTestCase):
+    def testEvictedFileIsRemovedFromDisk(self):
+        first = self.store.put(b"a" * 100)
+        second = self.store.put(b"b" * 100)
+        self.store.get(first)
+
+        self.store.put(b"c" * 100)
+
+        self.assertIsNone(self.store.get(second))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, second)))
+        self.assertEqual(self.store.get(first), b"a" * 100)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(self.store.stats()["disk_bytes"], 200)
+
+    def testStartsEmptyAndCloseRemovesDirectory(self):
+        with open(os.path.join(self.cache_dir, "unmanaged"), "wb") as f:
+            f.write(b"x" * 1000)
+
+        # 管理していないファイルは、生成時に削除する
+        store = AttachmentStore(
+            self.cache_dir,
+            memory_threshold_bytes=10,
+            max_memory_bytes=25,
+            max_disk_bytes=250,
+        )
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        store.put(b"a" * 100)
+        store.close()
+
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class RemoveStaleAttachmentDirsTest(unittest.TestCase):
+    def testOnlyDirectoriesOfEndedProcessesAreRemoved(self):
+        ended = subprocess.Popen([sys.executable, "-c", "pass"])
+        ended.wait()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for name in (
+                f"{PROCESS_DIR_PREFIX}{ended.pid}",
+                f"{PROCESS_DIR_PREFIX}{os.getpid()}",
+                "other",
+            ):
+                os.makedirs(os.path.join(cache_dir, name))
+            with open(os.path.join(cache_dir, "legacy-file"), "wb") as f:
+                f.write(b"x")
+
+            removeStaleAttachmentDirs(cache_dir)
+
+            # 実行中のプロセスの保存先と、保存先以外のディレクトリは残す
+            self.assertEqual(
+                set(os.listdir(cache_dir)),
+                {f"{PROCESS_DIR_PREFIX}{os.getpid()}", "other"},
+            )
+
+
+class ResolveAttachmentsTest(AttachmentStoreTestCase):
+    def testOnlyLatestMessageSendsFile(self):
+        previous = self.store.put(b"a" * 10)
+        latest = self.store.put(b"b" * 100)
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"text": "この画像は？"},
+                    makeAttachmentRef(previous, "image", "png", "previous.png"),
+                ],
+            },
+            {"role": "assistant", "content": [{"text": "猫です。"}]},
+            {
+                "role": "user",
+                "content": [
+                    {"text": "要約してください。"},
+                    makeAttachmentRef(latest, "document", "pdf", "latest.pdf"),
+                ],
+            },
+        ]
+
+        resolved = resolveAttachments(messages, self.store, resend_previous=False)
+
+        self.assertEqual(
+            resolved[0]["content"][1],
+            {"text": "（以前アップロードされたファイル: previous.png）"},
+        )
+        self.assertEqual(
+            resolved[2]["content"][1]["document"]["source"]["bytes"], b"b" * 100
+        )
+        # 元の会話履歴は変更しない
+        self.assertIn(ATTACHMENT_REF_KEY, messages[2]["content"][1])
+
+    def testEvictedFileIsReplacedWithName(self):
+        evicted = self.store.put(b"a" * 10)
+        self.store.put(b"b" * 10)
+        self.store.put(b"c" * 10)
+        messages = [
+            {
+                "role": "user",
+                "content": [makeAttachmentRef(evicted, "image", "png", "evicted.png")],
+            }
+        ]
+
+        resolved = resolveAttachments(messages, self.store)
+
+        self.assertEqual(
+            resolved[0]["content"],
+            [{"text": "（以前アップロードされたファイル: evicted.png）"}],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
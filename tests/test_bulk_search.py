@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from fake_clients import FakeAwsTestCase
+import bulk_search
+from caches import KendraQueryCache
+
+"""
+一括検索のテスト
+python -m unittest discover -s tests
+"""
+
+
+class CountingRateLimiter:
+    """
+    待機せずに、acquireの呼び出し回数を数えるリクエスト数の上限
+    """
+
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        return 0.0
+
+
+class BulkSearchRateLimitTest(FakeAwsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rate_limiter = self.patch(
+            mock.patch.object(bulk_search, "kendra_rate_limiter", CountingRateLimiter())
+        )
+
+    def testCachedQueriesAreNotRateLimited(self):
+        query_cache = KendraQueryCache(max_entries=100, default_ttl_seconds=600)
+        queries = bulk_search.parseQueryText("年金\n介護")
+
+        first = list(bulk_search.iterBulkSearch(queries, ["all"], query_cache))
+        second = list(bulk_search.iterBulkSearch(queries, ["all"], query_cache))
+
+        self.assertEqual([outcome["error"] for outcome in first + second], [None] * 4)
+        # 2回目の検索は全てキャッシュから返却され、Kendraへのリクエスト数の上限を消費しない
+        self.assertEqual(self.rate_limiter.acquired, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from fake_clients import (
+    BUCKET_NAME,
+    FakeAwsTestCase,
+    backend,
+    pdfDocumentName,
+    transcriptionResult,
+)
+
+"""
+キャッシュのテスト
+python -m unittest discover -s tests
+"""
+
+
+class PresignedUrlCacheTest(FakeAwsTestCase):
+    def testPeekDoesNotCount(self):
+        cache = self.presigned_url_cache
+        self.assertIsNone(cache.peek((BUCKET_NAME, "documents/doc1.pdf")))
+        cache.getOrSign(self.s3_client, BUCKET_NAME, "documents/doc1.pdf")
+        self.assertIsNotNone(cache.peek((BUCKET_NAME, "documents/doc1.pdf")))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def testResolveCountsOneLookupPerResult(self):
+        result = transcriptionResult(pdfDocumentName(self.s3_client.pdf_keys[0]))
+
+        backend._resolveSignedUrl(result, self.s3_client)
+        backend._resolveSignedUrl(result, self.s3_client)
+
+        # 1回目はミス、2回目はヒット（存在確認時の参照は数えない）
+        cache = self.presigned_url_cache
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import unittest
+from unittest import mock
+
+from fake_clients import PatchingTestCase
+from app_config import AppConfig
+from context_builder import (
+    ATTACHMENT_TOKEN_ESTIMATE,
+    RAG_CONTEXT_PREFIX,
+    buildRagContext,
+    dedupePassages,
+    estimateMessageTokens,
+    estimateTokens,
+    extractPassagesFromQuery,
+    packPassages,
+    rankPassages,
+)
+
+"""
+検索結果のコンテキストの構築のテスト
+python -m unittest discover -s tests
+"""
+
+MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+
+
+def passage(text, confidence="HIGH", rank=0, document_title="文書.pdf"):
+    """
+    パッセージを作成する
+    :param text: 本文
+    :param confidence: Kendraの信頼度
+    :param rank: Kendraの検索順
+    :param document_title: 文書のタイトル
+    :return: パッセージ
+    """
+    return {
+        "document_title": document_title,
+        "text": text,
+        "confidence": confidence,
+        "rank": rank,
+    }
+
+
+class EstimateTokensTest(unittest.TestCase):
+    def testAsciiAndNonAsciiCharacters(self):
+        # ASCII文字は4文字で1トークン（切り上げ）、日本語は1文字で1トークン
+        self.assertEqual(estimateTokens("abcdefgh"), 2)
+        self.assertEqual(estimateTokens("abcde"), 2)
+        self.assertEqual(estimateTokens("年金"), 2)
+        self.assertEqual(estimateTokens("ab年金"), 3)
+
+    def testAttachmentsAreCountedByType(self):
+        message = {
+            "role": "user",
+            "content": [
+                {"text": "年金"},
+                {"image": {"format": "png", "source": {"bytes": b""}}},
+            ],
+        }
+
+        self.assertEqual(
+            estimateMessageTokens(message), 2 + ATTACHMENT_TOKEN_ESTIMATE["image"]
+        )
+
+
+class ExtractPassagesTest(unittest.TestCase):
+    def testAnswerTextIsPreferredOverExcerpt(self):
+        kendra_response = {
+            "ResultItems": [
+                {
+                    "DocumentTitle": {"Text": "よくある質問"},
+                    "DocumentExcerpt": {"Text": "抜粋"},
+                    "AdditionalAttributes": [
+                        {
+                            "Key": "AnswerText",
+                            "Value": {
+                                "TextWithHighlightsValue": {"Text": "回答の本文"}
+                            },
+                        }
+                    ],
+                    "ScoreAttributes": {"ScoreConfidence": "VERY_HIGH"},
+                },
+                {
+                    "DocumentTitle": {"Text": "通知"},
+                    "DocumentExcerpt": {"Text": "本文"},
+                },
+            ]
+        }
+
+        passages = extractPassagesFromQuery(kendra_response)
+
+        self.assertEqual(
+            passages,
+            [
+                passage("回答の本文", "VERY_HIGH", 0, "よくある質問"),
+                passage("本文", "NOT_AVAILABLE", 1, "通知"),
+            ],
+        )
+
+
+class RankPassagesTest(unittest.TestCase):
+    def testOrderedByConfidenceThenRank(self):
+        passages = [
+            passage("a", "MEDIUM", 0),
+            passage("b", "HIGH", 1),
+            passage("c", "HIGH", 2),
+            passage("d", "VERY_HIGH", 3),
+        ]
+
+        ranked = rankPassages(passages)
+
+        self.assertEqual([p["text"] for p in ranked], ["d", "b", "c", "a"])
+
+
+class DedupePassagesTest(unittest.TestCase):
+    def testNearDuplicateIsRemovedAndFirstIsKept(self):
+        passages = [
+            passage("年金の請求には、年金請求書と戸籍謄本が必要です。", rank=0),
+            # 空白・省略記号の違いは無視する
+            passage("…年金の請求には、年金請求書と戸籍謄本が必要です ", rank=1),
+            passage("介護保険の申請は、市区町村の窓口で行います。", rank=2),
+        ]
+
+        deduped = dedupePassages(passages, threshold=0.8)
+
+        self.assertEqual([p["rank"] for p in deduped], [0, 2])
+
+    def testFullWidthAndHalfWidthAreNormalized(self):
+        passages = [passage("ＡＢＣ１２３の手続き"), passage("abc123の手続き", rank=1)]
+
+        self.assertEqual(len(dedupePassages(passages, threshold=0.8)), 1)
+
+    def testShorterPassageContainedInLongerIsDuplicate(self):
+        passages = [
+            passage(
+                "年金の請求には、年金請求書と戸籍謄本が必要です。窓口で提出します。"
+            ),
+            passage("年金請求書と戸籍謄本が必要です", rank=1),
+        ]
+
+        self.assertEqual(len(dedupePassages(passages, threshold=0.8)), 1)
+
+    def testEmptyPassageIsRemoved(self):
+        passages = [passage(" … "), passage("年金の手続き", rank=1)]
+
+        self.assertEqual([p["rank"] for p in dedupePassages(passages)], [1])
+
+
+class PackPassagesTest(unittest.TestCase):
+    def testSkipsPassageOverBudgetAndTriesShorterOnes(self):
+        passages = [
+            passage("短" * 10, document_title="A"),
+            passage("長" * 100, document_title="B"),
+            passage("短" * 10, document_title="C"),
+        ]
+
+        packed = packPassages(passages, token_budget=40)
+
+        # 番号は詰め込んだパッセージの順に振る
+        self.assertEqual(packed, ["[1] A\n" + "短" * 10, "[2] C\n" + "短" * 10])
+        self.assertLessEqual(sum(estimateTokens(text) for text in packed), 40)
+
+    def testNothingFits(self):
+        self.assertEqual(packPassages([passage("長" * 100)], token_budget=10), [])
+
+
+class BuildRagContextTest(PatchingTestCase):
+    def setUp(self):
+        self.patch(
+            mock.patch.dict(
+                AppConfig.RAG_CONTEXT_TOKEN_BUDGET_DICT, {"claude_3_5_sonnet": 40}
+            )
+        )
+
+    def testRankedDedupedAndPackedWithinModelBudget(self):
+        passages = [
+            passage("介護保険の申請", "MEDIUM", 0, "介護"),
+            passage("年金請求書が必要", "HIGH", 1, "年金"),
+            passage("年金請求書が必要", "HIGH", 2, "年金（写し）"),
+            passage("長" * 100, "VERY_HIGH", 3, "長文"),
+        ]
+
+        context = buildRagContext(passages, MODEL_ID)
+
+        self.assertEqual(
+            context,
+            f"{RAG_CONTEXT_PREFIX}\n\n[1] 年金\n年金請求書が必要\n\n[2] 介護\n介護保険の申請",
+        )
+
+    def testNoPassages(self):
+        context = buildRagContext([], MODEL_ID)
+
+        self.assertTrue(context.startswith(RAG_CONTEXT_PREFIX))
+        self.assertIn("該当する検索結果はありませんでした", context)
+
+
+if __name__ == "__main__":
+    unittest.main()
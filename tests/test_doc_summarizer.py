@@ -0,0 +1,136 @@
+import unittest
+from unittest import mock
+
+from fake_clients import PatchingTestCase, StubBedrockTestCase
+import doc_summarizer
+from app_config import AppConfig
+
+"""
+大きな文書の分割要約のテスト
+python -m unittest discover -s tests
+"""
+
+QUESTION = "申請の期限は？"
+MODEL_ID = AppConfig.MODEL_ID_DICT[AppConfig.MAP_REDUCE_MODEL_KEY]
+
+
+def textPage(page_number, tokens=40):
+    """
+    テキストのページを作成する
+    :param page_number: ページ番号
+    :param tokens: ページのトークン数（日本語の文字数）
+    :return: pdf_extract.extractPdfで抽出したページ
+    """
+    return {"page_number": page_number, "text": "文" * tokens, "image": None}
+
+
+def scannedPage(page_number):
+    """
+    スキャンした（テキストのない）ページを作成する
+    :param page_number: ページ番号
+    :return: pdf_extract.extractPdfで抽出したページ
+    """
+    return {"page_number": page_number, "text": "", "image": b"png"}
+
+
+class SplitIntoChunksTest(PatchingTestCase):
+    def testPagesAreGroupedWithinTokenLimit(self):
+        pages = [textPage(1), textPage(2), textPage(3), textPage(4, tokens=0)]
+
+        chunks = doc_summarizer.splitIntoChunks(pages, chunk_tokens=100)
+
+        # 空のページは除き、連続したページ範囲ごとに区切る
+        self.assertEqual(
+            [[page["page_number"] for page in chunk] for chunk in chunks],
+            [[1, 2], [3]],
+        )
+
+    def testChunksAreSplitByImageCount(self):
+        self.patch(mock.patch.object(AppConfig, "PDF_SCANNED_PAGE_MAX_IMAGES", 2))
+        pages = [scannedPage(page_number) for page_number in range(1, 6)]
+
+        chunks = doc_summarizer.splitIntoChunks(pages, chunk_tokens=10**6)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    def testNeedsMapReduceOverThreshold(self):
+        self.patch(mock.patch.object(AppConfig, "MAP_REDUCE_THRESHOLD_TOKENS", 100))
+
+        self.assertFalse(doc_summarizer.needsMapReduce([textPage(1), textPage(2)]))
+        self.assertTrue(
+            doc_summarizer.needsMapReduce([textPage(1), textPage(2), textPage(3)])
+        )
+
+
+class MapReduceSummarizeTest(StubBedrockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.progress = []
+        # テストごとに異なる文書として扱い、回答のキャッシュを共有しない
+        self.document_hash = self.id()
+
+    def _summarize(self, pages):
+        return doc_summarizer.mapReduceSummarize(
+            pages,
+            QUESTION,
+            self.document_hash,
+            on_progress=lambda completed, total: self.progress.append(
+                (completed, total)
+            ),
+        )
+
+    def _prompts(self):
+        return [
+            request["messages"][0]["content"][0]["text"]
+            for request in self.clients["us-west-2"].requests
+        ]
+
+    def testChunksAreSummarizedThenAnswered(self):
+        self.patch(mock.patch.object(AppConfig, "MAP_REDUCE_CHUNK_TOKENS", 100))
+        pages = [textPage(page_number) for page_number in range(1, 6)]
+
+        answer = self._summarize(pages)
+
+        self.assertEqual(answer, "us-west-2の回答です。")
+        # チャンク（1〜2, 3〜4, 5ページ）ごとの要約と、最後の回答
+        self.assertEqual(self.clients["us-west-2"].calls, [MODEL_ID] * 4)
+        reduce_prompt = self._prompts()[-1]
+        self.assertLess(
+            reduce_prompt.index("【1〜2ページ】"), reduce_prompt.index("【3〜4ページ】")
+        )
+        self.assertLess(
+            reduce_prompt.index("【3〜4ページ】"), reduce_prompt.index("【5〜5ページ】")
+        )
+        self.assertIn(QUESTION, reduce_prompt)
+        self.assertEqual(self.progress[-1], (4, 4))
+        self.assertEqual([completed for completed, _ in self.progress], [1, 2, 3, 4])
+
+    def testSummariesOverLimitAreCombined(self):
+        # 1ページずつのチャンクの要約（約15トークン）を、上限（50トークン）に収まる3件ずつまとめてから回答する
+        self.patch(mock.patch.object(AppConfig, "MAP_REDUCE_CHUNK_TOKENS", 50))
+        pages = [textPage(page_number) for page_number in range(1, 7)]
+
+        self._summarize(pages)
+
+        prompts = self._prompts()
+        combine_prompts = [
+            prompt for prompt in prompts if "1つの要約にまとめて" in prompt
+        ]
+        self.assertEqual(len(combine_prompts), 2)
+        self.assertEqual(len(prompts), 6 + 2 + 1)
+        self.assertEqual(self.progress[-1], (9, 9))
+
+    def testAnswerIsCached(self):
+        pages = [textPage(1)]
+
+        first = self._summarize(pages)
+        calls = len(self.clients["us-west-2"].calls)
+        second = self._summarize(pages)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.clients["us-west-2"].calls), calls)
+        self.assertEqual(self.progress[-1], (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import time
+import unittest
+from unittest import mock
+
+from fake_clients import PatchingTestCase, StubBedrockTestCase
+from app_config import AppConfig
+from context_builder import RAG_CONTEXT_PREFIX
+from history_manager import PLACEHOLDER_TEXT, HistoryManager, removeStaleTurns
+
+"""
+会話履歴の管理のテスト
+python -m unittest discover -s tests
+"""
+
+MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+
+
+def message(role, text):
+    """
+    テキストのみのメッセージを作成する
+    :param role: "user"または"assistant"
+    :param text: テキスト
+    :return: ConverseAPIのメッセージ
+    """
+    return {"role": role, "content": [{"text": text}]}
+
+
+def conversation(turns):
+    """
+    1メッセージあたり40トークン（日本語40文字）の会話履歴を作成する
+    :param turns: 質問と回答の組の数（最後に回答のない質問を追加する）
+    :return: 会話履歴
+    """
+    history = []
+    for i in range(turns):
+        history.append(message("user", f"{i:02d}" + "質" * 38))
+        history.append(message("assistant", f"{i:02d}" + "答" * 38))
+    history.append(message("user", f"{turns:02d}" + "質" * 38))
+    return history
+
+
+class RemoveStaleTurnsTest(unittest.TestCase):
+    def testRemovesSearchContextAndRepeatedQuestion(self):
+        history = [
+            message("user", "年金の手続きは？"),
+            message("assistant", f"{RAG_CONTEXT_PREFIX}\n年金の請求には…"),
+            message("user", "年金の手続きは？"),
+            message("assistant", "年金請求書が必要です。"),
+        ]
+
+        self.assertEqual(removeStaleTurns(history), [history[0], history[3]])
+
+    def testRemovesPlaceholderAndRepeatedQuestion(self):
+        history = [
+            message("user", "こんにちは"),
+            message("assistant", PLACEHOLDER_TEXT),
+            message("user", "こんにちは"),
+            message("assistant", "こんにちは。ご用件をどうぞ。"),
+        ]
+
+        self.assertEqual(removeStaleTurns(history), history[2:])
+
+
+class BuildMessagesTest(PatchingTestCase):
+    def setUp(self):
+        self.patch(
+            mock.patch.dict(
+                AppConfig.HISTORY_TOKEN_BUDGET_DICT, {"claude_3_5_sonnet": 130}
+            )
+        )
+        self.manager = HistoryManager(summarize=False)
+
+    def testKeepsRecentMessagesWithinBudget(self):
+        history = conversation(3)
+
+        # 上限（130トークン）に収まる直近の3メッセージ（120トークン）のみ送信する
+        self.assertEqual(self.manager.buildMessages(history, MODEL_ID), history[-3:])
+        # 元の会話履歴は変更しない
+        self.assertEqual(len(history), 7)
+
+    def testWindowStartsWithUserMessage(self):
+        history = conversation(3)
+
+        # 直近の2メッセージ（80トークン）は収まるが、assistantから始まるため最新の質問のみとする
+        messages = self.manager.buildMessages(history, MODEL_ID, reserved_tokens=30)
+
+        self.assertEqual(messages, history[-1:])
+
+    def testLatestMessageIsKeptEvenIfOverBudget(self):
+        history = conversation(0)
+
+        messages = self.manager.buildMessages(history, MODEL_ID, reserved_tokens=1000)
+
+        self.assertEqual(messages, history)
+
+
+class SummarizeTest(StubBedrockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(
+            mock.patch.dict(
+                AppConfig.HISTORY_TOKEN_BUDGET_DICT, {"claude_3_5_sonnet": 130}
+            )
+        )
+
+    def waitForSummary(self, manager):
+        deadline = time.monotonic() + 5
+        while not manager.getSummarySystemPrompt() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return manager.getSummarySystemPrompt()
+
+    def testDroppedMessagesAreSummarizedInBackground(self):
+        manager = HistoryManager(summarize=True)
+
+        manager.buildMessages(conversation(3), MODEL_ID)
+
+        system_prompt = self.waitForSummary(manager)
+        self.assertEqual(len(system_prompt), 1)
+        self.assertIn("us-west-2の回答です。", system_prompt[0]["text"])
+        # ウィンドウから外れた4メッセージ（01の回答まで）のみを要約する
+        summary_model_id = AppConfig.MODEL_ID_DICT[AppConfig.HISTORY_SUMMARY_MODEL_KEY]
+        self.assertEqual(self.clients["us-west-2"].calls, [summary_model_id])
+        prompt = self.clients["us-west-2"].requests[0]["messages"][0]["content"][0]
+        self.assertIn("00質", prompt["text"])
+        self.assertNotIn("02質", prompt["text"])
+
+    def testNoSummaryWhenEverythingFits(self):
+        manager = HistoryManager(summarize=True)
+
+        manager.buildMessages(conversation(1), MODEL_ID)
+
+        self.assertEqual(manager.getSummarySystemPrompt(), [])
+        self.assertEqual(self.clients["us-west-2"].calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
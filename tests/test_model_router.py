@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from fake_clients import StubBedrockTestCase, model_router
+from app_config import AppConfig
+
+"""
+モデル・リージョンのルーティングのテスト
+python -m unittest discover -s tests
+"""
+
+MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+FALLBACK_MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_sonnet"]
+
+
+class RoutedConverseFallbackTest(StubBedrockTestCase):
+    def _converse(self, policy="fixed", stream=False):
+        response, model_id, _ = model_router.routedConverse(
+            self.converseKwargs("claude_3_5_sonnet"), policy, stream=stream
+        )
+        if stream:
+            list(response["stream"])
+        return model_id
+
+    def testThrottledRegionFallsBackToNextRegion(self):
+        self.clients["us-west-2"].fail("ThrottlingException")
+
+        self.assertEqual(self._converse(), MODEL_ID)
+        self.assertEqual(self.clients["us-west-2"].calls, [MODEL_ID])
+        self.assertEqual(self.clients["us-east-1"].calls, [MODEL_ID])
+        self.assertEqual(self.clients["ap-northeast-1"].calls, [])
+        # スロットリングが発生したリージョンは、以降の呼び出しでは最後に試す
+        self.assertEqual(
+            self.region_pool.selectRegions(MODEL_ID)[-1],
+            "us-west-2",
+        )
+
+    def testUnavailableRegionFallsBackToNextRegion(self):
+        self.clients["us-west-2"].fail("AccessDeniedException")
+        self.clients["us-east-1"].fail(
+            "ValidationException",
+            "The provided model identifier is invalid.",
+        )
+
+        self.assertEqual(self._converse(), MODEL_ID)
+        self.assertEqual(self.clients["ap-northeast-1"].calls, [MODEL_ID])
+
+    def testUnavailableInAllRegionsDoesNotSwitchModel(self):
+        for client in self.clients.values():
+            client.fail("AccessDeniedException", model_id=MODEL_ID)
+
+        # モデルがリージョンで利用できない場合は、代替モデルには切り替えない
+        with self.assertRaises(ClientError):
+            self._converse(policy="fallback")
+        for client in self.clients.values():
+            self.assertEqual(client.calls, [MODEL_ID])
+
+    def testThrottledInAllRegionsFallsBackToNextModel(self):
+        for client in self.clients.values():
+            client.fail("ThrottlingException", model_id=MODEL_ID)
+
+        self.assertEqual(self._converse(policy="fallback"), FALLBACK_MODEL_ID)
+        self.assertEqual(self.clients["us-west-2"].calls, [MODEL_ID, FALLBACK_MODEL_ID])
+
+    def testThrottledInAllRegionsWithFixedPolicyRaises(self):
+        for client in self.clients.values():
+            client.fail("ThrottlingException")
+
+        with self.assertRaises(ClientError):
+            self._converse()
+        self.assertEqual(sum(len(client.calls) for client in self.clients.values()), 3)
+
+    def testInvalidRequestIsNotRetried(self):
+        self.clients["us-west-2"].fail(
+            "ValidationException", "messages: text content blocks must be non-empty"
+        )
+
+        with self.assertRaises(ClientError):
+            self._converse(policy="fallback")
+        self.assertEqual(self.clients["us-east-1"].calls, [])
+
+    def testOnlyStreamingRecordsModelLatency(self):
+        self._converse()
+        self.assertIsNone(self.model_router.modelStats(MODEL_ID)["latency_avg_seconds"])
+
+        self._converse(stream=True)
+        self.assertIsNotNone(
+            self.model_router.modelStats(MODEL_ID)["latency_avg_seconds"]
+        )
+
+
+class RoutedConverseNoRegionTest(StubBedrockTestCase):
+    region_names = ["us-west-2", "us-east-1"]
+
+    def testNoAvailableRegionRaises(self):
+        self.patch(
+            mock.patch.dict(
+                AppConfig.BEDROCK_MODEL_REGION_KEYS_DICT,
+                {"claude_3_5_sonnet": ["tokyo"]},
+            )
+        )
+
+        with self.assertRaises(model_router.BedrockRoutingError):
+            model_router.routedConverse(
+                self.converseKwargs("claude_3_5_sonnet"), "fixed"
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from unittest import mock
+
+from fake_clients import (
+    BUCKET_NAME,
+    FakeAwsTestCase,
+    backend,
+    pdfDocumentName,
+    transcriptionResult,
+)
+from app_config import AppConfig
+from s3_index import S3KeyIndex
+
+"""
+PDFファイルの存在確認用インデックスのテスト
+python -m unittest discover -s tests
+"""
+
+
+class PdfKeyIndexTest(FakeAwsTestCase):
+    def setUp(self):
+        super().setUp()
+        # インデックスにないキーの参照による再構築を、テスト中は行わない（addで追加されたことを確認するため）
+        self.index = S3KeyIndex(
+            self.s3_client,
+            BUCKET_NAME,
+            prefix=AppConfig.PDF_KEY_PREFIX,
+            refresh_interval_seconds=600,
+            min_refresh_interval_seconds=600,
+        )
+        self.index.build()
+        self.usePdfKeyIndex(self.index)
+
+    def testIndexedPdfSkipsHeadObject(self):
+        result = transcriptionResult(pdfDocumentName(self.s3_client.pdf_keys[0]))
+        plan = backend.planSignedUrl(result)
+        self.assertFalse(backend.needsExistenceCheck(plan, self.s3_client))
+
+    def testPdfAddedAfterBuildIsFound(self):
+        object_key = f"{AppConfig.PDF_KEY_PREFIX}added-after-build.pdf"
+        self.s3_client.addPdfKey(object_key)
+        self.assertFalse(self.index.contains(object_key))
+
+        signed_url = backend._resolveSignedUrl(
+            transcriptionResult("added-after-build"), self.s3_client
+        )
+
+        self.assertEqual(signed_url["document_name"], "added-after-build.pdf")
+        self.assertIn(object_key, signed_url["signed_url"])
+        # head_objectで存在を確認したキーは、インデックスに追加される
+        self.assertTrue(self.index.contains(object_key))
+
+    def testMissingPdfIsSkipped(self):
+        object_key = f"{AppConfig.PDF_KEY_PREFIX}missing.pdf"
+
+        signed_url = backend._resolveSignedUrl(
+            transcriptionResult("missing"), self.s3_client
+        )
+
+        self.assertIsNone(signed_url)
+        self.assertFalse(self.index.contains(object_key))
+
+    def testKeyAddedDuringRebuildIsKept(self):
+        object_key = f"{AppConfig.PDF_KEY_PREFIX}added-during-rebuild.pdf"
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+
+        def paginateAndAdd(**kwargs):
+            yield from paginator.paginate(**kwargs)
+            # 一覧の取得の完了後、差し替えの前にhead_objectで存在を確認したキー
+            self.index.add(object_key)
+
+        self.patch(
+            mock.patch.object(
+                self.s3_client,
+                "get_paginator",
+                lambda operation_name: mock.Mock(paginate=paginateAndAdd),
+            )
+        )
+
+        self.index.build()
+
+        self.assertTrue(self.index.contains(object_key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import unittest
+
+import pymupdf
+
+from fake_clients import FakeAwsTestCase, backend
+from app_config import AppConfig
+from attachment_store import ATTACHMENT_REF_KEY
+from run_benchmark import UploadedFile
+
+"""
+PDFファイルのアップロードのテスト
+python -m unittest discover -s tests
+"""
+
+
+def makeEncryptedPdf(padding_bytes):
+    """
+    パスワードで保護された（テキストを抽出できない）PDFを生成する
+    :param padding_bytes: ファイルサイズを大きくするため、添付ファイルとして埋め込む乱数のバイト数
+    :return: PDFの内容
+    """
+    document = pymupdf.open()
+    document.new_page().insert_text((72, 72), "Encrypted document")
+    if padding_bytes:
+        document.embfile_add("padding.bin", os.urandom(padding_bytes))
+    content = document.tobytes(
+        encryption=pymupdf.PDF_ENCRYPT_AES_256, owner_pw="owner", user_pw="user"
+    )
+    document.close()
+    return content
+
+
+class EncryptedPdfUploadTest(FakeAwsTestCase):
+    def testOversizedEncryptedPdfIsRejected(self):
+        content = makeEncryptedPdf(int(AppConfig.PDF_DOCUMENT_MAX_BYTES) + 1024)
+        self.assertLessEqual(len(content), AppConfig.PDF_MAX_UPLOAD_BYTES)
+        uploaded_file = UploadedFile("encrypted.pdf", "application/pdf", content)
+
+        with self.assertRaisesRegex(ValueError, "テキストを抽出できないPDF"):
+            backend.invokeLLMWithFile("要約してください。", uploaded_file, [])
+
+    def testSmallEncryptedPdfIsSentAsDocument(self):
+        content = makeEncryptedPdf(0)
+        uploaded_file = UploadedFile("encrypted.pdf", "application/pdf", content)
+
+        user_message, *_ = backend.buildFileUserMessage(
+            "要約してください。", uploaded_file
+        )
+
+        refs = [
+            block[ATTACHMENT_REF_KEY]
+            for block in user_message["content"]
+            if ATTACHMENT_REF_KEY in block
+        ]
+        self.assertEqual([ref["type"] for ref in refs], ["document"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from unittest import mock
+
+from fake_clients import backend
+from app_config import AppConfig
+from prompt_cache import CACHE_POINT_BLOCK
+
+"""
+プロンプトキャッシュのチェックポイントのテスト
+python -m unittest discover -s tests
+"""
+
+# プロンプトキャッシュに対応しているモデル・対応していないモデル
+SUPPORTED_MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_haiku"]
+UNSUPPORTED_MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+
+SYSTEM_PROMPT = [{"text": "あなたは行政文書に詳しいアシスタントです。" * 100}]
+HISTORY = [
+    {"role": "user", "content": [{"text": "年金の手続きは？" * 100}]},
+    {
+        "role": "assistant",
+        "content": [{"text": "年金の手続きは次のとおりです。" * 100}],
+    },
+]
+QUESTION = "必要な書類は？"
+PASSAGES = [
+    {
+        "document_title": "年金の手続き.pdf",
+        "text": "年金の請求には、年金請求書と戸籍謄本が必要です。",
+        "confidence": "HIGH",
+        "rank": 0,
+    }
+]
+
+
+def cachePointPositions(converse_kwargs):
+    """
+    キャッシュのチェックポイントの位置を返す
+    :param converse_kwargs: ConverseAPIの引数
+    :return: "system"、またはチェックポイントを含むメッセージの位置のリスト
+    """
+    positions = []
+    if CACHE_POINT_BLOCK in converse_kwargs.get("system", []):
+        positions.append("system")
+    for i, message in enumerate(converse_kwargs["messages"]):
+        if CACHE_POINT_BLOCK in message["content"]:
+            positions.append(i)
+    return positions
+
+
+class BuildConverseKwargsTest(unittest.TestCase):
+    def _build(self, model_id):
+        messages = HISTORY + [{"role": "user", "content": [{"text": QUESTION}]}]
+        return backend.buildConverseKwargs(
+            model_id, messages, {"temperature": 0.0}, SYSTEM_PROMPT
+        )
+
+    def testSupportedModelCachesSystemPromptAndHistory(self):
+        converse_kwargs = self._build(SUPPORTED_MODEL_ID)
+
+        # システムプロンプトの末尾と、今回の質問の直前（過去の会話履歴の末尾）に置く
+        self.assertEqual(cachePointPositions(converse_kwargs), ["system", 1])
+        self.assertEqual(converse_kwargs["system"][-1], CACHE_POINT_BLOCK)
+        self.assertEqual(
+            converse_kwargs["messages"][1]["content"][-1], CACHE_POINT_BLOCK
+        )
+
+    def testUnsupportedModelHasNoCachePoint(self):
+        self.assertEqual(cachePointPositions(self._build(UNSUPPORTED_MODEL_ID)), [])
+
+
+class BuildRagConverseKwargsTest(unittest.TestCase):
+    def setUp(self):
+        # RAG検索のシステムプロンプト（AppConfig.SYSTEM_PROMPT）も、チェックポイントを置く対象とする
+        patcher = mock.patch.object(AppConfig, "PROMPT_CACHE_MIN_TOKENS", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _build(self, model_id):
+        # 画面・APIと同じく、会話履歴の最後に今回の質問を追加して渡す
+        history = HISTORY + [{"role": "user", "content": [{"text": QUESTION}]}]
+        converse_kwargs, _ = backend.buildRagConverseKwargs(
+            QUESTION, history, model_id, 0.0, PASSAGES
+        )
+        return converse_kwargs
+
+    def testSupportedModelCachesSystemPromptAndHistory(self):
+        converse_kwargs = self._build(SUPPORTED_MODEL_ID)
+
+        # 会話履歴の末尾に置き、今回の検索結果と、その後の質問には置かない
+        self.assertEqual(cachePointPositions(converse_kwargs), ["system", 2])
+        self.assertEqual(len(converse_kwargs["messages"]), 5)
+
+    def testUnsupportedModelHasNoCachePoint(self):
+        self.assertEqual(cachePointPositions(self._build(UNSUPPORTED_MODEL_ID)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
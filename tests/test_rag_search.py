@@ -0,0 +1,63 @@
+import threading
+import unittest
+from unittest import mock
+
+from fake_clients import FakeAwsTestCase, backend
+from app_config import AppConfig
+
+"""
+RAG検索のテスト
+python -m unittest discover -s tests
+"""
+
+QUESTION = "年金の手続きは？"
+
+
+class RagSearchStreamTest(FakeAwsTestCase):
+    def setUp(self):
+        super().setUp()
+        # 署名付きURLの生成を、テストから完了させるまで止める
+        self.presign_released = threading.Event()
+        generate_signed_urls = backend.generateSignedUrls
+
+        def blockedGenerateSignedUrls(kendra_response):
+            self.presign_released.wait(timeout=10)
+            return generate_signed_urls(kendra_response)
+
+        self.patch(
+            mock.patch.object(backend, "generateSignedUrls", blockedGenerateSignedUrls)
+        )
+
+    def testStreamStartsBeforeSignedUrls(self):
+        stream, result = backend.ragSearch(
+            QUESTION,
+            [{"role": "user", "content": [{"text": QUESTION}]}],
+            AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"],
+            0.0,
+            "all",
+            stream=True,
+        )
+
+        # 署名付きURLの生成の完了を待たずに、回答を最後まで読み込める
+        answer = "".join(stream)
+        self.assertTrue(answer)
+        self.presign_released.set()
+        self.assertTrue(result.signed_urls)
+
+    def testNonStreamReturnsSignedUrls(self):
+        self.presign_released.set()
+        answer, signed_urls = backend.ragSearch(
+            QUESTION,
+            [{"role": "user", "content": [{"text": QUESTION}]}],
+            AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"],
+            0.0,
+            "all",
+        )
+
+        self.assertTrue(answer)
+        self.assertIsInstance(signed_urls, list)
+        self.assertTrue(signed_urls)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import time
+import unittest
+
+from fake_clients import StubBedrockTestCase, model_router
+from app_config import AppConfig
+from region_pool import RegionClientPool
+
+"""
+複数リージョンのBedrockクライアントのプールのテスト
+python -m unittest discover -s tests
+"""
+
+MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_5_sonnet"]
+OTHER_MODEL_ID = AppConfig.MODEL_ID_DICT["claude_3_haiku"]
+
+
+class SelectRegionsTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = RegionClientPool(
+            ["us-west-2", "us-east-1", "ap-northeast-1"],
+            client_factory=lambda region_name, max_attempts: None,
+            cooldown_seconds=0.05,
+            max_cooldown_seconds=0.2,
+        )
+
+    def testUnmeasuredRegionsKeepConfiguredOrder(self):
+        self.assertEqual(
+            self.pool.selectRegions(MODEL_ID),
+            ["us-west-2", "us-east-1", "ap-northeast-1"],
+        )
+
+    def testMeasuredRegionsAreOrderedByLatency(self):
+        self.pool.recordSuccess("us-west-2", 0.8, MODEL_ID)
+        self.pool.recordSuccess("ap-northeast-1", 0.2, MODEL_ID)
+
+        # 計測済みのリージョンをレイテンシの小さい順に、未計測のリージョンはその後に並べる
+        self.assertEqual(
+            self.pool.selectRegions(MODEL_ID),
+            ["ap-northeast-1", "us-west-2", "us-east-1"],
+        )
+        # レイテンシはモデルごとに記録する
+        self.assertEqual(
+            self.pool.selectRegions(OTHER_MODEL_ID),
+            ["us-west-2", "us-east-1", "ap-northeast-1"],
+        )
+
+    def testSuccessWithoutLatencyDoesNotReorder(self):
+        self.pool.recordSuccess("ap-northeast-1", None, MODEL_ID)
+
+        self.assertEqual(
+            self.pool.selectRegions(MODEL_ID),
+            ["us-west-2", "us-east-1", "ap-northeast-1"],
+        )
+
+    def testThrottledRegionCoolsDownForModel(self):
+        self.pool.recordSuccess("us-west-2", 0.1, MODEL_ID)
+        self.pool.recordThrottle("us-west-2", MODEL_ID)
+
+        self.assertEqual(
+            self.pool.selectRegions(MODEL_ID),
+            ["us-east-1", "ap-northeast-1", "us-west-2"],
+        )
+        # スロットリングは(リージョン, モデル)ごとに適用する
+        self.assertEqual(self.pool.selectRegions(OTHER_MODEL_ID)[0], "us-west-2")
+
+        time.sleep(0.1)
+        self.assertEqual(self.pool.selectRegions(MODEL_ID)[0], "us-west-2")
+
+    def testConnectionErrorCoolsDownWholeRegion(self):
+        self.pool.recordError("us-west-2")
+
+        self.assertEqual(self.pool.selectRegions(MODEL_ID)[-1], "us-west-2")
+        self.assertEqual(self.pool.selectRegions(OTHER_MODEL_ID)[-1], "us-west-2")
+        self.assertFalse(self.pool.stats()["us-west-2"]["healthy"])
+
+    def testRepeatedThrottlesExtendCooldown(self):
+        self.pool.recordThrottle("us-west-2", MODEL_ID)
+        self.pool.recordThrottle("us-west-2", MODEL_ID)
+
+        # 2回目は2倍の0.1秒
+        time.sleep(0.07)
+        self.assertEqual(self.pool.selectRegions(MODEL_ID)[-1], "us-west-2")
+        time.sleep(0.07)
+        self.assertEqual(self.pool.selectRegions(MODEL_ID)[0], "us-west-2")
+
+    def testSuccessClearsCooldown(self):
+        self.pool.recordThrottle("us-west-2", MODEL_ID)
+        self.pool.recordSuccess("us-west-2", None, MODEL_ID)
+
+        self.assertEqual(self.pool.selectRegions(MODEL_ID)[0], "us-west-2")
+
+
+class RegionLatencyTest(StubBedrockTestCase):
+    def _converse(self):
+        response, _, _ = model_router.routedConverse(
+            self.converseKwargs("claude_3_5_sonnet"), "fixed", stream=True
+        )
+        return response
+
+    def testRegionsAreOrderedByInjectedFirstByteLatency(self):
+        self.region_pool.cooldown_seconds = 0.05
+        self.clients["us-west-2"].first_byte_seconds = 0.15
+        self.clients["us-east-1"].first_byte_seconds = 0.02
+
+        # 未計測の場合は設定の順（us-west-2）に送信し、最初の1バイトまでの時間を記録する
+        self._converse()
+        # us-west-2でスロットリングが発生した場合は、次のリージョン（us-east-1）で呼び出し直す
+        self.clients["us-west-2"].fail("ThrottlingException")
+        self._converse()
+        self.assertEqual(self.clients["us-west-2"].calls, [MODEL_ID, MODEL_ID])
+        self.assertEqual(self.clients["us-east-1"].calls, [MODEL_ID])
+
+        latencies = {
+            region_name: stats["latency_seconds"].get(MODEL_ID)
+            for region_name, stats in self.region_pool.stats().items()
+        }
+        self.assertGreaterEqual(latencies["us-west-2"], 0.15)
+        self.assertLess(latencies["us-east-1"], 0.15)
+        self.assertIsNone(latencies["ap-northeast-1"])
+        # スロットリングが発生したus-west-2は、優先度を下げている間は最後に並べる
+        self.assertEqual(
+            self.region_pool.selectRegions(MODEL_ID),
+            ["us-east-1", "ap-northeast-1", "us-west-2"],
+        )
+
+        # 優先度を下げる期間が過ぎた後は、レイテンシの順に並べる
+        time.sleep(0.1)
+        self.assertEqual(
+            self.region_pool.selectRegions(MODEL_ID),
+            ["us-east-1", "us-west-2", "ap-northeast-1"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
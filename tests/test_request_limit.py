@@ -0,0 +1,83 @@
+import unittest
+
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+import fake_clients  # noqa: F401 （アプリのモジュールを読み込めるようにする）
+from api_server import RequestLimitMiddleware
+
+"""
+HTTP APIのリクエストの制限のテスト
+python -m unittest discover -s tests
+"""
+
+MAX_BODY_BYTES = 1024
+
+
+def makeApp():
+    """
+    ボディのサイズの上限をMAX_BODY_BYTESとしたRequestLimitMiddlewareと、
+    アップロードされたファイルのサイズを返すエンドポイントのみのアプリを作成する
+    :return: FastAPIのアプリと、エンドポイントの呼び出し回数を記録するリスト
+    """
+    app = FastAPI()
+    app.add_middleware(
+        RequestLimitMiddleware,
+        max_concurrent_requests=10,
+        max_body_bytes=MAX_BODY_BYTES,
+    )
+    calls = []
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        calls.append(file.filename)
+        return {"size": len(await file.read())}
+
+    return app, calls
+
+
+class RequestBodyLimitTest(unittest.TestCase):
+    def setUp(self):
+        app, self.calls = makeApp()
+        self.client = TestClient(app)
+
+    def testBodyWithinLimitIsAccepted(self):
+        response = self.client.post(
+            "/upload", files={"file": ("a.png", b"x" * 100, "image/png")}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"size": 100})
+        self.assertIn("x-request-id", response.headers)
+
+    def testContentLengthOverLimitIsRejected(self):
+        response = self.client.post(
+            "/upload", files={"file": ("a.png", b"x" * 2000, "image/png")}
+        )
+
+        self.assertEqual(response.status_code, 413)
+        # ボディを受信する前に拒否し、エンドポイントは呼び出さない
+        self.assertEqual(self.calls, [])
+
+    def testChunkedBodyOverLimitIsRejected(self):
+        def chunks():
+            yield b"--boundary\r\n"
+            yield b'Content-Disposition: form-data; name="file"; filename="a.png"\r\n'
+            yield b"Content-Type: image/png\r\n\r\n"
+            for _ in range(10):
+                yield b"x" * 500
+            yield b"\r\n--boundary--\r\n"
+
+        # Content-Lengthのないchunkedのリクエストは、受信したサイズが上限を超えた時点で拒否する
+        response = self.client.post(
+            "/upload",
+            content=chunks(),
+            headers={"Content-Type": "multipart/form-data; boundary=boundary"},
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()